@@ -0,0 +1,266 @@
+"""
+Offline analysis of stored games, for blunder statistics over game
+logs without loading the live servers.
+
+Every position of every game is evaluated (or searched), and each move
+is annotated with how much it lost against the best move from the same
+position. In eval mode the best move is the one with the best static
+evaluation one ply on, so both are evaluated with the same side to move.
+Games are streamed from the logs and spread across a pool of processes,
+and positions seen before (openings repeat a lot) are only analysed once
+per process.
+
+    python analyse.py games/ --mode search --level casual --output analysis.jsonl
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+import chess.pieces as chess_pieces
+import engine
+import engine_utils
+from chess.chess import move_to_string
+from game_log import read_games, replay_game
+
+# Scores beyond this (a king can be taken) are clamped, so one lost game
+# doesn't swamp the averages
+EVAL_CLAMP = 10000
+
+# Analysis of positions seen before, by (position key, colour to play)
+ANALYSED = {}
+ANALYSED_SIZE = 100000
+
+# Set in every worker process by init_worker
+settings = {}
+stats = {"positions": 0, "hits": 0}
+
+def init_worker(options):
+    # The engine saves its transposition table to the working directory,
+    # keep each process' table to itself
+    os.chdir(tempfile.mkdtemp(prefix="superchess-analyse-"))
+    sys.stdout = open(os.devnull, "w")
+    # Tables are cleared for every game, nothing to keep
+    engine_utils.TRANSPOSITION_SAVE_INTERVAL = None
+    settings.update(options)
+
+
+def clamp(score):
+    return max(min(score, EVAL_CLAMP), -EVAL_CLAMP)
+
+
+def evaluate_after(board, toPlay, move):
+    """
+    Static evaluation (for white) after toPlay makes move, with the
+    opponent to play. Taking the king is scored as won outright.
+    """
+    captured = board.get_piece(move[1])
+    if isinstance(captured, chess_pieces.King):
+        return EVAL_CLAMP if toPlay == "W" else -EVAL_CLAMP
+
+    board.move_piece(move[0], move[1])
+    try:
+        return clamp(engine_utils.evaluate_board_cached(board, "B" if toPlay == "W" else "W"))
+    finally:
+        board.unmake_move()
+
+
+def best_move_by_eval(board, toPlay):
+    """
+    Returns (score for white, move) for the move whose static evaluation
+    one ply on is best for toPlay, (static evaluation, None) without moves.
+    """
+    best = None
+    pieces, moves = engine_utils.get_all_moves(board, toPlay)
+    for piece, targets in moves.items():
+        start = tuple(piece.pos)
+        for end in targets:
+            move = (start, tuple(end))
+            score = evaluate_after(board, toPlay, move)
+            if best is None or (score > best[0] if toPlay == "W" else score < best[0]):
+                best = (score, move)
+
+    if best is None:
+        return clamp(engine_utils.evaluate_board_cached(board, toPlay)), None
+
+    return best[0], move_to_string(best[1])
+
+
+def analyse_position(board, toPlay):
+    """
+    Returns (score for white, best move or None, reached score for white)
+    for a position, from the cache if it was analysed before. score is
+    what the best move leads to, and reached is what the move into this
+    position is charged with: the search score again, or in eval mode the
+    static evaluation (with the same side to play as the scores of the
+    mover's alternatives).
+    """
+    key = (board.pos_key(), toPlay)
+    stats["positions"] += 1
+    if key in ANALYSED:
+        stats["hits"] += 1
+        return ANALYSED[key]
+
+    if settings["mode"] == "search":
+        scores = []
+        def on_iteration(depth, score, pv, nodes, elapsed):
+            scores.append(score)
+
+        move = engine.get_move(board, toPlay == "B", level=settings["level"], onIteration=on_iteration)
+        # Search scores are for the side to play, and missing on a transposition hit
+        if scores:
+            score = scores[-1] if toPlay == "W" else -scores[-1]
+        else:
+            score = engine_utils.evaluate_board_cached(board, toPlay)
+        result = (clamp(score), move_to_string(move), clamp(score))
+    else:
+        score, move = best_move_by_eval(board, toPlay)
+        result = (score, move, clamp(engine_utils.evaluate_board_cached(board, toPlay)))
+
+    if len(ANALYSED) >= ANALYSED_SIZE:
+        # dicts keep insertion order, so this is the oldest entry
+        del ANALYSED[next(iter(ANALYSED))]
+    ANALYSED[key] = result
+
+    return result
+
+
+def analyse_game(game):
+    """
+    Replays a game, scoring every position. Each move is annotated with
+    the score after it and its loss: how much worse the mover's position
+    got, compared to the best move.
+    """
+    # The table is only a cache here, don't let it grow
+    engine_utils.TRANSPOSITION_TABLE = {}
+    stats["positions"] = stats["hits"] = 0
+
+    # Score of every position, before each move
+    scores = []
+    moves = []
+    board = None
+    for ply, board, move in replay_game(game):
+        scores.append(analyse_position(board, "W" if ply % 2 == 0 else "B"))
+        moves.append(move)
+
+    # The board now holds the final position
+    if board is not None:
+        board.update_game_state()
+        if not board.game_over:
+            scores.append(analyse_position(board, "W" if len(moves) % 2 == 0 else "B"))
+
+    plies = []
+    for ply, move in enumerate(moves):
+        before = scores[ply]
+        annotation = {"ply": ply, "move": move_to_string(move), "best": before[1]}
+        if ply + 1 < len(scores):
+            # Not the move that ended the game, the result speaks for that one.
+            # The best move's score against what the played move reached
+            after = scores[ply + 1]
+            loss = before[0] - after[2] if ply % 2 == 0 else after[2] - before[0]
+            annotation.update({
+                "score": after[2],
+                "loss": max(loss, 0),
+                "blunder": loss >= settings["blunder"],
+            })
+        plies.append(annotation)
+
+    return {
+        "game": game.get("game"),
+        "result": game.get("result"),
+        "plies": plies,
+        "positions": stats["positions"],
+        "cache_hits": stats["hits"],
+    }
+
+
+def summarise(analyses):
+    """
+    Blunders and average loss per move for each side.
+    """
+    report = {"games": len(analyses), "positions": 0, "cache_hits": 0}
+    for colour in ("W", "B"):
+        losses = []
+        blunders = 0
+        for analysis in analyses:
+            first = 0 if colour == "W" else 1
+            for ply in analysis["plies"][first::2]:
+                if "loss" in ply:
+                    losses.append(ply["loss"])
+                    blunders += ply["blunder"]
+        report[colour] = {
+            "moves": len(losses),
+            "blunders": blunders,
+            "average_loss": sum(losses) / len(losses) if losses else 0.0,
+        }
+
+    for analysis in analyses:
+        report["positions"] += analysis["positions"]
+        report["cache_hits"] += analysis["cache_hits"]
+
+    return report
+
+
+def run_analysis(paths, processes, options, output=None, batch=64):
+    """
+    Analyses the games across a pool of processes, streaming them from the
+    logs a batch at a time rather than queueing every game at once.
+    Returns the per game summaries (not their plies).
+    """
+    import multiprocessing
+
+    games = (game for game in read_games(paths) if game.get("moves"))
+    summaries = []
+    with multiprocessing.Pool(processes, init_worker, (options,)) as pool:
+        while True:
+            chunk = list(itertools.islice(games, batch * processes))
+            if not chunk:
+                break
+
+            for analysis in pool.imap(analyse_game, chunk):
+                if output:
+                    output.write(json.dumps(analysis) + "\n")
+                # Keep only what the summary needs
+                summaries.append({
+                    "plies": [{"loss": p["loss"], "blunder": p["blunder"]} if "loss" in p else {} for p in analysis["plies"]],
+                    "positions": analysis["positions"],
+                    "cache_hits": analysis["cache_hits"],
+                })
+            print(f"[==] {len(summaries)} games analysed")
+
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Analyse stored games for blunders.")
+    parser.add_argument("games", nargs="+", help="game logs (files or directories), or match.py --output files")
+    parser.add_argument("--mode", choices=["eval", "search"], default="eval",
+                        help="static evaluation, or a search at --level, of every position")
+    parser.add_argument("--level", default="casual", choices=list(engine.LEVELS))
+    parser.add_argument("--blunder", type=int, default=300,
+                        help="a move losing at least this much is a blunder")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--output", help="write every analysed game to this file, one JSON record per line")
+    args = parser.parse_args()
+
+    options = {
+        "mode": args.mode,
+        "level": args.level,
+        "blunder": args.blunder,
+    }
+    output = open(args.output, "w") if args.output else None
+
+    analyses = run_analysis(args.games, args.processes, options, output)
+    if output:
+        output.close()
+
+    report = summarise(analyses)
+    print()
+    print(f"{report['games']} games, {report['positions']} positions "
+          f"({report['cache_hits']} analysed before)")
+    for colour, name in (("W", "White"), ("B", "Black")):
+        side = report[colour]
+        print(f"{name}: {side['blunders']} blunders in {side['moves']} moves, "
+              f"average loss {side['average_loss']:.1f}")
@@ -0,0 +1,246 @@
+"""
+Analysis of batches of positions for the server's POST /analyse, for
+analytics jobs that need evaluations of thousands of positions.
+
+A request names positions in the suite format (see suite.py) without the
+operations, a FEN-like placement and the side to play:
+
+    {"positions": ["rbnwbrnqknrbwnbr/pppppppppppppppp/16/... w", ...],
+     "mode": "search", "level": "normal", "nodes": 2000, "time": 1}
+
+mode is "eval" (static evaluation) or "search" (a search at level, within
+nodes and time per position, both 0 for the level's own budget). Results
+stream back as they finish, one JSON object per line:
+
+    {"index": 0, "position": "... w", "score": 12, "move": "i9i7",
+     "depth": 2, "nodes": 1885, "cached": false}
+
+with score for white, and move, depth and nodes only for searches.
+Positions that can't be read (or whose analysis fails) get
+{"index": ..., "position": ..., "error": ...}.
+
+Identical positions in a batch are analysed once, and results are kept
+by position key, so positions analysed for an earlier batch (with the same
+settings) are answered straight away. Searches run on a pool of processes,
+started the first time a batch needs one.
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+
+import engine
+import engine_utils
+import metrics
+from chess.chess import ChessBoard, move_to_string
+
+MODES = ("eval", "search")
+
+# Most positions one request may send
+MAX_POSITIONS = 10000
+
+# Scores beyond this (a king can be taken) are clamped, as in analyse.py
+EVAL_CLAMP = 10000
+
+# Level registered in the worker process for each search, see analyse_position
+BATCH_LEVEL = "batch"
+
+# Served at /metrics, see metrics.py
+POSITIONS = metrics.REGISTRY.counter(
+    "superchess_batch_positions_total", "Positions sent for batch analysis, by how they were answered",
+    labels=("result",))
+
+def init_worker():
+    # The engine saves its transposition table to the working directory,
+    # keep each process' table to itself
+    os.chdir(tempfile.mkdtemp(prefix="superchess-batch-"))
+    sys.stdout = open(os.devnull, "w")
+    # Tables are cleared for every position, nothing to keep
+    engine_utils.TRANSPOSITION_SAVE_INTERVAL = None
+
+
+def parse_position(position):
+    """
+    Reads a position string into (board, colour to play).
+    Raises ValueError if it isn't a valid position.
+    """
+    if not isinstance(position, str):
+        raise ValueError(f"Expected a string, got {type(position).__name__}")
+
+    fields = position.split()
+    if not fields:
+        raise ValueError("Empty position")
+    side = fields[1] if len(fields) > 1 else "w"
+    if side not in ("w", "b"):
+        raise ValueError(f"Side to move must be w or b, got {side}")
+
+    try:
+        # Boards print themselves when created
+        with contextlib.redirect_stdout(io.StringIO()):
+            board = ChessBoard(fields[0])
+    except (ValueError, KeyError, IndexError) as e:
+        raise ValueError(f"Invalid placement: {e}")
+
+    # The engine needs both kings on the board
+    codes = board.square_codes()
+    if codes.count("K") != 1 or codes.count("k") != 1:
+        raise ValueError("Invalid placement: each side needs exactly one king")
+
+    return board, side.upper()
+
+
+def parse_options(request):
+    """
+    Checks a request's settings. Returns
+    {"mode": ..., "level": ..., "nodes": ..., "time": ...}
+    or raises ValueError.
+    """
+    options = {
+        "mode": request.get("mode", "search"),
+        "level": request.get("level", engine.DEFAULT_LEVEL),
+        "nodes": request.get("nodes", 0),
+        "time": request.get("time", 0),
+    }
+    if options["mode"] not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    if options["level"] not in engine.LEVELS:
+        raise ValueError(f"level must be one of {', '.join(engine.LEVELS)}")
+    for budget in ("nodes", "time"):
+        if isinstance(options[budget], bool) or not isinstance(options[budget], (int, float)) or options[budget] < 0:
+            raise ValueError(f"{budget} must be a number, at least 0")
+
+    return options
+
+
+def analyse_position(task):
+    """
+    Analyses one position in a worker process.
+    Returns (key, result) with the result as described in the module docstring,
+    or (key, {"error": ...}) if the analysis failed, so one position can't end the batch.
+    """
+    key, fen, toPlay, options = task
+    try:
+        return key, analyse_board(ChessBoard(fen), toPlay, options)
+    except Exception as e:
+        return key, {"error": f"Analysis failed: {e!r}"}
+
+
+def analyse_board(board, toPlay, options):
+    """
+    Evaluates or searches a board, see analyse_position.
+    """
+
+    if options["mode"] == "eval":
+        score = engine_utils.evaluate_board_cached(board, toPlay)
+        return {"score": max(min(score, EVAL_CLAMP), -EVAL_CLAMP)}
+
+    # The level's depth and search features, within the requested budget
+    settings = engine.LEVELS[options["level"]]
+    engine.LEVELS[BATCH_LEVEL] = dict(
+        settings,
+        nodes=options["nodes"] or settings["nodes"],
+        time=options["time"] or settings["time"],
+    )
+    # Don't let one position's search answer another's
+    engine_utils.TRANSPOSITION_TABLE = {}
+
+    iterations = []
+    def on_iteration(depth, score, pv, nodes, elapsed):
+        iterations.append((depth, score, nodes))
+
+    move = engine.get_move(board, toPlay == "B", level=BATCH_LEVEL, onIteration=on_iteration)
+    if iterations:
+        depth, score, nodes = iterations[-1]
+        # Search scores are for the side to play
+        score = score if toPlay == "W" else -score
+    else:
+        # Tablebase hit
+        depth, nodes = 0, 0
+        score = engine_utils.evaluate_board_cached(board, toPlay)
+
+    return {
+        "score": max(min(score, EVAL_CLAMP), -EVAL_CLAMP),
+        "move": move_to_string(move),
+        "depth": depth,
+        "nodes": nodes,
+    }
+
+
+class BatchAnalyser:
+    """
+    Fans batches of positions out to a pool of processes, and keeps the
+    results by position key for later batches.
+    """
+    def __init__(self, processes=None, cache_size=100000):
+        self.processes = processes or os.cpu_count()
+        self.cache_size = cache_size
+        self.pool = None
+        # Results by (position key, colour to play, settings)
+        self.cache = {}
+        # Batches are run from several threads at once
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                import multiprocessing
+                self.pool = multiprocessing.Pool(self.processes, init_worker)
+
+        return self.pool
+
+    def remember(self, key, result):
+        with self.lock:
+            if len(self.cache) >= self.cache_size:
+                # dicts keep insertion order, so this is the oldest entry
+                del self.cache[next(iter(self.cache))]
+            self.cache[key] = result
+
+    def analyse(self, positions, options):
+        """
+        Yields a result for every position, cached and unreadable ones
+        first and then the rest as they finish, tagged with their index
+        in positions.
+        """
+        settings = (options["mode"], options["level"], options["nodes"], options["time"])
+
+        # Indexes waiting on each position being analysed
+        waiting = {}
+        tasks = []
+        for index, position in enumerate(positions):
+            try:
+                board, toPlay = parse_position(position)
+            except ValueError as e:
+                POSITIONS.inc("invalid")
+                yield {"index": index, "position": position, "error": str(e)}
+                continue
+
+            key = (board.pos_key(), toPlay, settings)
+            if key in self.cache:
+                POSITIONS.inc("cached")
+                yield dict(self.cache[key], index=index, position=position, cached=True)
+            elif key in waiting:
+                POSITIONS.inc("duplicate")
+                waiting[key].append((index, position))
+            else:
+                waiting[key] = [(index, position)]
+                # Workers get the placement back, it pickles smaller than the board
+                tasks.append((key, board.to_fen(), toPlay, options))
+
+        if not tasks:
+            return
+
+        for key, result in self.get_pool().imap_unordered(analyse_position, tasks):
+            if "error" in result:
+                POSITIONS.inc("failed")
+            else:
+                self.remember(key, result)
+                POSITIONS.inc("analysed")
+            for index, position in waiting.pop(key):
+                yield dict(result, index=index, position=position, cached=False)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -2,6 +2,53 @@ import numpy as np
 from . import pieces as chess_pieces
 import colorama
 import hashlib
+import random
+
+# Board size, see pieces.gen_board
+ROWS = 10
+COLS = 16
+
+KNIGHT_STEPS = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]
+KING_STEPS = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if (i, j) != (0, 0)]
+ORTHOGONAL = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+DIAGONAL = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+def leaper_table(steps, wrap=False):
+    """
+    Returns, for every square [row][col], the squares a piece making the
+    given steps could reach it from. wrap joins the left and right edges,
+    as wormholes do.
+    """
+    table = [[[] for _ in range(COLS)] for _ in range(ROWS)]
+    for row in range(ROWS):
+        for col in range(COLS):
+            for step in steps:
+                fromRow, fromCol = row - step[0], col - step[1]
+                if wrap:
+                    fromCol %= COLS
+                if 0 <= fromRow < ROWS and 0 <= fromCol < COLS:
+                    table[row][col].append((fromRow, fromCol))
+
+    return table
+
+KNIGHT_ATTACKS = leaper_table(KNIGHT_STEPS)
+KING_ATTACKS = leaper_table(KING_STEPS)
+WORMHOLE_ATTACKS = leaper_table(KING_STEPS, wrap=True)
+
+# Zobrist hashing: a position's key is the XOR of one random number per
+# piece on the board, by square code (see ChessBoard.square_codes) and
+# square index. Keys are updated as pieces are set, rather than rehashing
+# the whole board
+ZOBRIST_RANDOM = random.Random(0)
+ZOBRIST = {
+    code: [ZOBRIST_RANDOM.getrandbits(64) for _ in range(ROWS * COLS)]
+    for code in "KQWRBNPkqwrbnp"
+}
+# XORed into a key for black to play, for tables where that matters
+ZOBRIST_BLACK = ZOBRIST_RANDOM.getrandbits(64)
+
+# A position reached this many times, with the same side to move, is a draw
+DRAW_REPETITIONS = 3
 
 class ChessBoard:
     """
@@ -20,8 +67,9 @@ class ChessBoard:
         W - White
         B - Black
     """
-    def __init__(self):
-        self.board = chess_pieces.gen_board()
+    def __init__(self, fen=None):
+        # Start from a FEN-like placement (see to_fen) or the default position
+        self.board = chess_pieces.board_from_fen(fen) if fen else chess_pieces.gen_board()
         self.shape = self.board.shape
         self.last_moved_piece = None
         self.last_moved_piece_from = None
@@ -29,13 +77,43 @@ class ChessBoard:
         self.game_over = False
         self.outcome = None
 
+        self.compute_mailbox()
+        self.compute_zobrist()
+
+        # Zobrist key of every position reached, for spotting repetitions,
+        # and what unmake_move needs to take each move back
+        self.history = [self.zobrist]
+        self.undo = []
+
         print(self)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Boards pickled (e.g. in stored sessions) before these were kept
+        if "mailbox" not in state:
+            self.compute_mailbox()
+        if "zobrist" not in state:
+            self.compute_zobrist()
+        if "history" not in state:
+            self.history = [self.zobrist]
+            self.undo = []
+
+    def compute_mailbox(self):
+        """
+        Builds the padded mailbox used for move generation: every square
+        of the board, surrounded by OFF_BOARD squares, as one flat list
+        indexed by chess_pieces.to_mailbox. set_piece keeps it up to date.
+        """
+        self.mailbox = [chess_pieces.OFF_BOARD] * (chess_pieces.MAILBOX_ROWS * chess_pieces.MAILBOX_COLS)
+        for row in range(self.shape[0]):
+            for col in range(self.shape[1]):
+                self.mailbox[chess_pieces.to_mailbox((row, col))] = self.board[row][col]
     
     def pos_key(self):
         """
         Returns a unique key for the current board position.
         """
-        position = self.board_to_string_compact()
+        position = "".join(code or "." for code in self.square_codes())
     
         return hashlib.sha256(position.encode("utf-8")).hexdigest()
     
@@ -53,7 +131,48 @@ class ChessBoard:
                     board_string += " "
 
         return board_string
-    
+
+    def square_codes(self):
+        """
+        Returns one code per square, row by row.
+        Codes are piece keys, uppercase for white and lowercase for black,
+        or an empty string for empty squares.
+        """
+        codes = []
+
+        for row in self.board:
+            for piece in row:
+                if piece:
+                    codes.append(piece.key if piece.colour == "W" else piece.key.lower())
+                else:
+                    codes.append("")
+
+        return codes
+
+    def to_fen(self):
+        """
+        Returns the piece placement as a FEN-like string, read back by
+        ChessBoard(fen=...). Rows run from row 1 to row 10, uppercase keys
+        are white, lowercase black and digits count empty squares.
+        """
+        rows = []
+        for row in self.board:
+            fen_row = ""
+            empty = 0
+            for piece in row:
+                if piece:
+                    if empty:
+                        fen_row += str(empty)
+                        empty = 0
+                    fen_row += piece.key if piece.colour == "W" else piece.key.lower()
+                else:
+                    empty += 1
+            if empty:
+                fen_row += str(empty)
+            rows.append(fen_row)
+
+        return "/".join(rows)
+
     def __repr__(self):
         return self.board_to_string()
     
@@ -108,13 +227,12 @@ class ChessBoard:
     
     def get_piece(self, pos):
         """
-        Returns the piece at the given position.
+        Returns the piece at the given position, None if it is off the board.
         """
-        try:
-            return self.board[pos[0]][pos[1]]
-        except IndexError:
-            # print(f"IndexError: {pos} is not a valid position.")
-            return None
+        if 0 <= pos[0] < ROWS and 0 <= pos[1] < COLS:
+            return self.mailbox[chess_pieces.to_mailbox(pos)]
+
+        return None
 
  
     def is_empty(self, pos):
@@ -128,15 +246,53 @@ class ChessBoard:
         Sets the piece at the given position.
         No checking is done to ensure the move is legal.
         """
-        self.board[pos[0]][pos[1]] = piece
+        row, col = pos[0], pos[1]
+        old = self.board[row][col]
+        if old is not None:
+            self.update_zobrist(old, row, col)
+        if piece is not None:
+            self.update_zobrist(piece, row, col)
+        self.board[row][col] = piece
+        self.mailbox[chess_pieces.to_mailbox(pos)] = piece
+
+    def compute_zobrist(self):
+        """
+        Computes the Zobrist keys of all the pieces, and of the pawns alone,
+        from scratch. set_piece keeps them up to date after that.
+        """
+        self.zobrist = 0
+        self.pawn_zobrist = 0
+        for row in range(self.shape[0]):
+            for col in range(self.shape[1]):
+                if self.board[row][col] is not None:
+                    self.update_zobrist(self.board[row][col], row, col)
+
+    def update_zobrist(self, piece, row, col):
+        """
+        Adds a piece on the given square to the Zobrist keys, or removes it
+        if it is already there (XOR undoes itself).
+        """
+        number = ZOBRIST[piece.key if piece.colour == "W" else piece.key.lower()][row * COLS + col]
+        self.zobrist ^= number
+        if isinstance(piece, chess_pieces.Pawn):
+            self.pawn_zobrist ^= number
     
     def move_piece(self, start_pos, end_pos):
-        """Move a piece without checking for legality."""
+        """
+        Move a piece without checking for legality.
+        The move can be taken back with unmake_move.
+        """
         piece = self.get_piece(start_pos)
 
         # Get captured piece if any
         captured_piece = self.get_piece(end_pos)
 
+        self.undo.append((
+            start_pos, end_pos, captured_piece,
+            piece.pos, piece.has_moved, getattr(piece, "moved_two", False),
+            self.last_moved_piece, self.last_moved_piece_from, self.last_moved_piece_to,
+        ))
+
         self.set_piece(start_pos, None)
         self.set_piece(end_pos, piece)
         piece.has_moved = True
@@ -150,7 +306,55 @@ class ChessBoard:
         if isinstance(piece, chess_pieces.Pawn):
             piece.moved_two = abs(start_pos[0] - end_pos[0]) == 2
 
+        self.history.append(self.zobrist)
+
         return captured_piece
+
+    def unmake_move(self):
+        """
+        Takes back the last move made with move_piece, putting back
+        any captured piece. The game state is left as it is.
+        """
+        (start_pos, end_pos, captured_piece,
+         pos, has_moved, moved_two,
+         last_piece, last_from, last_to) = self.undo.pop()
+        self.history.pop()
+
+        piece = self.get_piece(end_pos)
+        self.set_piece(end_pos, captured_piece)
+        self.set_piece(start_pos, piece)
+        piece.pos = pos
+        piece.has_moved = has_moved
+        if isinstance(piece, chess_pieces.Pawn):
+            piece.moved_two = moved_two
+
+        self.last_moved_piece = last_piece
+        self.last_moved_piece_from = last_from
+        self.last_moved_piece_to = last_to
+
+    def make_null_move(self):
+        """
+        Passes the move to the other side (for the search's null-move
+        pruning), so the history keeps which side each position is for.
+        Taken back with unmake_null_move.
+        """
+        self.history.append(None)
+
+    def unmake_null_move(self):
+        self.history.pop()
+
+    def repetitions(self):
+        """
+        Returns how many times the current position was reached before,
+        with the same side to move.
+        """
+        key = self.history[-1]
+        if key is None:
+            # Just after a null move
+            return 0
+
+        # Every other position was reached with the other side to move
+        return self.history[-3::-2].count(key)
     
     def get_legal_moves(self, pos):
         """
@@ -171,18 +375,105 @@ class ChessBoard:
         
         return legal_moves
     
+    def get_legal_move_map(self, colour):
+        """
+        Returns every legal move for the given colour, keyed by square index.
+        Squares are indexed row * width + col, e.g.
+        {
+            "136": [120, 104],
+            ...
+        }
+        Pieces without legal moves are left out.
+        """
+        width = self.shape[1]
+        pieces = self.get_white_pieces() if colour == "W" else self.get_black_pieces()
+
+        move_map = {}
+        for piece in pieces:
+            moves = self.get_legal_moves(piece.pos)
+            if moves:
+                index = piece.pos[0] * width + piece.pos[1]
+                move_map[str(index)] = [move[0] * width + move[1] for move in moves]
+
+        return move_map
+
     def is_pos_safe_for_king(self, pos, colour):
         """
         Returns True if the given position is safe for the king.
         """
-        for row in self.board:
-            for piece in row:
-                if piece and piece.colour != colour:
-                    if pos in piece.get_moves(self):
-                        return False
-        
-        return True
-    
+        return not self.is_square_attacked(pos, "W" if colour == "B" else "B")
+
+    def is_square_attacked(self, square, by_colour):
+        """
+        Returns True if a piece of by_colour could capture on the given square
+        (whatever is on it now). Looks outward from the square for attackers,
+        instead of generating every piece's moves.
+        """
+        return next(self.get_attackers(square, by_colour), None) is not None
+
+    def get_attackers(self, square, by_colour, ignore=()):
+        """
+        Yields the pieces of by_colour that could capture on the given square,
+        leapers first, then pawns, then sliders.
+        Squares in ignore (as (row, col) tuples) are treated as empty, so
+        sliders behind a piece that has already captured show up (x-rays).
+        """
+        row, col = square[0], square[1]
+        board = self.board
+
+        def attacker(pos, kinds):
+            piece = board[pos[0]][pos[1]]
+            if (piece is not None and piece.colour == by_colour
+                    and isinstance(piece, kinds) and pos not in ignore):
+                return piece
+            return None
+
+        # Leapers
+        for table, kinds in (
+            (KNIGHT_ATTACKS, chess_pieces.Knight),
+            (KING_ATTACKS, chess_pieces.King),
+            (WORMHOLE_ATTACKS, chess_pieces.Wormhole),
+        ):
+            for pos in table[row][col]:
+                piece = attacker(pos, kinds)
+                if piece:
+                    yield piece
+
+        # Pawns capture diagonally forward, so attack from one row behind
+        pawnRow = row - (1 if by_colour == "B" else -1)
+        if 0 <= pawnRow < ROWS:
+            for pawnCol in (col - 1, col + 1):
+                if 0 <= pawnCol < COLS:
+                    piece = attacker((pawnRow, pawnCol), chess_pieces.Pawn)
+                    if piece:
+                        yield piece
+
+        # Sliders, up to the first piece in each direction
+        for directions, kinds in (
+            (ORTHOGONAL, (chess_pieces.Rook, chess_pieces.Queen)),
+            (DIAGONAL, (chess_pieces.Bishop, chess_pieces.Queen)),
+        ):
+            for step in directions:
+                r, c = row + step[0], col + step[1]
+                while 0 <= r < ROWS and 0 <= c < COLS:
+                    if board[r][c] is not None and (r, c) not in ignore:
+                        piece = attacker((r, c), kinds)
+                        if piece:
+                            yield piece
+                        break
+                    r += step[0]
+                    c += step[1]
+
+        # Wormholes jumping a friendly pawn onto an empty square
+        if board[row][col] is None:
+            for step in ORTHOGONAL:
+                pawnRow, pawnCol = row - step[0], (col - step[1]) % COLS
+                fromRow, fromCol = row - 2 * step[0], (col - 2 * step[1]) % COLS
+                if 0 <= fromRow < ROWS and attacker((pawnRow, pawnCol), chess_pieces.Pawn):
+                    piece = attacker((fromRow, fromCol), chess_pieces.Wormhole)
+                    if piece:
+                        yield piece
+
     def get_legal_moves_by_piece(self, piece):
         """
         Returns a list of legal moves for the given piece.
@@ -329,8 +620,10 @@ class ChessBoard:
         Returns True if the given colour is in check.
         """
         king = self.get_king(colour)
-        threatened_pieces = self.get_threatened_pieces("W" if colour == "B" else "B")
-        return king in threatened_pieces
+        if not king:
+            return False
+
+        return self.is_square_attacked(king.pos, "W" if colour == "B" else "B")
     
     def update_game_state(self):
         """
@@ -363,6 +656,14 @@ class ChessBoard:
                 "type": "stalemate",
                 "winner": None,
             }
+
+        # Check if the same position keeps coming back
+        elif self.repetitions() + 1 >= DRAW_REPETITIONS:
+            self.game_over = True
+            self.outcome = {
+                "type": "repetition",
+                "winner": None,
+            }
         
     def get_pawns(self, colour):
         """
@@ -486,4 +787,31 @@ class ChessBoard:
         """
         Returns the distance between two positions.
         """
-        return max(abs(pos1[0] - pos2[0]), abs(pos1[1] - pos2[1]))
\ No newline at end of file
+        return max(abs(pos1[0] - pos2[0]), abs(pos1[1] - pos2[1]))
+
+def pos_to_square(pos):
+    """
+    Returns the name of a position, column letter then row number
+    as labelled by ChessBoard.board_to_string, e.g. (9, 8) -> "i10".
+    """
+    return chr(pos[1] + 97) + str(pos[0] + 1)
+
+def square_to_pos(square):
+    """
+    Returns the position of a square name, e.g. "i10" -> (9, 8).
+    """
+    return (int(square[1:]) - 1, ord(square[0].lower()) - 97)
+
+def move_to_string(move):
+    """
+    Returns a move (start_pos, end_pos) as a string, e.g. "i9i7".
+    """
+    return pos_to_square(move[0]) + pos_to_square(move[1])
+
+def string_to_move(string):
+    """
+    Returns the move (start_pos, end_pos) written by move_to_string.
+    """
+    # The start square's row number ends where the second letter starts
+    split = next(i for i in range(1, len(string)) if string[i].isalpha())
+    return (square_to_pos(string[:split]), square_to_pos(string[split:]))
@@ -1,6 +1,7 @@
 import numpy as np
 import colorama
 import copy
+import re
 
 # Directions
 DIRECTION_HORIZONTAL = [
@@ -20,6 +21,68 @@ DIRECTION_DIAGONAL = [
     [-1, 1]
 ]
 
+# Padded mailbox (see ChessBoard.mailbox): the board with a border two
+# squares wide all round, flattened row by row. A knight's jump from any
+# square still lands in the list, and border squares hold OFF_BOARD, so
+# move generation needs no bounds checks
+BORDER = 2
+MAILBOX_ROWS = 10 + 2 * BORDER
+MAILBOX_COLS = 16 + 2 * BORDER
+OFF_BOARD = False
+
+def to_mailbox(pos):
+    """Mailbox index of a (row, col) position."""
+    return (pos[0] + BORDER) * MAILBOX_COLS + pos[1] + BORDER
+
+def from_mailbox(index):
+    """[row, col] position of a mailbox index."""
+    row, col = divmod(index, MAILBOX_COLS)
+    return [row - BORDER, col - BORDER]
+
+def offsets(steps):
+    """Mailbox offsets of (row, col) steps."""
+    return [step[0] * MAILBOX_COLS + step[1] for step in steps]
+
+# In the order moves have always been generated, which the search's
+# move ordering keeps for quiet moves
+KING_STEPS = [(i, j) for i in range(-1, 2) for j in range(-1, 2) if (i, j) != (0, 0)]
+KING_OFFSETS = offsets(KING_STEPS)
+QUEEN_OFFSETS = offsets(DIRECTION_HORIZONTAL + DIRECTION_VERTICAL + DIRECTION_DIAGONAL)
+ROOK_OFFSETS = offsets([[1, 0], [-1, 0], [0, 1], [0, -1]])
+BISHOP_OFFSETS = offsets([[1, 1], [-1, 1], [1, -1], [-1, -1]])
+KNIGHT_OFFSETS = offsets([[2, 1], [2, -1], [-2, 1], [-2, -1], [1, 2], [1, -2], [-1, 2], [-1, -2]])
+
+def slide(board, piece, directions):
+    """
+    Returns the squares a sliding piece can move to along each mailbox
+    offset in directions. Once it hits a piece, it cannot move past it,
+    but can capture it if it is an enemy.
+    """
+    mailbox = board.mailbox
+    start = to_mailbox(piece.pos)
+    moves = []
+    for offset in directions:
+        index = start + offset
+        on = mailbox[index]
+        while on is None:
+            moves.append(from_mailbox(index))
+            index += offset
+            on = mailbox[index]
+
+        if on is not OFF_BOARD and on.colour != piece.colour:
+            moves.append(from_mailbox(index))
+
+    return moves
+
+def leap(board, piece, directions):
+    """
+    Returns the squares on the board a piece can jump to by each mailbox
+    offset in directions. Friendly pieces are left to the board's rules.
+    """
+    mailbox = board.mailbox
+    start = to_mailbox(piece.pos)
+    return [from_mailbox(start + offset) for offset in directions if mailbox[start + offset] is not OFF_BOARD]
+
 class Piece:
     def __init__(self, colour, pos):
         self.colour = colour
@@ -60,14 +123,7 @@ class King(Piece):
         """
         Can move one space in any direction.
         """
-        moves = []
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                if i == 0 and j == 0:
-                    continue
-                moves.append([self.pos[0] + i, self.pos[1] + j])
-        
-        return moves
+        return leap(board, self, KING_OFFSETS)
 
 class Queen(Piece):
     def __init__(self, colour, pos):
@@ -81,29 +137,8 @@ class Queen(Piece):
         Can move any number of spaces in any direction.
         Once it hits a piece, it cannot move past it.
         """
-        moves = []
-        
         # For each direction (horizontal, vertical, diagonal)
-        for direction in DIRECTION_HORIZONTAL + DIRECTION_VERTICAL + DIRECTION_DIAGONAL:
-            # For each step in that direction
-            for i in range(1, 16):
-                pos = [self.pos[0] + direction[0] * i, self.pos[1] + direction[1] * i]
-                
-                on = board.get_piece(pos)
-
-                # If its a friendly piece, stop non-inclusive
-                if on:
-                    if on.colour == self.colour:
-                        break
-                    # If its an enemy piece, add it and stop
-                    else:
-                        moves.append(pos)
-                        break
-
-                moves.append(pos)
-
-        
-        return moves
+        return slide(board, self, QUEEN_OFFSETS)
     
 class Wormhole(Piece):
     def __init__(self, colour, pos):
@@ -122,46 +157,28 @@ class Wormhole(Piece):
             a. Destination *must* be empty
             b. Can only jump horizontally or vertically
         """
-        # Rule 1: Move 1 step in any direction
+        mailbox = board.mailbox
+        row, col = self.pos[0], self.pos[1]
         moves = []
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                if i == 0 and j == 0:
-                    continue
-
-                pos = [self.pos[0] + i, self.pos[1] + j]
-
-                # Rule 3: If it is on a pawn, it can jump over it
-                # Is it on a pawn?
-                on = board.get_piece(pos)
-                if isinstance(on, Pawn):
-                    # Is it a friendly pawn?
-                    if on.colour == self.colour:
-                        # Rule 3a: Destination (dir * 2) must be empty
-                        direction = [i, j]
-                        dest = [pos[0] + direction[0], pos[1] + direction[1]]
-                        if board.get_piece(dest) is None:
-                            # Rule 3b: Can only jump horizontally or vertically
-                            if direction[0] == 0 or direction[1] == 0:
-                                moves.append(dest)
-                    else:
-                        # Can capture enemy pawn
-                        moves.append(pos)
-                else:
-                    # Can move to empty space or capture enemy piece
-                    moves.append(pos)
-        
-        # Rule 2: Loop round the board
-        # Position in form (y, x)
-        for i in range(len(moves)):
-            # If moving out of through right side
-            if moves[i][1] > 15:
-                # Teleport to left side
-                moves[i][1] = 0
-            # If moving out of through left side
-            elif moves[i][1] < 0:
-                # Teleport to right side
-                moves[i][1] = 15
+        # Rule 1: Move 1 step in any direction
+        for i, j in KING_STEPS:
+            # Rule 2: Loop round the left and right sides (rows don't)
+            pos = [row + i, (col + j) % 16]
+            on = mailbox[to_mailbox(pos)]
+            if on is OFF_BOARD:
+                continue
+
+            # Rule 3: If it is on a friendly pawn, it can jump over it
+            if isinstance(on, Pawn) and on.colour == self.colour:
+                # Rule 3b: Can only jump horizontally or vertically
+                if i == 0 or j == 0:
+                    # Rule 3a: Destination must be empty
+                    dest = [row + 2 * i, (col + 2 * j) % 16]
+                    if mailbox[to_mailbox(dest)] is None:
+                        moves.append(dest)
+            else:
+                # Can move to empty space or capture enemy piece
+                moves.append(pos)
         
         return moves
 
@@ -177,29 +194,7 @@ class Rook(Piece):
         Can move any number of spaces in any direction.
         Once it hits a piece, it cannot move past it.
         """
-        directions = [
-            [1, 0],
-            [-1, 0],
-            [0, 1],
-            [0, -1]
-        ]
-        moves = []
-        for direction in directions:
-            # Move in direction until it hits a piece
-            for k in range(16):
-                pos = [self.pos[0] + direction[0] * (k + 1), self.pos[1] + direction[1] * (k + 1)]
-                piece = board.get_piece(pos)
-                if piece:
-                    if piece.colour != self.colour:
-                        # Can capture enemy piece
-                        moves.append(pos)
-                    # Cannot move past any piece
-                    break
-                else:
-                    # Can move to empty space
-                    moves.append(pos)
-        
-        return moves
+        return slide(board, self, ROOK_OFFSETS)
 
 class Bishop(Piece):
     def __init__(self, colour, pos):
@@ -213,29 +208,7 @@ class Bishop(Piece):
         Can move any number of spaces in any direction.
         Once it hits a piece, it cannot move past it.
         """
-        directions = [
-            [1, 1],
-            [-1, 1],
-            [1, -1],
-            [-1, -1]
-        ]
-        moves = []
-        for direction in directions:
-            # Move in direction until it hits a piece
-            for k in range(16):
-                pos = [self.pos[0] + direction[0] * (k + 1), self.pos[1] + direction[1] * (k + 1)]
-                piece = board.get_piece(pos)
-                if piece:
-                    if piece.colour != self.colour:
-                        # Can capture enemy piece
-                        moves.append(pos)
-                    # Cannot move past any piece
-                    break
-                else:
-                    # Can move to empty space
-                    moves.append(pos)
-        
-        return moves
+        return slide(board, self, BISHOP_OFFSETS)
 
 class Knight(Piece):
     def __init__(self, colour, pos):
@@ -245,25 +218,9 @@ class Knight(Piece):
         self.key = "N"
     
     def get_moves(self, board):
-        # Positions are in format (y, x)
-        knight_moves = [
-            [2, 1],
-            [2, -1],
-            [-2, 1],
-            [-2, -1],
-            [1, 2],
-            [1, -2],
-            [-1, 2],
-            [-1, -2]
-        ]
-        moves = []
-        for move in knight_moves:
-            pos = [self.pos[0] + move[0], self.pos[1] + move[1]]
-            # we trust that the board will check if the move is valid
-            # through global rules
-            moves.append(pos)
-        
-        return moves
+        # we trust that the board will check if the move is valid
+        # through global rules
+        return leap(board, self, KNIGHT_OFFSETS)
 
 class Pawn(Piece):
     def __init__(self, colour, pos):
@@ -282,35 +239,33 @@ class Pawn(Piece):
         3. Can capture diagonally forward one space
         4. Can en-passant capture diagonally forward one space
         """
+        mailbox = board.mailbox
+        start = to_mailbox(self.pos)
+        forward = self.direction * MAILBOX_COLS
         moves = []
 
         # Rule 1: Can move relatively forward one space
-        pos = [self.pos[0] + self.direction, self.pos[1]]
-        if board.is_empty(pos):
-            moves.append(pos)
+        if mailbox[start + forward] is None:
+            moves.append(from_mailbox(start + forward))
             # Rule 2: Can move relatively forward two spaces if it has not moved yet
-            if not self.has_moved:
-                pos = [self.pos[0] + self.direction * 2, self.pos[1]]
-                if board.is_empty(pos):
-                    moves.append(pos)
+            if not self.has_moved and mailbox[start + forward * 2] is None:
+                moves.append(from_mailbox(start + forward * 2))
             
         # Rule 3: Can capture diagonally forward one space
         for i in [-1, 1]:
             # Move up in direction, and either left or right
-            pos = [self.pos[0] + self.direction, self.pos[1] + i]
-            piece = board.get_piece(pos)
+            piece = mailbox[start + forward + i]
             if piece and piece.colour != self.colour:
-                moves.append(pos)
+                moves.append(from_mailbox(start + forward + i))
         
         # Rule 4: Can en-passant capture diagonally forward one space
         # Check if there is a pawn in same row, one space away
         for i in [-1, 1]:
-            pos = [self.pos[0], self.pos[1] + i]
-            piece = board.get_piece(pos)
+            piece = mailbox[start + i]
             if isinstance(piece, Pawn) and piece.colour != self.colour:
                 # Check if the pawn has moved two spaces
                 if piece.has_moved_two_spaces:
-                    moves.append([self.pos[0] + self.direction, self.pos[1] + i])
+                    moves.append(from_mailbox(start + forward + i))
 
         return moves
 
@@ -362,5 +317,43 @@ def gen_board():
 
     return board
 
+def board_from_fen(fen):
+    """
+    Builds a board from the piece placement part of a FEN-like string.
+    Rows are listed from row 1 (black's back rank) to row 10, separated by
+    "/", with uppercase keys for white, lowercase for black and digits
+    for runs of empty squares, e.g. the starting position begins
+    "rbnwbrnqknrbwnbr/pppppppppppppppp/16/...".
+
+    Pawns off their starting row are marked as moved, so they
+    don't get a double step.
+    """
+    placement = fen.split()[0]
+    rows = placement.split("/")
+    if len(rows) != 10:
+        raise ValueError(f"Expected 10 rows, got {len(rows)}: {placement}")
+
+    board = np.full((10, 16), None, dtype=object)
+    for y, row in enumerate(rows):
+        x = 0
+        # Runs of empty squares can be two digits wide
+        for run, symbol in re.findall(r"(\d+)|(\D)", row):
+            if run:
+                x += int(run)
+                continue
+            if x >= 16:
+                raise ValueError(f"Row {y + 1} is too long: {row}")
+
+            piece = symbol_to_piece(symbol, (y, x))
+            if isinstance(piece, Pawn):
+                piece.has_moved = y != (1 if piece.colour == "B" else 8)
+            board[y][x] = piece
+            x += 1
+
+        if x != 16:
+            raise ValueError(f"Row {y + 1} has {x} squares: {row}")
+
+    return board
+
 # Default position
 pieces = ['R', 'B', 'N', 'W', 'B', 'R', 'N', 'Q', 'K', 'N', 'R', 'B', 'W', 'N', 'B', 'R']
\ No newline at end of file
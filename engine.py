@@ -1,28 +1,182 @@
 import copy
 import engine_utils
 import random
+import tablebase
+import threading
+import time
+from chess import chess
+import chess.pieces as chess_pieces
 
-MAX_DEPTH = 2
 SENTINEL_VALUE = None
 
-def get_move(board, isBlack=True):
+# Larger than any evaluation (a captured king is 9999999999)
+INFINITY = 99999999999
+# Half width of the aspiration window around the previous iteration's score
+ASPIRATION_WINDOW = 50
+
+# Null-move pruning: let the opponent move twice, and if we are still
+# above beta, assume a real move would be too
+NULL_MOVE_MIN_DEPTH = 3
+NULL_MOVE_REDUCTION = 2
+
+# Late-move reductions: quiet moves ordered late are searched shallower,
+# and only searched again at full depth if they beat alpha
+LMR_MIN_DEPTH = 3
+LMR_MIN_MOVES = 4 # moves searched at full depth before reducing
+LMR_REDUCTION = 1
+
+# Probe the endgame tablebases (see tablebase.py) before searching
+TABLEBASES = True
+
+# Score of a drawn position, e.g. one repeated during the search
+DRAW_SCORE = 0
+
+# Quiescence search: at the horizon, keep resolving captures (only those
+# the static exchange evaluation doesn't expect to lose) before evaluating
+QUIESCENCE_MAX_DEPTH = 4
+
+# Bot strength levels. Each bounds how much work one move may cost:
+#   depth - deepest iteration
+#   nodes - node budget (0 for none)
+#   time - time budget in seconds (0 for none)
+# and which search features are used (quiescence extends the search past
+# its depth until the captures run out, lazy_eval skips the expensive part
+# of the evaluation at leaves far outside the window).
+# Budgets are checked once depth 1 is complete, so there is always a move.
+# Node budgets leave room for the level's depth in ordinary positions
+# (depth 2 takes up to about 2000 nodes, depth 3 about 5000 with null-move
+# pruning and late-move reductions and 8000-15000 without), so they only
+# cut the search short in unusually busy ones
+LEVELS = {
+    "casual": {
+        "depth": 1, "nodes": 100, "time": 1,
+        "aspiration": False, "null_move": False, "lmr": False,
+        "quiescence": False, "lazy_eval": False,
+    },
+    "easy": {
+        "depth": 2, "nodes": 4000, "time": 10,
+        "aspiration": True, "null_move": False, "lmr": False,
+        "quiescence": False, "lazy_eval": True,
+    },
+    "normal": {
+        "depth": 3, "nodes": 6000, "time": 15,
+        "aspiration": True, "null_move": True, "lmr": True,
+        "quiescence": False, "lazy_eval": True,
+    },
+    "hard": {
+        "depth": 3, "nodes": 30000, "time": 30,
+        "aspiration": True, "null_move": True, "lmr": True,
+        "quiescence": False, "lazy_eval": True,
+    },
+    "max": {
+        "depth": 5, "nodes": 0, "time": 60,
+        "aspiration": True, "null_move": True, "lmr": True,
+        "quiescence": True, "lazy_eval": True,
+    },
+}
+DEFAULT_LEVEL = "normal"
+
+class SearchStopped(Exception):
+    """Raised inside a search when its stop event is set."""
+    pass
+
+class BudgetExceeded(SearchStopped):
+    """Raised inside a search when it runs out of nodes or time."""
+    pass
+
+class Search:
+    """
+    One search: its limits and features (from a strength level),
+    and the nodes it has searched so far.
+    """
+    def __init__(self, level=DEFAULT_LEVEL, stop=None, onIteration=None):
+        settings = LEVELS[level]
+        self.level = level
+        self.maxDepth = settings["depth"]
+        self.maxNodes = settings["nodes"]
+        self.maxTime = settings["time"]
+        self.aspiration = settings["aspiration"]
+        self.nullMove = settings["null_move"]
+        self.lmr = settings["lmr"]
+        self.quiescence = settings["quiescence"]
+        self.lazyEval = settings["lazy_eval"]
+
+        self.stop = stop # threading.Event, set to abandon the search
+        self.onIteration = onIteration # called as each iteration completes, see iterative_deepening
+        self.nodes = 0
+        self.rootPly = 0 # length of the board's history where the search starts
+        self.startTime = time.monotonic()
+        self.budgeted = False # budgets only apply once there is a move to fall back on
+
+    def elapsed(self):
+        return time.monotonic() - self.startTime
+
+    def check(self):
+        """
+        Called at every node. Raises SearchStopped when the search must end.
+        """
+        self.nodes += 1
+
+        if self.stop is not None and self.stop.is_set():
+            raise SearchStopped()
+
+        if self.budgeted:
+            if self.maxNodes and self.nodes > self.maxNodes:
+                raise BudgetExceeded()
+            if self.maxTime and self.elapsed() > self.maxTime:
+                raise BudgetExceeded()
+
+def get_level(level):
+    """
+    Returns the given level if it exists, else the default one.
+    """
+    return level if level in LEVELS else DEFAULT_LEVEL
+
+def get_move(board, isBlack=True, stop=None, level=DEFAULT_LEVEL, onIteration=None):
     """
     Returns a move for the bot (black) to make.
 
     Returns:
         A tuple of the form (start_pos, end_pos)
     """
+    move, pv = get_move_with_pv(board, isBlack, stop, level, onIteration)
+    return move
+
+def get_move_with_pv(board, isBlack=True, stop=None, level=DEFAULT_LEVEL, onIteration=None):
+    """
+    Returns a move for the bot (black) to make, and the principal variation
+    (the line of best play the search expects, starting with that move).
+    level is one of LEVELS, and bounds how much work the search may do.
+    The search raises SearchStopped if stop (a threading.Event) gets set.
+    onIteration is passed to the Search, see iterative_deepening.
+
+    Returns:
+        (move, pv) where move is a tuple of the form (start_pos, end_pos)
+    """
+    colour = "B" if isBlack else "W"
+
+    # Endings in the tablebases need no search
+    probed = tablebase.probe(board, colour) if TABLEBASES else None
+    if probed:
+        move, value = probed
+        print(f"Tablebase hit: playing move {move}, value {value}")
+        return move, [move]
 
-    # Check if in transposition table
+    search = Search(level, stop, onIteration)
+
+    # Check if in transposition table, searched at least as deep as this level would
     transposition = engine_utils.in_transposition_table(board)
-    if transposition:
+    if transposition and transposition[1]["depth"] >= search.maxDepth:
         score, metadata = transposition
         move = metadata["best_move"]
         depth = metadata["depth"]
+        pv = metadata.get("pv", [move])
         print(f"Transposition table hit at depth {depth}")
     else:
-        # Get the best move
-        score, move = minimax(board, MAX_DEPTH, -999999, 999999, isBlack)
+        # Get the best move. The search makes and takes back moves on the
+        # board it is given, so it gets its own copy
+        score, pv, depth = iterative_deepening(copy.deepcopy(board), colour, search)
+        move = pv[0] if pv else SENTINEL_VALUE
 
         if move == SENTINEL_VALUE:
             # No moves available
@@ -30,102 +184,304 @@ def get_move(board, isBlack=True):
             print(f"Score: {score}")
             print(f"Game over: {board.game_over}")
             print(f"[!] DEBUG: Playing random move [!]")
-            moves = engine_utils.get_all_moves(board, "B" if isBlack else "W")
+            moves = engine_utils.get_all_moves(board, colour)
             
             try:
                 move = random.choice(list(moves.values()))[0]
                 print(f"Randomly moving piece to {move}")
             except AttributeError:
                 # Randomly move the king
-                king = board.get_king("B" if isBlack else "W")
+                king = board.get_king(colour)
                 move = (king.pos, random.choice(board.get_legal_moves(king.pos)))
                 print(f"Randomly moving king to {move}")
+            pv = [move]
 
         # Add to transposition table
-        engine_utils.add_transposition(board, score, move, MAX_DEPTH)
+        engine_utils.add_transposition(board, score, move, depth, pv)
 
     print(f"Playing move {move} with score {score}")
 
     # Return the move in format (start_pos, end_pos)
-    return move
+    return move, pv
+
+
+def iterative_deepening(board, colour, search):
+    """
+    Searches to depth 1, 2, ... search.maxDepth, each iteration starting from
+    the previous principal variation, and inside an aspiration window around
+    the previous score. When the score falls outside the window, the search
+    is repeated with a wider one.
+    If the search runs out of budget, the last complete iteration is used.
+    After each complete iteration, search.onIteration (if set) is called
+    with (depth, score, pv, nodes, elapsed seconds).
+
+    Returns:
+        (score, pv, depth), score from the point of view of colour
+    """
+    score = 0
+    pv = []
+    completedDepth = 0
+    search.rootPly = len(board.history)
+
+    for depth in range(1, search.maxDepth + 1):
+        if depth == 1 or not search.aspiration:
+            window = INFINITY
+            alpha, beta = -INFINITY, INFINITY
+        else:
+            window = ASPIRATION_WINDOW
+            alpha, beta = score - window, score + window
+
+        try:
+            while True:
+                linePv = []
+                value = pvs(board, depth, alpha, beta, colour, search, linePv, pv)
+
+                if value <= alpha and alpha > -INFINITY:
+                    # Fail low, widen downwards
+                    window *= 2
+                    alpha = max(score - window, -INFINITY)
+                elif value >= beta and beta < INFINITY:
+                    # Fail high, widen upwards
+                    window *= 2
+                    beta = min(score + window, INFINITY)
+                else:
+                    break
+        except BudgetExceeded:
+            print(f"Out of budget at depth {depth} ({search.nodes} nodes, {search.elapsed():.2f}s)")
+            break
+
+        score = value
+        pv = linePv
+        completedDepth = depth
+        search.budgeted = True
+        print(f"Depth {depth}: score {score}, nodes {search.nodes}, pv {format_pv(pv)}")
+        if search.onIteration:
+            search.onIteration(depth, score, pv, search.nodes, search.elapsed())
+
+    return score, pv, completedDepth
+
+
+def evaluate(board, colour, alpha, beta, search):
+    """
+    Evaluates a leaf from the point of view of colour. With lazy_eval, the
+    expensive part of the evaluation is skipped when the cheap part is far
+    outside the window (alpha, beta), see engine_utils.evaluate_board_lazy.
+    """
+    # The evaluation is positive when white is winning
+    if not search.lazyEval:
+        score = engine_utils.evaluate_board_cached(board, colour)
+        return score if colour == "W" else -score
+
+    if colour == "W":
+        return engine_utils.evaluate_board_lazy(board, colour, alpha, beta)
+    return -engine_utils.evaluate_board_lazy(board, colour, -beta, -alpha)
 
 
-def minimax(board, depth, alpha, beta, maximizingPlayer):
+def pvs(board, depth, alpha, beta, colour, search, pv=None, pvHint=None, allowNull=True):
     """
-    Minimax algorithm with alpha-beta pruning.
+    Principal variation search (negamax with alpha-beta pruning).
+    The first move is searched with the full window, the rest with a null
+    window which only proves they are no better. A move which does turn out
+    better is searched again with the full window.
+
+    Scores are from the point of view of colour (the side to move).
+    search is the Search this node belongs to.
+    If pv is given, it is filled with the best line found from this position.
+    pvHint is a line to search first, usually the previous iteration's pv.
+    allowNull is False right after a null move, so two are never played in a row.
     """
-    toPlay = "B" if maximizingPlayer else "W"
+    # A position repeated since the search started (or earlier in the
+    # game) can be repeated again, so it is a draw
+    if len(board.history) > search.rootPly and board.repetitions():
+        return DRAW_SCORE
+
+    if depth == 0 and search.quiescence and not board.game_over:
+        return quiesce(board, alpha, beta, colour, search)
+
+    search.check()
 
     if depth == 0 or board.game_over:
-        # negative score means black (us) is winning
-        return -engine_utils.evaluate_board(board, toPlay), None
+        return evaluate(board, colour, alpha, beta, search)
 
-    if maximizingPlayer:
-        # We want to maximize the score
-        bestValue = -999999
+    opponent = "W" if colour == "B" else "B"
 
-        # Get all possible moves
-        pieces, moves = engine_utils.get_all_moves(board, "B")
+    # Only worth the check detection when a pruning could apply
+    inCheck = False
+    if ((search.nullMove and depth >= NULL_MOVE_MIN_DEPTH)
+            or (search.lmr and depth >= LMR_MIN_DEPTH)):
+        inCheck = board.is_in_check(colour)
 
-        bestMove = None
+    # Null-move pruning, only in null window (non-PV) nodes.
+    # Not when in check (passing would lose the king), nor with only pawns
+    # left, where having to move can be the only thing that loses (zugzwang)
+    if (search.nullMove and allowNull and beta - alpha == 1
+            and depth >= NULL_MOVE_MIN_DEPTH and not inCheck
+            and has_non_pawn_material(board, colour)):
+        board.make_null_move()
+        try:
+            value = -pvs(board, depth - 1 - NULL_MOVE_REDUCTION, -beta, -beta + 1,
+                         opponent, search, None, None, allowNull=False)
+        finally:
+            board.unmake_null_move()
+        if value >= beta:
+            return value
 
-        for piece, piece_moves in moves.items():
-            # For each move, find the best score
-            for move in piece_moves:
-                # Copy the board
-                newBoard = copy.deepcopy(board)
+    # Moves are generated lazily, best candidates first
+    hintMove = pvHint[0] if pvHint else None
+    bestValue = None
 
-                # Make the move
-                newBoard.move_piece(piece.pos, move)
+    for i, move in enumerate(engine_utils.generate_moves(board, colour, hintMove)):
+        isCapture = board.get_piece(move[1]) is not None
 
-                # Get the score
-                value, _ = minimax(newBoard, depth - 1, alpha, beta, False)
+        # Make the move, and take it back whatever happens in the search
+        board.move_piece(move[0], move[1])
+        try:
+            childPv = []
+            if i == 0:
+                # Follow the hint down the first move, if it is the hinted one
+                childHint = pvHint[1:] if hintMove and same_move(move, hintMove) else None
+                value = -pvs(board, depth - 1, -beta, -alpha, opponent, search, childPv, childHint)
+            else:
+                # Late quiet moves are unlikely to be best, search them shallower first
+                reduction = 0
+                if (search.lmr and depth >= LMR_MIN_DEPTH and i >= LMR_MIN_MOVES
+                        and not inCheck and not isCapture):
+                    reduction = LMR_REDUCTION
 
-                # Update the best score
-                if value > bestValue:
-                    bestValue = value
-                    bestMove = (piece.pos, move)
+                value = -pvs(board, depth - 1 - reduction, -alpha - 1, -alpha, opponent, search, childPv)
 
-                # Update alpha
-                alpha = max(alpha, bestValue)
+                if reduction and value > alpha:
+                    # Not so bad after all, verify at full depth
+                    childPv = []
+                    value = -pvs(board, depth - 1, -alpha - 1, -alpha, opponent, search, childPv)
 
-                # Prune
-                if beta <= alpha:
-                    break
+                if alpha < value < beta:
+                    # Better than the first move after all, get its exact score
+                    childPv = []
+                    value = -pvs(board, depth - 1, -beta, -alpha, opponent, search, childPv)
+        finally:
+            board.unmake_move()
 
-        return bestValue, bestMove
-    
-    else:
-        # We want to minimize the score
-        bestValue = 999999
+        if bestValue is None or value > bestValue:
+            bestValue = value
 
-        # Get all possible moves
-        pieces, moves = engine_utils.get_all_moves(board, "W")
+        if value > alpha:
+            alpha = value
+            if pv is not None:
+                pv[:] = [move] + childPv
 
-        bestMove = None
+        # Prune
+        if alpha >= beta:
+            break
 
-        for piece, piece_moves in moves.items():
-            # For each move, find the best score
-            for move in piece_moves:
-                # Copy the board
-                newBoard = copy.deepcopy(board)
+    if bestValue is None:
+        # No moves available
+        return evaluate(board, colour, alpha, beta, search)
 
-                # Make the move
-                newBoard.move_piece(piece.pos, move)
+    return bestValue
 
-                # Get the score
-                value, _ = minimax(newBoard, depth - 1, alpha, beta, True)
 
-                # Update the best score
-                if value < bestValue:
-                    bestValue = value
-                    bestMove = (piece.pos, move)
+def quiesce(board, alpha, beta, colour, search, depth=0):
+    """
+    Quiescence search: searches only captures (those not losing material by
+    static exchange evaluation), so positions are only evaluated once quiet.
+    The side to move may always stand pat on the evaluation rather than capture.
 
-                # Update beta
-                beta = min(beta, bestValue)
+    Scores are from the point of view of colour (the side to move).
+    """
+    search.check()
 
-                # Prune
-                if beta <= alpha:
-                    break
+    standPat = evaluate(board, colour, alpha, beta, search)
+    # Nothing more to resolve once a king has been taken
+    if board.game_over or depth >= QUIESCENCE_MAX_DEPTH or not board.get_king(colour):
+        return standPat
+
+    if standPat >= beta:
+        return standPat
+    alpha = max(alpha, standPat)
+
+    opponent = "W" if colour == "B" else "B"
+    bestValue = standPat
+    for move in engine_utils.generate_moves(board, colour, capturesOnly=True):
+        board.move_piece(move[0], move[1])
+        try:
+            value = -quiesce(board, -beta, -alpha, opponent, search, depth + 1)
+        finally:
+            board.unmake_move()
+        bestValue = max(bestValue, value)
+
+        if value > alpha:
+            alpha = value
+        if alpha >= beta:
+            break
+
+    return bestValue
+
+
+def has_non_pawn_material(board, colour):
+    """
+    Returns True if the given colour has any piece besides pawns and the king.
+    """
+    pieces = board.get_white_pieces() if colour == "W" else board.get_black_pieces()
+    for piece in pieces:
+        if not isinstance(piece, (chess_pieces.Pawn, chess_pieces.King)):
+            return True
+
+    return False
+
+
+def same_move(a, b):
+    """Moves may hold tuples or lists (e.g. after a JSON round-trip)."""
+    return list(a[0]) == list(b[0]) and list(a[1]) == list(b[1])
+
+
+def format_pv(pv):
+    return " ".join(chess.move_to_string(move) for move in pv)
+
+
+class Ponderer:
+    """
+    Searches the position the bot expects after the opponent's reply,
+    on the opponent's time, in a background thread.
+    The result also warms the transposition table.
+    """
+    def __init__(self, board, expectedMove, isBlack=True, level=DEFAULT_LEVEL, slots=None):
+        # Semaphore acquired for this ponder by the caller, released when the search ends
+        self.slots = slots
+
+        # Position after the expected reply
+        self.board = copy.deepcopy(board)
+        self.board.move_piece(expectedMove[0], expectedMove[1])
+        self.key = self.board.pos_key()
+        self.isBlack = isBlack
+        self.level = level
+
+        self.stop = threading.Event()
+        self.result = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.result = get_move_with_pv(self.board, self.isBlack, self.stop, self.level)
+        except SearchStopped:
+            pass
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    def get(self, board):
+        """
+        Returns (move, pv) for the given position if it is the one being pondered
+        (a ponder hit), waiting for the search to finish if needed.
+        Otherwise stops pondering and returns None.
+        """
+        if board.pos_key() != self.key:
+            self.cancel()
+            return None
+
+        self.thread.join()
+        return self.result
 
-        return bestValue, bestMove
\ No newline at end of file
+    def cancel(self):
+        self.stop.set()
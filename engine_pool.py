@@ -0,0 +1,424 @@
+"""
+Engine processes (uci.py) for the server, so a runaway search or a
+memory blow-up costs one process rather than every session.
+
+The pool keeps warm processes (their transposition tables persist across
+games), hands one to each search, and replaces a process after a number
+of searches, once it uses too much memory, or when it dies or overruns
+its search. Positions are sent as the game's moves from the starting
+position, so the engine sees repetitions as the server's board does.
+
+    pool = EnginePool(4)
+    move, pv, nodes = pool.search(["i9i7", "h2h4"], level="normal")
+"""
+import copy
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import engine
+import metrics
+from chess.chess import move_to_string, string_to_move
+
+UCI_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uci.py")
+
+# Seconds a search may take beyond its level's time budget before its
+# process is killed, and the limit for levels without a time budget
+SEARCH_GRACE = 10
+SEARCH_TIMEOUT = 300
+
+# Seconds to wait for a process to start up (imports, tablebases)
+START_TIMEOUT = 30
+
+# Served at /metrics, see metrics.py
+RECYCLED = metrics.REGISTRY.counter(
+    "superchess_engine_processes_recycled_total", "Engine processes replaced, by why",
+    labels=("reason",))
+PREEMPTED = metrics.REGISTRY.counter(
+    "superchess_engine_ponders_preempted_total", "Ponders stopped to free their process for a search")
+
+class EngineError(Exception):
+    """Raised when an engine process dies or doesn't answer in time."""
+    pass
+
+class EngineProcess:
+    """
+    One uci.py process. Lines it writes are read on a thread into a
+    queue, so waiting for them can time out.
+    """
+    def __init__(self, command=None):
+        self.process = subprocess.Popen(
+            command or [sys.executable, UCI_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+        )
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+        self.searches = 0
+
+        try:
+            self.send("uci")
+            self.wait_for("uciok", START_TIMEOUT)
+        except EngineError:
+            self.process.kill()
+            raise
+
+    def read(self):
+        for line in self.process.stdout:
+            self.lines.put(line.strip())
+        # None marks the end of the output, the process has exited
+        self.lines.put(None)
+
+    def send(self, line):
+        try:
+            self.process.stdin.write(line + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            raise EngineError(f"Engine process {self.process.pid} has exited")
+
+    def read_line(self, timeout):
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            raise EngineError(f"Engine process {self.process.pid} didn't answer in {timeout}s")
+        if line is None:
+            raise EngineError(f"Engine process {self.process.pid} has exited")
+
+        return line
+
+    def wait_for(self, prefix, timeout):
+        """Returns the next line starting with prefix, skipping the others."""
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self.read_line(max(deadline - time.monotonic(), 0))
+            if line.split()[:1] == [prefix]:
+                return line
+
+    def go(self, moves, level):
+        """
+        Starts a search of the position after moves (strings, from the
+        starting position) at the given level.
+        """
+        self.send("position startpos" + (" moves " + " ".join(moves) if moves else ""))
+        self.send(f"go level {level}")
+        self.searches += 1
+
+    def result(self, timeout):
+        """
+        Waits up to timeout seconds in all for the search to finish.
+        Returns (move, pv, nodes), with nodes from the last complete iteration.
+        """
+        deadline = time.monotonic() + timeout
+        pv = []
+        nodes = 0
+        while True:
+            fields = self.read_line(max(deadline - time.monotonic(), 0)).split()
+            if fields[:1] == ["info"]:
+                if "nodes" in fields:
+                    nodes = int(fields[fields.index("nodes") + 1])
+                if "pv" in fields:
+                    pv = [string_to_move(move) for move in fields[fields.index("pv") + 1:]]
+            elif fields[:1] == ["bestmove"]:
+                if fields[1] == "0000":
+                    return None, [], nodes
+                move = string_to_move(fields[1])
+                # The engine may have played from its transposition table or the tablebases
+                if not pv or not engine.same_move(pv[0], move):
+                    pv = [move] + ([string_to_move(fields[3])] if len(fields) > 3 else [])
+                return move, pv, nodes
+
+    def stop(self):
+        self.send("stop")
+
+    def memory(self):
+        """Resident memory in bytes, None where it can't be read."""
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+
+        return None
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        """Asks the process to quit, killing it if it doesn't."""
+        try:
+            self.send("quit")
+            self.process.wait(timeout=1)
+        except (EngineError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+def search_timeout(level):
+    seconds = engine.LEVELS[engine.get_level(level)]["time"]
+    return seconds + SEARCH_GRACE if seconds else SEARCH_TIMEOUT
+
+
+class EnginePool:
+    """
+    Keeps size engine processes, each used for one search at a time.
+    A process is replaced after max_searches searches, or once its
+    memory goes over max_memory bytes (0 for no limit).
+    """
+    def __init__(self, size, max_searches=200, max_memory=1024 * 1024 * 1024, command=None):
+        self.size = size
+        self.max_searches = max_searches
+        self.max_memory = max_memory
+        self.command = command
+
+        self.idle = queue.LifoQueue()
+        self.closed = False
+        # Ponderers holding a process, which searches may take over
+        self.ponderers = set()
+        self.lock = threading.Lock()
+        for _ in range(size):
+            self.idle.put(EngineProcess(self.command))
+        print(f"[==] Started {size} engine processes")
+
+    def acquire(self, block=True, timeout=None):
+        """
+        Returns an idle process, waiting for one (up to timeout seconds)
+        if block is set. Returns None if all are busy.
+        """
+        try:
+            process = self.idle.get(block, timeout)
+        except queue.Empty:
+            return None
+
+        if process is None:
+            # A process that couldn't be started before, try again
+            try:
+                process = EngineProcess(self.command)
+            except (EngineError, OSError) as e:
+                self.idle.put(None)
+                raise EngineError(f"Couldn't start an engine process: {e}")
+
+        return process
+
+    def release(self, process, failed=False):
+        """
+        Returns a process to the pool, replacing it if it failed, died
+        or is due to be recycled.
+        """
+        reason = None
+        if failed or not process.alive():
+            reason = "failed"
+        elif process.searches >= self.max_searches:
+            reason = "searches"
+        elif self.max_memory:
+            memory = process.memory()
+            if memory is not None and memory > self.max_memory:
+                reason = "memory"
+
+        if reason is not None:
+            RECYCLED.inc(reason)
+            process.close()
+            if self.closed:
+                return
+            try:
+                process = EngineProcess(self.command)
+            except (EngineError, OSError) as e:
+                # Keep the place, acquire starts one when it's needed
+                print(f"[!!] Couldn't start an engine process: {e}")
+                process = None
+
+        if self.closed:
+            if process is not None:
+                process.close()
+        else:
+            self.idle.put(process)
+
+    def search(self, moves, level=engine.DEFAULT_LEVEL):
+        """
+        Searches the position after moves (strings, from the starting
+        position), retrying once on a fresh process if the first one fails.
+        Returns (move, pv, nodes).
+        """
+        for attempt in range(2):
+            process = self.acquire_for_search()
+            try:
+                process.go(moves, level)
+                result = process.result(search_timeout(level))
+            except EngineError as e:
+                print(f"[!!] {e}")
+                self.release(process, failed=True)
+                if attempt:
+                    raise
+                continue
+
+            self.release(process)
+            return result
+
+    def acquire_for_search(self):
+        """
+        Returns an idle process, or else takes one from a ponderer, since
+        searches come first. Waits only while every process is searching.
+        """
+        while True:
+            process = self.acquire(block=False) or self.preempt()
+            if process is not None:
+                return process
+            # Ponders may start meanwhile, look again every so often
+            process = self.acquire(timeout=1)
+            if process is not None:
+                return process
+
+    def preempt(self):
+        """
+        Stops a ponder and returns its process, None if nothing is pondering.
+        """
+        with self.lock:
+            ponderers = list(self.ponderers)
+        for ponderer in ponderers:
+            process = ponderer.take()
+            if process is not None:
+                PREEMPTED.inc()
+                return process
+
+        return None
+
+    def forget(self, ponderer):
+        with self.lock:
+            self.ponderers.discard(ponderer)
+
+    def ponder(self, board, moves, expectedMove, level=engine.DEFAULT_LEVEL):
+        """
+        Starts searching the position after moves and the expected reply
+        on an idle process. Returns a Ponderer, or None if every process is busy.
+        """
+        try:
+            process = self.acquire(block=False)
+        except EngineError:
+            return None
+        if process is None:
+            return None
+
+        try:
+            process.go(moves + [move_to_string(expectedMove)], level)
+        except EngineError:
+            self.release(process, failed=True)
+            return None
+
+        ponderer = Ponderer(self, process, board, expectedMove, level)
+        with self.lock:
+            self.ponderers.add(ponderer)
+
+        return ponderer
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                process = self.idle.get(block=False)
+            except queue.Empty:
+                return
+            if process is not None:
+                process.close()
+
+
+class Ponderer:
+    """
+    A search on an engine process of the position the bot expects after
+    the opponent's reply, with the same interface as engine.Ponderer.
+    The process goes back to the pool once the search is collected or
+    cancelled, or to a search that needs it first (see EnginePool.preempt).
+    """
+    def __init__(self, pool, process, board, expectedMove, level):
+        self.pool = pool
+        self.process = process
+        self.level = level
+        self.lock = threading.Lock()
+
+        # Key of the position after the expected reply
+        board = copy.deepcopy(board)
+        board.move_piece(expectedMove[0], expectedMove[1])
+        self.key = board.pos_key()
+
+    def release(self):
+        """
+        Returns the process, None if it was already handed on.
+        The pool no longer offers this ponderer's process to searches.
+        """
+        with self.lock:
+            process, self.process = self.process, None
+        self.pool.forget(self)
+
+        return process
+
+    def stop(self, process):
+        """
+        Stops the search on process and waits for its answer.
+        Returns False (the process is replaced) if it didn't answer.
+        """
+        try:
+            process.stop()
+            process.result(search_timeout(self.level))
+        except EngineError:
+            self.pool.release(process, failed=True)
+            return False
+
+        return True
+
+    def take(self):
+        """
+        Stops pondering and returns the process for another search,
+        None if it was already handed on.
+        """
+        process = self.release()
+        if process is None or not self.stop(process):
+            return None
+
+        return process
+
+    def get(self, board):
+        """
+        Returns (move, pv) for the given position if it is the one being pondered
+        (a ponder hit), waiting for the search to finish if needed.
+        Otherwise stops pondering and returns None. Also None if a search
+        took the process.
+        """
+        if board.pos_key() != self.key:
+            self.cancel()
+            return None
+
+        process = self.release()
+        if process is None:
+            return None
+
+        try:
+            move, pv, nodes = process.result(search_timeout(self.level))
+        except EngineError as e:
+            print(f"[!!] {e}")
+            self.pool.release(process, failed=True)
+            return None
+
+        self.pool.release(process)
+        return (move, pv) if move is not None else None
+
+    def cancel(self):
+        """
+        Stops the search. The process is handed back once it has answered,
+        on a thread, so cancelling never waits.
+        """
+        process = self.release()
+        if process is None:
+            return
+
+        def finish():
+            if self.stop(process):
+                self.pool.release(process)
+
+        threading.Thread(target=finish, daemon=True).start()
@@ -1,7 +1,42 @@
 import chess.pieces as chess_pieces
+from chess import chess
+import atexit
 import json
+import os
+import threading
+import time
+
+# Evaluations by Zobrist key (with the colour to play), in a fixed number
+# of slots: each key has one slot, and a new evaluation replaces whatever
+# was there. Slots hold (key, score)
+EVAL_CACHE_SIZE = 2 ** 16
+EVAL_CACHE = [None] * EVAL_CACHE_SIZE
+
+# evaluate_board_lazy skips the move generation tier of the evaluation when
+# the cheap tier is at least this far outside the window. Bigger than
+# nearly all the move terms add up to (not counting a king about to fall)
+LAZY_EVAL_MARGIN = 400
+
+# Pawn structure counts by the Zobrist key of the pawns alone, slotted the
+# same way. Pawns move rarely, so most positions find theirs here
+PAWN_TABLE_SIZE = 2 ** 14
+PAWN_TABLE = [None] * PAWN_TABLE_SIZE
+
+# Loaded from transposition_table.json on first use
+TRANSPOSITION_TABLE = None
+# The server searches from several threads (e.g. pondering)
+TRANSPOSITION_LOCK = threading.Lock()
+# The table is written out at most this often (in seconds) as it grows,
+# and at exit. None to never write it, where it is only a cache
+TRANSPOSITION_SAVE_INTERVAL = 30
+# Whether it has changed since it was last written, and when that was
+TRANSPOSITION_CHANGED = False
+TRANSPOSITION_SAVED_AT = 0.0
 
 VALUES = {
+    # Material, piece values are set on the pieces
+    "MATERIAL": 1,
+
     # Game state values
     "CHECK": 150,
     "STALEMATE": float("-inf"),
@@ -29,7 +64,7 @@ VALUES = {
     "PAWN_PASSED": 25,
 
     # Piece mobility
-    "MOBILITY": 1,
+    "MOBILITY": 2,
 
     # Piece development
     "PAWN_DEVELOPMENT": 5,
@@ -39,13 +74,50 @@ VALUES = {
     "QUEEN_DEVELOPMENT": 30,
     "WORMHOLE_DEVELOPMENT": 30,
 
-    # Other
-    "MOBILITY": 2,
-
     # King mobility
     "KING_MOBILITY": 10,
 }
 
+# Values that tune.py leaves alone: material sets the scale of the others,
+# and the infinite ones end the game
+FIXED_VALUES = ("MATERIAL", "STALEMATE", "KING_CAPTURE")
+
+# Tuned values written by tune.py, loaded over VALUES at startup
+WEIGHTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "weights.json")
+
+# Names of pieces in VALUES, by piece key
+PIECE_NAMES = {
+    "P": "PAWN",
+    "N": "KNIGHT",
+    "B": "BISHOP",
+    "R": "ROOK",
+    "Q": "QUEEN",
+    "W": "WORMHOLE",
+    "K": "KING",
+}
+
+def load_weights(path=WEIGHTS_FILE):
+    """
+    Loads tuned values over VALUES, if the weights file exists.
+    Returns the names of the values loaded.
+    """
+    try:
+        with open(path) as f:
+            weights = json.load(f)
+    except FileNotFoundError:
+        return []
+
+    loaded = []
+    for name, value in weights.items():
+        if name in VALUES and name not in FIXED_VALUES:
+            VALUES[name] = value
+            loaded.append(name)
+
+    print(f"[==] Loaded {len(loaded)} evaluation weights from {path}")
+    return loaded
+
+load_weights()
+
 def get_all_moves(board, colour):
     # Get all pieces
     pieces = board.get_white_pieces() if colour == "W" else board.get_black_pieces()
@@ -60,70 +132,148 @@ def get_all_moves(board, colour):
 
     return pieces, moves
 
-def get_capture_value(piece):
+def static_exchange_eval(board, move):
     """
-    Returns the value of capturing a piece.
+    Returns the material the side making move (start_pos, end_pos) can
+    expect to win on the destination square, in piece values, once every
+    capture and recapture there is played out. Each side recaptures with
+    its least valuable attacker, and may stop when that would lose.
+    Pieces behind ones that have captured join in (x-rays).
+    Quiet moves score 0, or less if the piece can be taken for free.
     """
-    if isinstance(piece, chess_pieces.Pawn):
-        return VALUES["PAWN_CAPTURE"]
-    elif isinstance(piece, chess_pieces.Knight):
-        return VALUES["KNIGHT_CAPTURE"]
-    elif isinstance(piece, chess_pieces.Bishop):
-        return VALUES["BISHOP_CAPTURE"]
-    elif isinstance(piece, chess_pieces.Rook):
-        return VALUES["ROOK_CAPTURE"]
-    elif isinstance(piece, chess_pieces.Queen):
-        return VALUES["QUEEN_CAPTURE"]
-    elif isinstance(piece, chess_pieces.Wormhole):
-        return VALUES["WORMHOLE_CAPTURE"]
-    elif isinstance(piece, chess_pieces.King):
-        return VALUES["KING_CAPTURE"]
-    else:
-        return 0
-
-def get_threaten_value(piece):
+    start, end = move
+    piece = board.get_piece(start)
+    target = board.get_piece(end)
+
+    if isinstance(target, chess_pieces.King):
+        # Taking the king ends the game
+        return target.value
+
+    # gains[i] is what the side making capture i has won, if the exchange stops there
+    gains = [target.value if target else 0]
+    onSquare = piece
+    removed = {tuple(start)}
+    colour = "W" if piece.colour == "B" else "B"
+
+    while True:
+        attackers = list(board.get_attackers(end, colour, removed))
+        if not attackers:
+            break
+
+        attacker = min(attackers, key=lambda p: p.value)
+        gains.append(onSquare.value - gains[-1])
+        if isinstance(onSquare, chess_pieces.King):
+            # Taking the king ends the game, nothing recaptures
+            break
+        onSquare = attacker
+        removed.add(tuple(attacker.pos))
+        colour = "W" if colour == "B" else "B"
+
+    # Work back from the end, each side only capturing if it pays
+    for i in range(len(gains) - 1, 0, -1):
+        gains[i - 1] = -max(-gains[i - 1], gains[i])
+
+    return gains[0]
+
+def generate_moves(board, colour, hintMove=None, capturesOnly=False):
     """
-    Returns the value of threatening a piece.
+    Yields every legal move for colour as (start_pos, end_pos), in stages,
+    each only generated once the previous one is used up:
+    1. The hint move (e.g. from the principal variation), if it is legal
+    2. Captures that don't lose material (by static exchange evaluation),
+       of the most valuable pieces by the least valuable ones first
+    3. Everything else, in generation order
+    4. Captures that lose material, least bad first
+    A search that cuts off on the hint move never generates the rest.
+    With capturesOnly, only the hint move and stage 2 are generated.
     """
-    if isinstance(piece, chess_pieces.Pawn):
-        return VALUES["PAWN_THREATEN"]
-    elif isinstance(piece, chess_pieces.Knight):
-        return VALUES["KNIGHT_THREATEN"]
-    elif isinstance(piece, chess_pieces.Bishop):
-        return VALUES["BISHOP_THREATEN"]
-    elif isinstance(piece, chess_pieces.Rook):
-        return VALUES["ROOK_THREATEN"]
-    elif isinstance(piece, chess_pieces.Queen):
-        return VALUES["QUEEN_THREATEN"]
-    elif isinstance(piece, chess_pieces.Wormhole):
-        return VALUES["WORMHOLE_THREATEN"]
-    else:
-        return 0
-
-def get_development_value(piece):
+    # Stage 1: hint move, checking just the one piece
+    if hintMove:
+        piece = board.get_piece(hintMove[0])
+        if piece and piece.colour == colour and list(hintMove[1]) in board.get_legal_moves(piece):
+            yield (piece.pos, list(hintMove[1]))
+        else:
+            hintMove = None
+
+    # Stage 2: captures. Quiet moves come out of the same generation,
+    # so they are kept aside for later
+    pieces = board.get_white_pieces() if colour == "W" else board.get_black_pieces()
+    captures = []
+    losingCaptures = []
+    quiets = []
+    for piece in pieces:
+        for move in board.get_legal_moves(piece):
+            if hintMove and list(piece.pos) == list(hintMove[0]) and move == list(hintMove[1]):
+                continue
+            captured = board.get_piece(move)
+            if not captured:
+                quiets.append((piece.pos, move))
+            elif captured.value >= piece.value:
+                # Can't lose material, whatever the recaptures
+                captures.append((captured.value * 10 - piece.value, (piece.pos, move)))
+            else:
+                exchange = static_exchange_eval(board, (piece.pos, move))
+                if exchange >= 0:
+                    captures.append((captured.value * 10 - piece.value, (piece.pos, move)))
+                else:
+                    losingCaptures.append((exchange, (piece.pos, move)))
+
+    # Stable, so equal captures keep their generation order
+    captures.sort(key=lambda x: x[0], reverse=True)
+    for score, move in captures:
+        yield move
+
+    if capturesOnly:
+        return
+
+    # Stage 3: quiet moves
+    yield from quiets
+
+    # Stage 4: captures that lose material
+    losingCaptures.sort(key=lambda x: x[0], reverse=True)
+    for score, move in losingCaptures:
+        yield move
+
+def get_static_features(board):
     """
-    Returns the value of developing a piece.
+    Counts the features that need no move generation: material, pawn
+    structure and development, white minus black (see get_features).
+    These are the cheap tier of the evaluation, see evaluate_board_lazy.
     """
-    if isinstance(piece, chess_pieces.Pawn):
-        return VALUES["PAWN_DEVELOPMENT"]
-    elif isinstance(piece, chess_pieces.Knight):
-        return VALUES["KNIGHT_DEVELOPMENT"]
-    elif isinstance(piece, chess_pieces.Bishop):
-        return VALUES["BISHOP_DEVELOPMENT"]
-    elif isinstance(piece, chess_pieces.Rook):
-        return VALUES["ROOK_DEVELOPMENT"]
-    elif isinstance(piece, chess_pieces.Queen):
-        return VALUES["QUEEN_DEVELOPMENT"]
-    elif isinstance(piece, chess_pieces.Wormhole):
-        return VALUES["WORMHOLE_DEVELOPMENT"]
-    else:
-        return 0
+    features = dict.fromkeys(VALUES, 0)
 
-def evaluate_board(board, toPlay):
+    whitePieces = board.get_white_pieces()
+    blackPieces = board.get_black_pieces()
+
+    # Get total value of pieces
+    for piece in whitePieces:
+        features["MATERIAL"] += piece.value
+    for piece in blackPieces:
+        features["MATERIAL"] -= piece.value
+
+    # Pawn structure
+    for name, count in get_pawn_features(board).items():
+        features[name] += count
+
+    # Development
+    # Check which pieces are not in the starting position
+    for piece in whitePieces:
+        name = PIECE_NAMES[piece.key] + "_DEVELOPMENT"
+        if piece.pos != piece.starting_pos and name in features:
+            features[name] += 1
+    for piece in blackPieces:
+        name = PIECE_NAMES[piece.key] + "_DEVELOPMENT"
+        if piece.pos != piece.starting_pos and name in features:
+            features[name] -= 1
+
+    return features
+
+def get_features(board, toPlay, features=None, sides=None):
     """
-    Determines a score for the current board state.
-    Positive score is good for white, negative score is good for black.
-    Score is determined by a number of factors:
+    Counts what the evaluation scores in the current board state, for
+    white minus black, keyed by the name of the value each is weighted by.
+    The score is the sum of count * VALUES[name] (see evaluate_board).
+    Features are:
     1. Total value of pieces
     2. Threatened pieces
     3. Check / stalemate
@@ -131,164 +281,133 @@ def evaluate_board(board, toPlay):
     5. Pawn structure
     6. Development
     7. Potential captures
-    8. King safety
+    8. King mobility
+    1, 5 and 6 come from get_static_features, or features if those are
+    already counted (it is added to).
+    Counts for one side cancel out against the other's, so if sides is
+    given it is filled with each colour's own, by colour:
+    {"W": {"moves": ..., "captures": ..., "in_check": ...}, "B": ...}
+    The kings must both be on the board.
     """
-    score = 0
-
-    # Get all pieces
-    whitePieces = board.get_white_pieces()
-    blackPieces = board.get_black_pieces()
+    if features is None:
+        features = get_static_features(board)
 
     # Get all moves
     whitePieces, whiteMoves = get_all_moves(board, "W")
     blackPieces, blackMoves = get_all_moves(board, "B")
 
-    # Get all threatened pieces
-    whiteThreatenedPieces = board.get_threatened_pieces("W")
-    blackThreatenedPieces = board.get_threatened_pieces("B")
+    # Get all threatened pieces, from the moves above rather than
+    # generating them again (see ChessBoard.get_threatened_pieces)
+    whiteThreatenedPieces = [
+        board.get_piece(move)
+        for moves in whiteMoves.values() for move in moves
+        if board.get_piece(move)
+    ]
+    blackThreatenedPieces = [
+        board.get_piece(move)
+        for moves in blackMoves.values() for move in moves
+        if board.get_piece(move)
+    ]
 
-    # Get all pawns
-    whitePawns = board.get_pawns("W")
-    blackPawns = board.get_pawns("B")
+    kingW = board.get_king("W")
+    kingB = board.get_king("B")
+
+    if sides is not None:
+        sides["W"] = {
+            "moves": sum(len(moves) for moves in whiteMoves.values()),
+            "captures": len(whiteThreatenedPieces),
+            "in_check": kingW in blackThreatenedPieces,
+        }
+        sides["B"] = {
+            "moves": sum(len(moves) for moves in blackMoves.values()),
+            "captures": len(blackThreatenedPieces),
+            "in_check": kingB in whiteThreatenedPieces,
+        }
 
     # Is in check?
-    if board.is_in_check("W"):
-        # DEBUG: print(f"[+{VALUES['CHECK']}] White is in check")
-        score += VALUES["CHECK"]
-    elif board.is_in_check("B"):
-        # DEBUG: print(f"[-{VALUES['CHECK']}] Black is in check")
-        score -= VALUES["CHECK"]
+    if kingW in blackThreatenedPieces:
+        features["CHECK"] += 1
+    elif kingB in whiteThreatenedPieces:
+        features["CHECK"] -= 1
 
     # Is in stalemate?
-    if board.is_stalemate("W"):
-        # DEBUG: print(f"[+{VALUES['STALEMATE']}] White is in stalemate")
-        score += VALUES["STALEMATE"]
-    elif board.is_stalemate("B"):
-        # DEBUG: print(f"[-{VALUES['STALEMATE']}] Black is in stalemate")
-        score -= VALUES["STALEMATE"]
-
-    # Get total value of pieces
-    for piece in whitePieces:
-        # DEBUG: print(f"[+{piece.value}] {piece} is on the board")
-        score += piece.value
-    for piece in blackPieces:
-        # DEBUG: print(f"[-{piece.value}] {piece} is on the board")
-        score -= piece.value
+    if not whiteMoves:
+        features["STALEMATE"] += 1
+    elif not blackMoves:
+        features["STALEMATE"] -= 1
 
-    # Get total value of threatened pieces
+    # Threatened pieces can be captured by the side to play
     for piece in whiteThreatenedPieces:
-        if toPlay == "W":
-            # DEBUG: print(f"[+{get_threaten_value(piece)}] {piece} is threatened with capture")
-            score += get_capture_value(piece)
-        else:
-            # DEBUG: print(f"[+{get_capture_value(piece)}] {piece} is threatened")
-            score += get_threaten_value(piece)
+        kind = "_CAPTURE" if toPlay == "W" else "_THREATEN"
+        name = PIECE_NAMES[piece.key] + kind
+        if name in features:
+            features[name] += 1
     for piece in blackThreatenedPieces:
-        if toPlay == "B":
-            # DEBUG: print(f"[-{get_threaten_value(piece)}] {piece} is threatened with capture")
-            score -= get_capture_value(piece)
-        else:
-            # DEBUG: print(f"[-{get_capture_value(piece)}] {piece} is threatened")
-            score -= get_threaten_value(piece)
-
+        kind = "_CAPTURE" if toPlay == "B" else "_THREATEN"
+        name = PIECE_NAMES[piece.key] + kind
+        if name in features:
+            features[name] -= 1
 
-    # Get total value of moves
+    # Get total number of moves
     for piece in whiteMoves:
-        # DEBUG: print(f"[+{len(whiteMoves[piece]) * VALUES['MOBILITY']}] {piece} has {len(whiteMoves[piece])} moves")
-        score += len(whiteMoves[piece]) * VALUES["MOBILITY"]
+        features["MOBILITY"] += len(whiteMoves[piece])
     for piece in blackMoves:
-        # DEBUG: print(f"[-{len(blackMoves[piece]) * VALUES['MOBILITY']}] {piece} has {len(blackMoves[piece])} moves")
-        score -= len(blackMoves[piece]) * VALUES["MOBILITY"]
-    
+        features["MOBILITY"] -= len(blackMoves[piece])
 
-    # For each pawn, check if it is isolated, doubled, backward, or passed
-    for piece in whitePieces:
-        if isinstance(piece, chess_pieces.Pawn):
-            # Isolated
-            if not board.is_pawn_isolated(piece, whitePawns):
-                # DEBUG: print(f"[+{VALUES['PAWN_ISOLATED']}] {piece} is isolated")
-                score += VALUES["PAWN_ISOLATED"]
-
-            # Doubled
-            if board.is_pawn_doubled(piece, whitePawns):
-                # DEBUG: print(f"[+{VALUES['PAWN_DOUBLED']}] {piece} is doubled")
-                score += VALUES["PAWN_DOUBLED"]
-
-            # Passed
-            if board.is_pawn_passed(piece, whitePawns, blackPawns):
-                # DEBUG: print(f"[+{VALUES['PAWN_PASSED']}] {piece} is passed")
-                score += VALUES["PAWN_PASSED"]
+    # King mobility
+    # Get all moves for the king to squares the opponent doesn't attack
+    kingMovesW = [move for move in whiteMoves.get(kingW, []) if not board.is_square_attacked(move, "B")]
+    kingMovesB = [move for move in blackMoves.get(kingB, []) if not board.is_square_attacked(move, "W")]
+    features["KING_MOBILITY"] += len(kingMovesW) - len(kingMovesB)
 
-    for piece in blackPieces:
-        if isinstance(piece, chess_pieces.Pawn):
-            # Isolated
-            if not board.is_pawn_isolated(piece, blackPawns):
-                # DEBUG: print(f"[-{VALUES['PAWN_ISOLATED']}] {piece} is isolated")
-                score -= VALUES["PAWN_ISOLATED"]
-
-            # Doubled
-            if board.is_pawn_doubled(piece, blackPawns):
-                # DEBUG: print(f"[-{VALUES['PAWN_DOUBLED']}] {piece} is doubled")
-                score -= VALUES["PAWN_DOUBLED"]
-
-            # Passed
-            if board.is_pawn_passed(piece, whitePawns, blackPawns):
-                # DEBUG: print(f"[-{VALUES['PAWN_PASSED']}] {piece} is passed")
-                score -= VALUES["PAWN_PASSED"]
+    return features
 
-    # Development
-    # Check which pieces are not in the starting position
-    for piece in whitePieces:
-        if piece.pos != piece.starting_pos:
-            value = get_development_value(piece)
-            # DEBUG: print(f"[+{value}] {piece} is developed")
-            score += value
-    
-    for piece in blackPieces:
-        if piece.pos != piece.starting_pos:
-            value = get_development_value(piece)
-            # DEBUG: print(f"[-{value}] {piece} is developed")
-            score -= value
-
-    # King safety
-    # Check the threats to the king
-    kingAttacksW = board.get_king_attacks("W")
-    kingAttacksB = board.get_king_attacks("B")
-
-    for piece in kingAttacksW:
-        # DEBUG: print(f"[+{get_threaten_value(piece) * 1.5}] {piece} threatens the king")
-        score += get_threaten_value(piece) * 1.5
-
-    for piece in kingAttacksB:
-        # DEBUG: print(f"[-{get_threaten_value(piece) * 1.5}] {piece} threatens the king")
-        score -= get_threaten_value(piece) * 1.5
-    
-    # King mobility
-    kingW = board.get_king("W")
-    kingB = board.get_king("B")
+def get_pawn_features(board):
+    """
+    Counts the pawn structure features (isolated, doubled and passed pawns),
+    white minus black. Only depends on where the pawns are, so the counts
+    are kept in PAWN_TABLE by the pawns' Zobrist key.
+    """
+    key = board.pawn_zobrist
+    index = key & (PAWN_TABLE_SIZE - 1)
+    entry = PAWN_TABLE[index]
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    whitePawns = board.get_pawns("W")
+    blackPawns = board.get_pawns("B")
+    features = {"PAWN_ISOLATED": 0, "PAWN_DOUBLED": 0, "PAWN_PASSED": 0}
 
-    if not kingW:
-        # Checkmate for black
-        score = -VALUES["KING_CAPTURE"]
-    elif not kingB:
-        # Checkmate for white
-        score = VALUES["KING_CAPTURE"]
-    else:
-        # Get all moves for the king that don't put it in check
-        kingMovesW = list(filter(
-            lambda x: board.is_pos_safe_for_king(x, "W"),
-            board.get_legal_moves(kingW)
-        ))
-
-        kingMovesB = list(filter(
-            lambda x: board.is_pos_safe_for_king(x, "B"),
-            board.get_legal_moves(kingB)
-        ))
-
-        # DEBUG: print(f"[+{len(kingMovesW) * VALUES['KING_MOBILITY']}] White king has {len(kingMovesW)} safe moves")
-        # DEBUG: print(f"[-{len(kingMovesB) * VALUES['KING_MOBILITY']}] Black king has {len(kingMovesB)} safe moves")
-        score += len(kingMovesW) * VALUES["KING_MOBILITY"]
-        score -= len(kingMovesB) * VALUES["KING_MOBILITY"]
+    # For each pawn, check if it is isolated, doubled, backward, or passed
+    for piece in whitePawns:
+        if not board.is_pawn_isolated(piece, whitePawns):
+            features["PAWN_ISOLATED"] += 1
+        if board.is_pawn_doubled(piece, whitePawns):
+            features["PAWN_DOUBLED"] += 1
+        if board.is_pawn_passed(piece, whitePawns, blackPawns):
+            features["PAWN_PASSED"] += 1
+
+    for piece in blackPawns:
+        if not board.is_pawn_isolated(piece, blackPawns):
+            features["PAWN_ISOLATED"] -= 1
+        if board.is_pawn_doubled(piece, blackPawns):
+            features["PAWN_DOUBLED"] -= 1
+        if board.is_pawn_passed(piece, whitePawns, blackPawns):
+            features["PAWN_PASSED"] -= 1
+
+    PAWN_TABLE[index] = (key, features)
+
+    return features
+
+def evaluate_features(features):
+    """
+    Scores features counted by get_features with the current VALUES.
+    """
+    score = 0
+    for name, count in features.items():
+        # Skip unused values, 0 * inf is not a number
+        if count:
+            score += count * VALUES[name]
 
     if score == float("inf"):
         return 9999999999
@@ -297,6 +416,70 @@ def evaluate_board(board, toPlay):
 
     return score
 
+def evaluate_board(board, toPlay):
+    """
+    Determines a score for the current board state.
+    Positive score is good for white, negative score is good for black.
+    See get_features for what is scored.
+    """
+    # A captured king ends the game
+    if not board.get_king("W"):
+        return -9999999999
+    elif not board.get_king("B"):
+        return 9999999999
+
+    return evaluate_features(get_features(board, toPlay))
+
+
+def eval_cache_key(board, toPlay):
+    return board.zobrist ^ (chess.ZOBRIST_BLACK if toPlay == "B" else 0)
+
+def evaluate_board_cached(board, toPlay):
+    """
+    evaluate_board, but positions evaluated recently are looked up in
+    EVAL_CACHE instead.
+    """
+    key = eval_cache_key(board, toPlay)
+    index = key & (EVAL_CACHE_SIZE - 1)
+    entry = EVAL_CACHE[index]
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    score = evaluate_board(board, toPlay)
+    # One assignment, so other threads never see half an entry
+    EVAL_CACHE[index] = (key, score)
+
+    return score
+
+def evaluate_board_lazy(board, toPlay, lower, upper):
+    """
+    evaluate_board_cached, in two tiers for a search with the window
+    (lower, upper) (for white, as the score is). The cheap tier counts the
+    static features (see get_static_features). If that lands more than
+    LAZY_EVAL_MARGIN outside the window, the move terms can't bring it
+    back, so it is returned as it is. Otherwise the move terms are added.
+    """
+    key = eval_cache_key(board, toPlay)
+    index = key & (EVAL_CACHE_SIZE - 1)
+    entry = EVAL_CACHE[index]
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    if not board.get_king("W") or not board.get_king("B"):
+        return evaluate_board(board, toPlay)
+
+    features = get_static_features(board)
+    score = evaluate_features(features)
+    if score + LAZY_EVAL_MARGIN <= lower or score - LAZY_EVAL_MARGIN >= upper:
+        # Unless the side to play can take the king, which outweighs everything
+        if not board.is_in_check("W" if toPlay == "B" else "B"):
+            return score
+
+    score = evaluate_features(get_features(board, toPlay, features))
+    EVAL_CACHE[index] = (key, score)
+
+    return score
+
 
 def in_transposition_table(board):
     """
@@ -317,35 +500,72 @@ def in_transposition_table(board):
 def get_transposition():
     """
     Get the transposition table.
+    It is read from disk once, then kept in memory.
     """
-    return json.load(
-        open("transposition_table.json", "r")
-    )
+    global TRANSPOSITION_TABLE
+
+    if TRANSPOSITION_TABLE is None:
+        try:
+            TRANSPOSITION_TABLE = json.load(
+                open("transposition_table.json", "r")
+            )
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Missing, or left unreadable by a crash mid-write before saves were atomic
+            TRANSPOSITION_TABLE = {}
+
+    return TRANSPOSITION_TABLE
 
 def save_transposition(t):
     """
     Save the transposition table.
+    Written to a temporary file first and moved into place, so other
+    processes sharing the working directory (server workers) never
+    read a half-written table.
     """
-    json.dump(
-        t,
-        open("transposition_table.json", "w"),
-        indent=4
-    )
+    path = "transposition_table.json"
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp, "w") as f:
+        json.dump(t, f, indent=4)
+    os.replace(temp, path)
 
-def add_transposition(board, score, bestMove, depth):
+def add_transposition(board, score, bestMove, depth, pv=None):
     """
     Add a new transposition to the transposition table.
+    The table is saved if it wasn't for TRANSPOSITION_SAVE_INTERVAL seconds.
     """
+    global TRANSPOSITION_CHANGED, TRANSPOSITION_SAVED_AT
+
     # filename: transposition_table.json
-    # format: {posKey: {"score": score, "metadata": {"best_move": bestMove, "depth": depth}}}
+    # format: {posKey: {"score": score, "metadata": {"best_move": bestMove, "depth": depth, "pv": pv}}}
     posKey = board.pos_key()
-    transposition = get_transposition()
-    transposition[posKey] = {
-        "score": score,
-        "metadata": {
-            "best_move": bestMove,
-            "depth": depth
+    with TRANSPOSITION_LOCK:
+        transposition = get_transposition()
+        transposition[posKey] = {
+            "score": score,
+            "metadata": {
+                "best_move": bestMove,
+                "depth": depth,
+                "pv": pv or [bestMove]
+            }
         }
-    }
-    
-    save_transposition(transposition)
\ No newline at end of file
+        TRANSPOSITION_CHANGED = True
+
+        if (TRANSPOSITION_SAVE_INTERVAL is not None
+                and time.monotonic() - TRANSPOSITION_SAVED_AT >= TRANSPOSITION_SAVE_INTERVAL):
+            save_transposition(transposition)
+            TRANSPOSITION_CHANGED = False
+            TRANSPOSITION_SAVED_AT = time.monotonic()
+
+def flush_transposition():
+    """
+    Save the transposition table if it changed since it was last saved.
+    """
+    global TRANSPOSITION_CHANGED, TRANSPOSITION_SAVED_AT
+
+    with TRANSPOSITION_LOCK:
+        if TRANSPOSITION_CHANGED and TRANSPOSITION_SAVE_INTERVAL is not None and TRANSPOSITION_TABLE is not None:
+            save_transposition(TRANSPOSITION_TABLE)
+            TRANSPOSITION_CHANGED = False
+            TRANSPOSITION_SAVED_AT = time.monotonic()
+
+atexit.register(flush_transposition)
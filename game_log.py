@@ -0,0 +1,155 @@
+"""
+Append-only log of finished games.
+
+Each game is one JSON line, in the same shape as match.py's records:
+    {"game": ..., "kind": "bot", "level": "normal", "result": "1-0",
+     "reason": "checkmate", "moves": ["i9i7", "h2h4", ...],
+     "started": ..., "ended": ...}
+
+Games are handed to a background thread and written in batches, so
+logging never waits on the disk. Every process writes its own files,
+starting a new one once the current one reaches a size limit, so
+workers never need to coordinate.
+"""
+import atexit
+import glob
+import json
+import os
+import queue
+import threading
+import time
+
+from chess.chess import ChessBoard, string_to_move
+
+class GameLog:
+    """
+    Writes game records to directory/games-<time>-<pid>-<part>.jsonl.
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, flush_interval=1.0, batch_size=100):
+        self.directory = directory
+        self.max_bytes = max_bytes # start a new file beyond this size
+        self.flush_interval = flush_interval # seconds a record may wait to be written
+        self.batch_size = batch_size # records written at once
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.file = None
+        self.part = 0 # files started by this process
+
+    def append(self, record):
+        """
+        Queues a game record to be written. Never blocks.
+        """
+        # Threads don't survive a fork, start one in each process that logs
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.queue = queue.Queue()
+            self.file = None
+            self.part = 0
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+        self.queue.put(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+
+            # Gather whatever else arrives before the batch is due
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if record is None:
+                    self.write(batch)
+                    return
+                batch.append(record)
+
+            self.write(batch)
+
+    def write(self, batch):
+        if self.file is None or self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+        self.file.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in batch))
+        self.file.flush()
+
+    def rotate(self):
+        """
+        Starts a new log file.
+        """
+        if self.file is not None:
+            self.file.close()
+
+        self.part += 1
+        name = f"games-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.part}.jsonl"
+        path = os.path.join(self.directory, name)
+        self.file = open(path, "a")
+        print(f"[==] Logging games to {path}")
+
+    def close(self):
+        """
+        Writes any queued records and stops the writer thread.
+        """
+        if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def log_files(path):
+    """
+    Returns the log files at path (a file, or a directory of logs), oldest first.
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.jsonl")), key=os.path.getmtime)
+
+    return [path]
+
+
+def read_games(paths):
+    """
+    Yields game records one at a time from the given files or directories,
+    without loading whole files. Also reads match.py --output files.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    for path in paths:
+        for filename in log_files(path):
+            with open(filename) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a log still being written
+                        continue
+
+
+def replay_game(record):
+    """
+    Replays a game record. Yields (ply, board, move) for every move, with the
+    board as it was before the move. The same board is updated in place.
+    """
+    board = ChessBoard()
+    moves = record.get("opening", []) + record["moves"]
+
+    for ply, string in enumerate(moves):
+        move = string_to_move(string)
+        yield ply, board, move
+        board.move_piece(move[0], move[1])
@@ -0,0 +1,319 @@
+"""
+Load test for server.py: many simulated players, each playing games over
+socket.io the way static/js/play.js does, to measure how many concurrent
+games a server sustains.
+
+    python loadtest.py --clients 200 --duration 60 --bot-share 0.5
+
+Without --url a server is started locally (in a temporary directory) for
+the run, with --server-args passed on to it. Every client connects over
+websockets, starts a game with request_board, and then for each of its
+moves asks for the legal moves of the piece it picked (get_legal_moves)
+and makes the move (move_piece), thinking for a while first. In bot games
+it asks for the bot's replies (bot_move); in local games it plays both
+sides. A finished game (or one reaching --max-plies) is followed by a new
+one until the time is up.
+
+Latency is the time from emitting an event to receiving its reply:
+    request_board -> board
+    get_legal_moves -> legal_moves
+    move_piece -> move_piece (the server echoing the move)
+    bot_move -> move_piece (the bot's move)
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import socketio
+
+# Seconds to wait for a reply before counting the event as timed out
+REPLY_TIMEOUT = 60
+
+EVENTS = ("request_board", "get_legal_moves", "move_piece", "bot_move")
+
+class Stats:
+    """
+    Latencies and failures of every client's events.
+    Clients run on their own threads, so updates take a lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {event: [] for event in EVENTS}
+        self.timeouts = {event: 0 for event in EVENTS}
+        self.games = 0
+        self.errors = 0
+
+    def record(self, event, seconds):
+        with self.lock:
+            self.latencies[event].append(seconds)
+
+    def timeout(self, event):
+        with self.lock:
+            self.timeouts[event] += 1
+
+    def game_finished(self):
+        with self.lock:
+            self.games += 1
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+
+def percentile(values, share):
+    """The value below which share (0-1) of the sorted values fall."""
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+class SimulatedClient:
+    """
+    One player: a socket.io connection playing games until the deadline.
+    Events are sent one at a time, each waiting for its reply.
+    """
+    def __init__(self, url, stats, options, seed):
+        self.url = url
+        self.stats = stats
+        self.options = options
+        self.random = random.Random(seed)
+
+        self.sio = socketio.Client(reconnection=False)
+        self.replies = {}
+        self.replied = threading.Event()
+        self.waitingFor = None
+        self.gameOver = False
+
+        for event in ("board", "legal_moves", "move_piece"):
+            self.sio.on(event, self.reply_handler(event))
+        self.sio.on("game_over", self.on_game_over)
+
+    def reply_handler(self, event):
+        def handler(data):
+            if event == self.waitingFor:
+                self.replies[event] = data
+                self.replied.set()
+        return handler
+
+    def on_game_over(self, data):
+        # Arrives just after the last move, wake a request for the bot's reply
+        self.gameOver = True
+        self.replied.set()
+
+    def request(self, event, data, replyEvent):
+        """
+        Emits an event and waits for its reply. Returns the reply's data,
+        or None if it timed out or the game ended first.
+        """
+        self.replied.clear()
+        if self.gameOver:
+            return None
+        self.waitingFor = replyEvent
+        start = time.perf_counter()
+        self.sio.emit(event, data)
+
+        if not self.replied.wait(REPLY_TIMEOUT) or replyEvent not in self.replies:
+            if not self.gameOver:
+                self.stats.timeout(event)
+            self.waitingFor = None
+            return None
+
+        self.stats.record(event, time.perf_counter() - start)
+        self.waitingFor = None
+        return self.replies.pop(replyEvent)
+
+    def think(self):
+        thinkTime = self.options["think"]
+        if thinkTime:
+            # Anywhere from no time to twice the average
+            time.sleep(self.random.uniform(0, 2 * thinkTime))
+
+    def play_game(self, deadline):
+        """
+        Plays one game from request_board to its end, --max-plies or the deadline.
+        """
+        ssid = uuid.uuid4().hex
+        kind = "bot" if self.random.random() < self.options["bot_share"] else "local"
+        self.gameOver = False
+
+        board = self.request("request_board", {"ssid": ssid, "kind": kind, "level": self.options["level"]}, "board")
+        if board is None:
+            return
+        seq, legal = board["seq"], board["legal"]
+
+        while not self.gameOver and seq < self.options["max_plies"] and time.monotonic() < deadline:
+            toPlay = "W" if seq % 2 == 0 else "B"
+            if kind == "bot" and toPlay == "B":
+                reply = self.request("bot_move", {"ssid": ssid, "level": self.options["level"]}, "move_piece")
+            else:
+                if not legal:
+                    # Nothing to move, the game is over
+                    break
+                self.think()
+
+                # Pick a piece like a click would, and one of its moves
+                square = self.random.choice(list(legal))
+                start = divmod(int(square), 16)
+                if self.request("get_legal_moves", {"ssid": ssid, "pos": list(start)}, "legal_moves") is None:
+                    break
+                end = divmod(self.random.choice(legal[square]), 16)
+                reply = self.request("move_piece", {"ssid": ssid, "from": list(start), "to": list(end)}, "move_piece")
+
+            if reply is None:
+                break
+            seq, legal = reply["seq"], reply["legal"]
+
+        if self.gameOver or seq >= self.options["max_plies"]:
+            self.stats.game_finished()
+
+    def run(self, deadline):
+        try:
+            self.sio.connect(self.url, transports=["websocket"])
+            while time.monotonic() < deadline:
+                self.play_game(deadline)
+        except Exception as e:
+            print(f"[!] Client failed: {e}")
+            self.stats.error()
+        finally:
+            self.sio.disconnect()
+
+
+def start_server(port, serverArgs):
+    """
+    Starts server.py on the given port in a temporary directory, so its
+    sessions and transposition table don't mix with anything else.
+    Returns the process once the port accepts connections.
+    """
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    process = subprocess.Popen(
+        [sys.executable, server, "--port", str(port), "--no-game-log"] + serverArgs,
+        cwd=tempfile.mkdtemp(prefix="superchess-loadtest-"),
+        stdout=subprocess.DEVNULL,
+    )
+
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError(f"Server didn't start listening on port {port}")
+
+
+def run_load(url, clients, duration, ramp, options, seed=0):
+    """
+    Runs the clients against the server at url for duration seconds,
+    starting them evenly over the first ramp seconds.
+    Returns (stats, elapsed seconds).
+    """
+    stats = Stats()
+    start = time.monotonic()
+    deadline = start + duration
+
+    threads = []
+    for i in range(clients):
+        client = SimulatedClient(url, stats, options, seed + i)
+        thread = threading.Thread(target=client.run, args=(deadline,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if ramp:
+            time.sleep(ramp / clients)
+
+    for thread in threads:
+        # Replies still outstanding at the deadline get a little longer
+        thread.join(max(deadline - time.monotonic(), 0) + REPLY_TIMEOUT)
+
+    return stats, time.monotonic() - start
+
+
+def summarise(stats, elapsed):
+    """
+    Returns throughput and latency percentiles (in milliseconds) per event.
+    """
+    report = {
+        "elapsed": elapsed,
+        "games": stats.games,
+        "errors": stats.errors,
+        "events": sum(len(latencies) for latencies in stats.latencies.values()),
+        "by_event": {},
+    }
+    report["events_per_sec"] = report["events"] / elapsed if elapsed else 0.0
+
+    for event in EVENTS:
+        latencies = sorted(stats.latencies[event])
+        report["by_event"][event] = {
+            "count": len(latencies),
+            "timeouts": stats.timeouts[event],
+            "per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p90_ms": percentile(latencies, 0.90) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        }
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the server with simulated players.")
+    parser.add_argument("--url", help="server to test, e.g. http://localhost:5000 (default: start one locally)")
+    parser.add_argument("--port", type=int, default=5200, help="port of the locally started server")
+    parser.add_argument("--server-args", default="", help="extra arguments for the locally started server.py")
+    parser.add_argument("--clients", type=int, default=100, help="simulated players")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run for")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which the clients connect")
+    parser.add_argument("--think", type=float, default=1.0, help="average seconds a player thinks before moving")
+    parser.add_argument("--bot-share", type=float, default=0.5, help="share of games played against the bot")
+    parser.add_argument("--level", default="casual", help="bot level")
+    parser.add_argument("--max-plies", type=int, default=60, help="start a new game after this many moves")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this file as JSON")
+    args = parser.parse_args()
+
+    options = {
+        "think": args.think,
+        "bot_share": args.bot_share,
+        "level": args.level,
+        "max_plies": args.max_plies,
+    }
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_server(args.port, args.server_args.split())
+        url = f"http://127.0.0.1:{args.port}"
+        print(f"[==] Started a server at {url}")
+
+    try:
+        print(f"[==] Running {args.clients} clients for {args.duration:.0f}s")
+        stats, elapsed = run_load(url, args.clients, args.duration, args.ramp, options, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = summarise(stats, elapsed)
+    print()
+    print(f"{report['games']} games, {report['events']} events in {report['elapsed']:.1f}s "
+          f"({report['events_per_sec']:.1f}/s), {report['errors']} clients failed")
+    print(f"{'event':>16} {'count':>7} {'per sec':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'timeouts':>8}")
+    for event, row in report["by_event"].items():
+        print(f"{event:>16} {row['count']:>7} {row['per_sec']:>8.1f} {row['p50_ms']:>8.1f} {row['p90_ms']:>8.1f} "
+              f"{row['p99_ms']:>8.1f} {row['max_ms']:>8.1f} {row['timeouts']:>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"[==] Wrote {args.output}")
@@ -0,0 +1,302 @@
+"""
+Headless engine matches, for checking that speed changes don't cost strength.
+
+Plays engine A against engine B (possibly the same build at another level,
+or an older build checked out elsewhere) over many games in parallel
+processes, and reports the Elo difference and moves per second.
+
+    python match.py --games 40 --processes 4 --level-a normal --b ../superchess-old
+"""
+import argparse
+import contextlib
+import importlib
+import inspect
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+from chess.chess import move_to_string
+
+# Modules that make up an engine build
+BUILD_MODULES = ("engine", "engine_utils", "tablebase", "chess")
+
+def load_build(path):
+    """
+    Imports engine.py from the given build directory, along with the chess
+    package and engine_utils it uses, without clashing with other builds
+    loaded in this process.
+
+    Returns:
+        (engine module, chess.chess module)
+    """
+    path = os.path.abspath(path)
+
+    def is_build_module(name):
+        return name.split(".")[0] in BUILD_MODULES
+
+    # Put aside whatever build is already imported
+    saved = {name: sys.modules.pop(name) for name in list(sys.modules) if is_build_module(name)}
+    before = set(sys.modules)
+    sys.path.insert(0, path)
+    try:
+        engine = importlib.import_module("engine")
+        chess = importlib.import_module("chess.chess")
+    finally:
+        sys.path.remove(path)
+        # Forget everything the build imported from its own directory.
+        # The modules keep references to each other, so they still work
+        for name in set(sys.modules) - before:
+            module_file = getattr(sys.modules[name], "__file__", None) or ""
+            if is_build_module(name) or module_file.startswith(path + os.sep):
+                del sys.modules[name]
+        sys.modules.update(saved)
+
+    return engine, chess
+
+
+class Player:
+    """
+    An engine build playing at a level, with its own copy of the board
+    (each build has its own piece classes).
+    """
+    def __init__(self, name, path, level):
+        self.name = name
+        self.engine, self.chess = load_build(path)
+        self.level = level
+        self.board = None
+
+        # Older builds have no levels
+        self.has_levels = "level" in inspect.signature(self.engine.get_move).parameters
+
+    def new_game(self):
+        self.board = self.chess.ChessBoard()
+        engine_utils = self.engine.engine_utils
+        if hasattr(engine_utils, "TRANSPOSITION_TABLE"):
+            # Don't carry knowledge over from the last game
+            engine_utils.TRANSPOSITION_TABLE = {}
+
+    def get_move(self, isBlack):
+        if self.has_levels:
+            return self.engine.get_move(self.board, isBlack, level=self.level)
+        return self.engine.get_move(self.board, isBlack)
+
+    def play(self, move):
+        self.board.move_piece(tuple(move[0]), tuple(move[1]))
+        self.board.update_game_state()
+
+
+# Set in every worker process by init_worker
+players = {}
+settings = {}
+
+def init_worker(a, b, options):
+    # Engines save their transposition table to the working directory,
+    # keep each process' table to itself
+    os.chdir(tempfile.mkdtemp(prefix="superchess-match-"))
+    # (older builds expect it to exist)
+    with open("transposition_table.json", "w") as f:
+        f.write("{}")
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        players["A"] = Player("A", *a)
+        players["B"] = Player("B", *b)
+    settings.update(options)
+
+
+def random_opening(board, plies, rng):
+    """
+    Plays random legal moves from the starting position.
+    Returns the moves played.
+    """
+    moves = []
+    colour = "W"
+    for _ in range(plies):
+        candidates = []
+        for piece in board.get_white_pieces() if colour == "W" else board.get_black_pieces():
+            for move in board.get_legal_moves(piece.pos):
+                candidates.append((tuple(piece.pos), tuple(move)))
+        if not candidates:
+            break
+
+        move = rng.choice(candidates)
+        board.move_piece(move[0], move[1])
+        moves.append(move)
+        colour = "B" if colour == "W" else "W"
+
+    return moves
+
+
+def play_game(index):
+    """
+    Plays one game. Even games have A as white, odd games B, and each pair
+    of games shares the same random opening.
+    """
+    white, black = (players["A"], players["B"]) if index % 2 == 0 else (players["B"], players["A"])
+    rng = random.Random(settings["seed"] + index // 2)
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        white.new_game()
+        black.new_game()
+        opening = random_opening(white.board, settings["random_plies"], rng)
+        for move in opening:
+            black.play(move)
+        white.board.update_game_state()
+
+        moves = []
+        times = []
+        isBlack = len(opening) % 2 == 1
+        toMove, waiting = (black, white) if isBlack else (white, black)
+        while not toMove.board.game_over and len(opening) + len(moves) < settings["max_plies"]:
+            start = time.perf_counter()
+            move = toMove.get_move(isBlack)
+            times.append(time.perf_counter() - start)
+
+            toMove.play(move)
+            waiting.play(move)
+            moves.append(move)
+
+            toMove, waiting = waiting, toMove
+            isBlack = not isBlack
+
+    board = white.board
+    if board.game_over and board.outcome["winner"] == "W":
+        result = "1-0"
+    elif board.game_over and board.outcome["winner"] == "B":
+        result = "0-1"
+    else:
+        result = "1/2-1/2"
+
+    return {
+        "game": index,
+        "white": white.name,
+        "black": black.name,
+        "result": result,
+        "reason": board.outcome["type"] if board.game_over else "move limit",
+        "opening": [move_to_string(move) for move in opening],
+        "moves": [move_to_string(move) for move in moves],
+        # Time taken by each move after the opening, in order
+        "times": times,
+    }
+
+
+def score_for(game, name):
+    """1 for a win, 0.5 for a draw, 0 for a loss."""
+    if game["result"] == "1/2-1/2":
+        return 0.5
+    winner = game["white"] if game["result"] == "1-0" else game["black"]
+    return 1.0 if winner == name else 0.0
+
+
+def elo_difference(score):
+    """Elo difference implied by an expected score."""
+    # A perfect (or nil) score has no finite Elo, clamp it
+    score = min(max(score, 0.001), 0.999)
+    return -400 * math.log10(1 / score - 1)
+
+
+def summarise(games):
+    """
+    Returns a report of A's results against B, with a 95% confidence
+    interval on the Elo difference, and each engine's speed.
+    """
+    n = len(games)
+    scores = [score_for(game, "A") for game in games]
+    wins = scores.count(1.0)
+    draws = scores.count(0.5)
+    losses = scores.count(0.0)
+
+    mean = sum(scores) / n
+    variance = sum((s - mean) ** 2 for s in scores) / n
+    margin = 1.96 * math.sqrt(variance / n)
+
+    speed = {}
+    for name in ("A", "B"):
+        moveTimes = []
+        for game in games:
+            # Moves after the opening alternate, starting with whoever's turn it was
+            firstMover = game["white"] if len(game["opening"]) % 2 == 0 else game["black"]
+            first = 0 if firstMover == name else 1
+            moveTimes.extend(game["times"][first::2])
+        speed[name] = {
+            "moves": len(moveTimes),
+            "moves_per_sec": len(moveTimes) / sum(moveTimes) if sum(moveTimes) else 0.0,
+            "max_move_time": max(moveTimes, default=0.0),
+        }
+
+    return {
+        "games": n,
+        "wins": wins,
+        "draws": draws,
+        "losses": losses,
+        "score": mean,
+        "elo": elo_difference(mean),
+        "elo_low": elo_difference(mean - margin),
+        "elo_high": elo_difference(mean + margin),
+        "speed": speed,
+    }
+
+
+def run_match(a, b, games, processes, options, output=None):
+    """
+    Plays the games across a pool of processes.
+    a and b are (path, level) pairs. Returns the game records.
+    """
+    import multiprocessing
+
+    records = []
+    with multiprocessing.Pool(processes, init_worker, (a, b, options)) as pool:
+        for record in pool.imap_unordered(play_game, range(games)):
+            records.append(record)
+            print(f"Game {record['game']}: {record['white']} vs {record['black']} "
+                  f"{record['result']} ({record['reason']}, {len(record['moves'])} moves)")
+            if output:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Play engine builds against each other.")
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument("--a", default=here, help="build directory of engine A (default: this one)")
+    parser.add_argument("--b", default=here, help="build directory of engine B (default: this one)")
+    parser.add_argument("--level-a", default="normal")
+    parser.add_argument("--level-b", default="normal")
+    parser.add_argument("--games", type=int, default=20)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--random-plies", type=int, default=4,
+                        help="random moves played before the engines take over")
+    parser.add_argument("--max-plies", type=int, default=300,
+                        help="games reaching this many moves are drawn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write every game to this file, one JSON record per line")
+    args = parser.parse_args()
+
+    options = {
+        "random_plies": args.random_plies,
+        "max_plies": args.max_plies,
+        "seed": args.seed,
+    }
+    output = open(args.output, "a") if args.output else None
+
+    records = run_match(
+        (args.a, args.level_a), (args.b, args.level_b),
+        args.games, args.processes, options, output
+    )
+    report = summarise(records)
+
+    print()
+    print(f"A ({args.a} {args.level_a}) vs B ({args.b} {args.level_b})")
+    print(f"+{report['wins']} ={report['draws']} -{report['losses']} "
+          f"score {report['score']:.3f} over {report['games']} games")
+    print(f"Elo difference: {report['elo']:+.1f} "
+          f"(95% {report['elo_low']:+.1f} to {report['elo_high']:+.1f})")
+    for name in ("A", "B"):
+        speed = report["speed"][name]
+        print(f"{name}: {speed['moves_per_sec']:.2f} moves/sec over {speed['moves']} moves, "
+              f"slowest {speed['max_move_time']:.2f}s")
@@ -0,0 +1,108 @@
+"""
+A local stand-in for the message queue (redis, rabbitmq...) that
+python-socketio uses to share emits between server processes.
+
+The broker runs in the master process and relays every line it
+receives to every connected worker. Each worker plugs into it
+through LocalQueueManager, so an emit made in one worker reaches
+clients connected to any other worker.
+
+Every connection starts with a line naming its role: LISTEN for
+connections that receive the relayed lines, PUBLISH for connections
+that send them. Lines are only relayed to listeners, as nothing reads
+from a publisher's connection.
+"""
+import json
+
+import eventlet
+from eventlet.green import socket
+from eventlet.semaphore import Semaphore
+import socketio
+
+LISTEN = b"listen\n"
+PUBLISH = b"publish\n"
+
+class LocalQueueBroker:
+    """
+    Relays newline delimited messages between all connected workers.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.listener = eventlet.listen(address)
+        # Connections receiving relayed lines
+        self.listeners = set()
+
+    def serve(self):
+        """
+        Accept workers forever, relaying their messages to every listener.
+        """
+        while True:
+            conn, _ = self.listener.accept()
+            eventlet.spawn(self.handle, conn)
+
+    def handle(self, conn):
+        reader = conn.makefile("rb")
+        try:
+            role = reader.readline()
+            if role == LISTEN:
+                self.listeners.add(conn)
+                # Nothing more is sent on it, wait for it to close
+                for _ in reader:
+                    pass
+            elif role == PUBLISH:
+                self.relay(reader)
+        finally:
+            self.listeners.discard(conn)
+            conn.close()
+
+    def relay(self, reader):
+        for line in reader:
+            for other in list(self.listeners):
+                try:
+                    other.sendall(line)
+                except OSError:
+                    self.listeners.discard(other)
+
+    def close(self):
+        self.listener.close()
+
+
+class LocalQueueManager(socketio.PubSubManager):
+    """
+    Client manager backed by a LocalQueueBroker.
+    Pass it to SocketIO as client_manager in every worker.
+    """
+    name = "localqueue"
+
+    def __init__(self, address, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = address
+        self.publisher = None
+        self.publish_lock = Semaphore()
+
+    def _connect(self, role):
+        conn = socket.create_connection(self.address)
+        conn.sendall(role)
+        return conn
+
+    def _publish(self, data):
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        with self.publish_lock:
+            try:
+                if self.publisher is None:
+                    self.publisher = self._connect(PUBLISH)
+                self.publisher.sendall(line)
+            except OSError:
+                # Broker went away, retry once on a fresh connection
+                self.publisher = self._connect(PUBLISH)
+                self.publisher.sendall(line)
+
+    def _listen(self):
+        while True:
+            try:
+                conn = self._connect(LISTEN)
+                for line in conn.makefile("rb"):
+                    yield json.loads(line)
+            except OSError:
+                self._get_logger().error("Cannot reach local queue broker, retrying")
+            eventlet.sleep(1)
@@ -0,0 +1,162 @@
+"""
+Counters, gauges and histograms for the server, served at /metrics in the
+Prometheus text format:
+
+    curl localhost:5000/metrics
+
+Recording takes no locks. Socket handlers run on eventlet green threads,
+which only switch at I/O, so their updates never interleave. Updates made
+from real threads could in theory lose an increment, which is fine for
+monitoring.
+
+Every process keeps its own metrics. With several workers (--workers),
+a scrape is answered by whichever worker accepts it, so each series
+carries the worker's pid.
+"""
+import bisect
+import functools
+import os
+import time
+
+# Histogram buckets: seconds for latencies, and searched nodes
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+NODE_BUCKETS = (10, 50, 100, 500, 1000, 2000, 5000, 10000, 50000, 100000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_labels(pairs):
+    """Renders {name="value",...} from (name, value) pairs, with the worker's pid first."""
+    pairs = [("pid", os.getpid())] + pairs
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """
+    A count that only goes up, per combination of label values.
+    """
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labelValues, amount=1):
+        self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def samples(self):
+        """Yields (name, label pairs, value) for every series."""
+        for labelValues, value in self.values.items():
+            yield self.name, list(zip(self.labels, labelValues)), value
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down. If function is given, it is called
+    for the value at every scrape instead.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), function=None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def dec(self, *labelValues, amount=1):
+        self.inc(*labelValues, amount=-amount)
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, [], self.function()
+        else:
+            yield from super().samples()
+
+
+class Histogram:
+    """
+    Observations counted into buckets (upper bounds), per combination of
+    label values, with their sum and count.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=TIME_BUCKETS, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        # [count per bucket (the last one above every bound), sum], by label values
+        self.series = {}
+
+    def observe(self, value, *labelValues):
+        series = self.series.get(labelValues)
+        if series is None:
+            series = self.series[labelValues] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for labelValues, (counts, total) in self.series.items():
+            labels = list(zip(self.labels, labelValues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket", labels + [("le", bound)], cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class Registry:
+    """
+    The metrics of this process, rendered together for a scrape.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=(), function=None):
+        return self.register(Gauge(name, description, labels, function))
+
+    def histogram(self, name, description, buckets=TIME_BUCKETS, labels=()):
+        return self.register(Histogram(name, description, buckets, labels))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+def timed(histogram, *labelValues, inProgress=None):
+    """
+    Decorator recording how long each call takes in histogram, even if it
+    raises. inProgress (a Gauge) counts the calls still running.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if inProgress is not None:
+                inProgress.inc(*labelValues)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labelValues)
+                if inProgress is not None:
+                    inProgress.dec(*labelValues)
+        return wrapper
+    return decorator
@@ -1,62 +1,258 @@
-from flask import Flask, render_template
-from flask_socketio import SocketIO, send, emit
+from flask import Flask, Response, render_template, request
+from flask_socketio import SocketIO, send, emit, join_room
 import eventlet
-from eventlet import wsgi
+from eventlet import tpool, wsgi
+import argparse
+import copy
 import json
+import os
+import signal
+import threading
+import time
 
+from batch_analysis import BatchAnalyser, MAX_POSITIONS, parse_options
 from chess import chess
 import engine
+from engine_pool import EngineError, EnginePool
 import engine_utils
+from game_log import GameLog
+import metrics
+from message_queue import LocalQueueBroker, LocalQueueManager
+from session_store import GameSession, SharedSessionStore
 
 app = Flask(__name__)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.config['TEMPLATES_AUTO_RELOAD'] = True
-socketio = SocketIO(app)
+# Initialised in __main__, once we know whether workers share a message queue
+socketio = SocketIO()
+
+# Beyond this many missed moves, resending the board is cheaper than deltas
+MAX_DELTA_MOVES = 100
 
 sessions = {
-    # 'ssid': Board
+    # 'ssid': GameSession
+    # Replaced by a SharedSessionStore when running several workers
+}
+
+# Finished games are appended here, None to keep no record
+game_log = None
+
+# Engine processes searching bot moves (see engine_pool.py), per process.
+# None to search in this process
+engines = None
+# Settings for start_engines, set in __main__
+engine_settings = None
+
+# Search on the player's time in bot games
+PONDERING = True
+# In-process ponders running at once. Each is a CPU-bound thread competing
+# with the server for the GIL, so further games go without
+MAX_PONDERS = 2
+ponder_slots = threading.BoundedSemaphore(MAX_PONDERS)
+ponderers = {
+    # 'ssid': (socket.io sid, engine.Ponderer), per process
 }
 
+# Searches for POST /analyse, on a pool of processes started with the first batch
+analyser = BatchAnalyser()
+
+# Served at /metrics, see metrics.py
+EVENT_TIME = metrics.REGISTRY.histogram(
+    "superchess_event_seconds", "Time taken to handle a socket event", labels=("event",))
+EVENTS_IN_PROGRESS = metrics.REGISTRY.gauge(
+    "superchess_events_in_progress", "Socket events being handled", labels=("event",))
+SEARCH_TIME = metrics.REGISTRY.histogram(
+    "superchess_search_seconds", "Time taken by engine searches for bot moves", labels=("level",))
+SEARCH_NODES = metrics.REGISTRY.histogram(
+    "superchess_search_nodes", "Nodes searched for bot moves", metrics.NODE_BUCKETS, labels=("level",))
+EVALUATION_TIME = metrics.REGISTRY.histogram(
+    "superchess_evaluation_seconds", "Time taken to evaluate a position for the evaluation bar")
+EVALUATIONS_PENDING = metrics.REGISTRY.gauge(
+    "superchess_evaluations_pending", "Evaluations queued for or running on a worker thread")
+SESSIONS = metrics.REGISTRY.gauge(
+    "superchess_sessions", "Games in progress", function=lambda: len(sessions))
+ENGINE_FALLBACKS = metrics.REGISTRY.counter(
+    "superchess_engine_fallbacks_total", "Bot moves searched in the server process after the engine processes failed")
+GAME_LOG_QUEUE = metrics.REGISTRY.gauge(
+    "superchess_game_log_queue_depth", "Finished games waiting to be written",
+    function=lambda: game_log.queue.qsize() if game_log else 0)
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route("/play/<string:kind>")
 def play(kind):
+    # Bot games take an optional strength level, e.g. /play/bot?level=casual
     if kind not in ['local', 'bot']:
         return render_template('index.html')
 
     return render_template('play.html', kind=kind)
 
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/analyse", methods=["POST"])
+def post_analyse():
+    """
+    Analyse a batch of positions, streaming a JSON line for each as it
+    finishes. See batch_analysis.py for the request and results.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("positions"), list):
+        return Response("Expected a JSON object with a list of positions\n", status=400)
+    if len(data["positions"]) > MAX_POSITIONS:
+        return Response(f"At most {MAX_POSITIONS} positions per request\n", status=413)
+    try:
+        options = parse_options(data)
+    except ValueError as e:
+        return Response(f"{e}\n", status=400)
+
+    def stream():
+        results = analyser.analyse(data["positions"], options)
+        while True:
+            # Waiting on the pool would block every other green thread
+            result = tpool.execute(next, results, None)
+            if result is None:
+                return
+            yield json.dumps(result) + "\n"
+
+    return Response(stream(), content_type="application/x-ndjson")
+
+def send_board(session):
+    """
+    Send the whole board, tagged with the sequence number it reflects,
+    and the legal moves for the side to move.
+    """
+    pieces = session.board.pieces_to_json()
+    pieces['seq'] = session.seq
+    pieces['legal'] = session.legal_move_map()
+    emit('board', pieces)
+
+def send_move(ssid, session, entry):
+    """
+    Send a move that was just made, then the game outcome or evaluation.
+    """
+    seq, start_pos, end_pos, changes = entry
+    board = session.board
+
+    # instead of sending the whole board, re-send the from and to positions,
+    # the piece that was moved and every square that changed.
+    # Legal moves for the next turn come along, so the client needs no round-trips
+    emit('move_piece', {
+        'seq': seq,
+        'from': start_pos,
+        'to': end_pos,
+        'piece': board.get_piece(end_pos).to_json(),
+        'changes': changes,
+        'legal': session.legal_move_map()
+    })
+
+    # Check if the game is over
+    if board.game_over:
+        emit('game_over', {
+            "outcome": board.outcome
+        })
+        if game_log:
+            game_log.append(session.to_record(ssid))
+        # Remove the session from the sessions dict
+        del sessions[ssid]
+        if ssid in ponderers:
+            ponderers.pop(ssid)[1].cancel()
+    elif session.evaluate:
+        # Evaluate in the background, the move has already been acknowledged.
+        # The board is copied so the next move can't change it mid-evaluation
+        EVALUATIONS_PENDING.inc()
+        socketio.start_background_task(
+            send_evaluation, ssid, copy.deepcopy(board), session.to_play(), seq
+        )
+
+def send_evaluation(ssid, board, toPlay, seq):
+    """
+    Evaluate a position on a worker thread, and send it to the session once ready.
+    """
+    start = time.perf_counter()
+    try:
+        evaluation = tpool.execute(engine_utils.evaluate_board_cached, board, toPlay)
+    finally:
+        EVALUATION_TIME.observe(time.perf_counter() - start)
+        EVALUATIONS_PENDING.dec()
+    print(f"Eval: {evaluation}")
+    socketio.emit('evaluation', {
+        "evaluation": evaluation,
+        "seq": seq
+    }, to=ssid)
+
 @socketio.on('connect')
 def on_connect_event():
     print("[==] Connected")
     emit('connected')
 
 @socketio.on('request_board')
+@metrics.timed(EVENT_TIME, "request_board", inProgress=EVENTS_IN_PROGRESS)
 def on_request_board_event(data):
     print(f"Request board: {data}")
     ssid = data['ssid']
 
     if not ssid in sessions:
         # Create a new board
-        board = chess.ChessBoard()
-        sessions[ssid] = board
+        sessions[ssid] = GameSession(chess.ChessBoard(), data.get('kind', 'local'))
     
-    board = sessions[ssid]
-    emit('board', board.pieces_to_json())
+    session = sessions[ssid]
+
+    # Clients that don't show the evaluation bar can opt out of evaluations
+    if 'evaluate' in data:
+        session.evaluate = bool(data['evaluate'])
+        sessions[ssid] = session
+
+    if 'level' in data:
+        session.level = engine.get_level(data['level'])
+        sessions[ssid] = session
+
+    # Room per session, so emits for it reach the client whichever worker holds it
+    join_room(ssid)
+    send_board(session)
+
+@socketio.on('request_moves')
+@metrics.timed(EVENT_TIME, "request_moves", inProgress=EVENTS_IN_PROGRESS)
+def on_request_moves_event(data):
+    print(f"Request moves: {data}")
+    # Data must contain ssid and since (last sequence number the client has)
+    ssid = data['ssid']
+    since = data['since']
+
+    if not ssid in sessions:
+        # Session is gone (game over or server restarted), start again
+        on_request_board_event(data)
+        return
+
+    session = sessions[ssid]
+    join_room(ssid)
+
+    if since < 0 or since > session.seq or session.seq - since > MAX_DELTA_MOVES:
+        send_board(session)
+    else:
+        emit('moves', {
+            'since': since,
+            'seq': session.seq,
+            'moves': session.moves_since(since),
+            'legal': session.legal_move_map()
+        })
 
 @socketio.on('get_legal_moves')
+@metrics.timed(EVENT_TIME, "get_legal_moves", inProgress=EVENTS_IN_PROGRESS)
 def on_get_legal_moves_event(data):
     print(f"Requesting legal moves: {data}")
     # Data must contain ssid and pos
     ssid = data['ssid']
     pos = data['pos']
 
-    board = sessions[ssid]
+    board = sessions[ssid].board
     emit('legal_moves', board.get_legal_moves(pos))
 
 @socketio.on('move_piece')
+@metrics.timed(EVENT_TIME, "move_piece", inProgress=EVENTS_IN_PROGRESS)
 def on_move_piece_event(data):
     print(f"Moving piece: {data}")
     # Data must contain ssid, from, and to
@@ -64,79 +260,212 @@ def on_move_piece_event(data):
     start_pos = data['from']
     end_pos = data['to']
 
-    board = sessions[ssid]
-    board.move_piece(start_pos, end_pos)
-    board.update_game_state()
+    session = sessions[ssid]
+    entry = session.move_piece(start_pos, end_pos)
+    session.board.update_game_state()
+    sessions[ssid] = session
 
-    # instead of sending the whole board, re-send the from and to positions
-    # and the piece that was moved
-    emit('move_piece', {
-        'from': start_pos,
-        'to': end_pos,
-        'piece': board.get_piece(end_pos).to_json()
-    })
-
-    # Check if the game is over
-    if board.game_over:
-        emit('game_over', {
-            "outcome": board.outcome
-        })
-        # Remove the session from the sessions dict
-        del sessions[ssid]
-    else:
-        toPlay = "W" if board.last_moved_piece.colour == "B" else "B"
-        evaluation = engine_utils.evaluate_board(board, toPlay)
-        print(f"Eval: {evaluation}")
-        # Send evaluation
-        emit('evaluation', {
-            "evaluation": evaluation
-        })
+    send_move(ssid, session, entry)
 
 @socketio.on('bot_move')
+@metrics.timed(EVENT_TIME, "bot_move", inProgress=EVENTS_IN_PROGRESS)
 def on_bot_move_event(data):
     print(f"Bot moving piece: {data}")
     # Data must contain ssid
     ssid = data['ssid']
-    board = sessions[ssid]
+    session = sessions[ssid]
+
+    if session.to_play() != "B":
+        # Already moved, e.g. the client asked again after resyncing
+        return
+
+    # The level can also be picked per move
+    if 'level' in data:
+        session.level = engine.get_level(data['level'])
+
+    # Serve the pondered move if the player replied as expected
+    result = None
+    sid, ponderer = ponderers.pop(ssid, (None, None))
+    if ponderer:
+        result = tpool.execute(ponderer.get, session.board)
+        print("[==] Ponder hit" if result else "[==] Ponder miss")
 
     # Get the best move
-    move = engine.get_move(board)
+    if result is None:
+        start = time.perf_counter()
+        nodes = []
+        if engines:
+            try:
+                move, pv, searched = tpool.execute(engines.search, session.move_strings(), session.level)
+            except EngineError as e:
+                print(f"[!!] Engine processes failed, searching here: {e}")
+                move = None
+            if move is not None:
+                result = (move, pv)
+                nodes = [searched]
+            else:
+                # No answer (bestmove 0000 is sent when the search failed)
+                ENGINE_FALLBACKS.inc()
+        if result is None:
+            result = engine.get_move_with_pv(
+                session.board, level=session.level,
+                onIteration=lambda depth, score, pv, searched, elapsed: nodes.append(searched)
+            )
+        SEARCH_TIME.observe(time.perf_counter() - start, session.level)
+        # Nodes of the completed iterations, none for tablebase and transposition hits
+        SEARCH_NODES.observe(nodes[-1] if nodes else 0, session.level)
+    move, pv = result
 
     # Move the piece
-    board.move_piece(move[0], move[1])
-    board.update_game_state()
+    entry = session.move_piece(move[0], move[1])
+    session.board.update_game_state()
+    sessions[ssid] = session
 
-    # instead of sending the whole board, re-send the from and to positions
-    # and the piece that was moved
-    emit('move_piece', {
-        'from': move[0],
-        'to': move[1],
-        'piece': board.get_piece(move[1]).to_json()
-    })
+    send_move(ssid, session, entry)
 
-    # Check if the game is over
-    if board.game_over:
-        emit('game_over', {
-            "outcome": board.outcome
-        })
-        # Remove the session from the sessions dict
-        del sessions[ssid]
-    else:
-        toPlay = "W" if board.last_moved_piece.colour == "B" else "B"
-        evaluation = engine_utils.evaluate_board(board, toPlay)
-        # Send evaluation
-        emit('evaluation', {
-            "evaluation": engine_utils.evaluate_board(board, toPlay)
-        })
+    # Think about the expected reply while the player does
+    if PONDERING and not session.board.game_over and len(pv) > 1:
+        if engines:
+            # Only on an idle engine process, searches come first
+            ponderer = engines.ponder(session.board, session.move_strings(), pv[1], session.level)
+        elif ponder_slots.acquire(blocking=False):
+            ponderer = engine.Ponderer(session.board, pv[1], level=session.level, slots=ponder_slots)
+        else:
+            ponderer = None
+        if ponderer:
+            ponderers[ssid] = (request.sid, ponderer)
 
 @socketio.on('disconnect')
 def on_disconnect_event():
     print("[==] Disconnected")
 
+    # Nobody left to reply, stop pondering for this client
+    for ssid, (sid, ponderer) in list(ponderers.items()):
+        if sid == request.sid:
+            ponderer.cancel()
+            del ponderers[ssid]
+
 @socketio.on('error')
 def on_error_event(data):
     print(f"Error: {data}")
 
+def start_engines():
+    """
+    Start this process' engine processes, if the server was asked for them.
+    """
+    global engines
+    if engine_settings and engine_settings["processes"]:
+        engines = EnginePool(
+            engine_settings["processes"],
+            max_searches=engine_settings["max_searches"],
+            max_memory=engine_settings["max_memory"],
+        )
+
+def run_worker(sock, queue_address):
+    """
+    Serve requests from a listening socket shared with the other workers.
+    """
+    # Pipes to engine processes can't be shared, each worker starts its own
+    start_engines()
+    socketio.init_app(app, client_manager=LocalQueueManager(queue_address))
+    wsgi.server(sock, app)
+
+def spawn_worker(sock, queue_address):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(sock, queue_address)
+        finally:
+            os._exit(0)
+
+    return pid
+
+def run_workers(host, port, workers, session_dir, queue_port):
+    """
+    Pre-fork server: every worker accepts from the same listening socket,
+    and the kernel spreads connections across them. Clients use the
+    websocket transport, so a connection stays on the worker that accepted it.
+    Boards live in a shared session store, and emits travel through a local
+    message queue broker owned by this (master) process.
+    """
+    global sessions
+    sessions = SharedSessionStore(session_dir)
+
+    queue_address = ('127.0.0.1', queue_port)
+    broker = LocalQueueBroker(queue_address)
+    sock = eventlet.listen((host, port))
+
+    children = set()
+    for _ in range(workers):
+        children.add(spawn_worker(sock, queue_address))
+    print(f"[==] Started {workers} workers on port {port}")
+
+    eventlet.spawn(broker.serve)
+
+    try:
+        while True:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid in children:
+                # Worker died, replace it
+                print(f"[!!] Worker {pid} exited with status {status}, restarting")
+                children.discard(pid)
+                children.add(spawn_worker(sock, queue_address))
+            eventlet.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        broker.close()
+
 if __name__ == '__main__':
-    # app.run(debug=True)
-    wsgi.server(eventlet.listen(('', 5000)), app)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the superchess server.")
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    parser.add_argument("--session-dir", default="sessions",
+                        help="shared session store used when running several workers")
+    parser.add_argument("--queue-port", type=int, default=5100,
+                        help="local port of the message queue broker used when running several workers")
+    parser.add_argument("--no-ponder", action="store_true",
+                        help="don't search on the player's time in bot games")
+    parser.add_argument("--max-ponders", type=int, default=MAX_PONDERS,
+                        help="in-process ponders running at once, in each worker")
+    parser.add_argument("--game-log", default="games",
+                        help="directory finished games are logged to")
+    parser.add_argument("--game-log-max-mb", type=int, default=64,
+                        help="size at which a game log file is rotated")
+    parser.add_argument("--no-game-log", action="store_true",
+                        help="don't log finished games")
+    parser.add_argument("--engine-processes", type=int, default=0,
+                        help="engine processes searching bot moves, in each worker (default: 0, search in the worker)")
+    parser.add_argument("--engine-max-searches", type=int, default=200,
+                        help="searches after which an engine process is replaced")
+    parser.add_argument("--engine-max-memory-mb", type=int, default=1024,
+                        help="memory above which an engine process is replaced (0 for no limit)")
+    parser.add_argument("--analysis-processes", type=int, default=os.cpu_count(),
+                        help="processes searching positions for POST /analyse, in each worker")
+    args = parser.parse_args()
+
+    PONDERING = not args.no_ponder
+    ponder_slots = threading.BoundedSemaphore(args.max_ponders)
+    analyser.processes = args.analysis_processes
+    engine_settings = {
+        "processes": args.engine_processes,
+        "max_searches": args.engine_max_searches,
+        "max_memory": args.engine_max_memory_mb * 1024 * 1024,
+    }
+    if not args.no_game_log:
+        game_log = GameLog(args.game_log, max_bytes=args.game_log_max_mb * 1024 * 1024)
+
+    if args.workers > 1:
+        run_workers(args.host, args.port, args.workers, args.session_dir, args.queue_port)
+    else:
+        start_engines()
+        socketio.init_app(app)
+        # app.run(debug=True)
+        wsgi.server(eventlet.listen((args.host, args.port)), app)
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+import engine
+from chess.chess import move_to_string
+
+class GameSession:
+    """
+    A game being played: the board plus a log of every move made on it.
+    Each move gets the next sequence number (starting at 1), and is logged
+    as the squares it changed, so a client that missed moves can catch up
+    with "moves since N" instead of refetching the whole board.
+
+    Log entries are [seq, from, to, changes], where changes is a list of
+    [square index (row * 16 + col), square code] as in ChessBoard.square_codes.
+    """
+    def __init__(self, board, kind="local"):
+        self.board = board
+        self.kind = kind # "local" or "bot" (bot plays black)
+        self.evaluate = True # send an evaluation after every move
+        self.level = engine.DEFAULT_LEVEL # bot strength
+        self.moves = []
+        self.started = time.time()
+
+    @property
+    def seq(self):
+        """Sequence number of the last move made, 0 before any move."""
+        return len(self.moves)
+
+    def to_play(self):
+        """White always moves first."""
+        return "W" if self.seq % 2 == 0 else "B"
+
+    def legal_move_map(self):
+        """
+        Returns the legal move map for the side to move, see ChessBoard.get_legal_move_map.
+        None when nobody on the client needs it (game over, or the bot is to move).
+        """
+        toPlay = self.to_play()
+        if self.board.game_over or (self.kind == "bot" and toPlay == "B"):
+            return None
+
+        return self.board.get_legal_move_map(toPlay)
+
+    def move_piece(self, start_pos, end_pos):
+        """
+        Make a move on the board and log it.
+        Returns the log entry.
+        """
+        before = self.board.square_codes()
+        self.board.move_piece(start_pos, end_pos)
+        after = self.board.square_codes()
+
+        # Diff the whole board rather than trusting from/to, so captures
+        # away from the destination (en passant) are never missed
+        changes = [
+            [i, code] for i, code in enumerate(after)
+            if code != before[i]
+        ]
+
+        entry = [self.seq + 1, list(start_pos), list(end_pos), changes]
+        self.moves.append(entry)
+
+        return entry
+
+    def move_strings(self):
+        """
+        Returns every move made, as strings (see chess.move_to_string).
+        """
+        return [move_to_string((start, end)) for seq, start, end, changes in self.moves]
+
+    def moves_since(self, seq):
+        """
+        Returns the log entries of every move after the given sequence number.
+        """
+        return self.moves[seq:]
+
+    def to_record(self, ssid):
+        """
+        Returns the game as a record for the game log (see game_log.py).
+        The ssid is hashed, like SharedSessionStore does, rather than logged.
+        """
+        outcome = self.board.outcome
+        if not self.board.game_over:
+            result, reason = "*", "unfinished"
+        elif outcome["winner"] == "W":
+            result, reason = "1-0", outcome["type"]
+        elif outcome["winner"] == "B":
+            result, reason = "0-1", outcome["type"]
+        else:
+            result, reason = "1/2-1/2", outcome["type"]
+
+        return {
+            "game": hashlib.sha1(ssid.encode("utf-8")).hexdigest(),
+            "kind": self.kind,
+            "level": self.level if self.kind == "bot" else None,
+            "result": result,
+            "reason": reason,
+            "moves": self.move_strings(),
+            "started": self.started,
+            "ended": time.time(),
+        }
+
+
+class SharedSessionStore:
+    """
+    Session store shared by every worker process on one box.
+    Sessions are pickled to one file per ssid, so whichever worker
+    receives an event for a session can load it, and a worker
+    crashing does not take the game with it.
+
+    Behaves like the plain dict used in single-process mode:
+        ssid in store, store[ssid], store[ssid] = session, del store[ssid]
+    Sessions are copies, so handlers must write them back after mutating.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, ssid):
+        """
+        Returns the file holding the given session.
+        ssids come from the client, so they are hashed rather than trusted as filenames.
+        """
+        name = hashlib.sha1(ssid.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".pickle")
+
+    def __contains__(self, ssid):
+        return os.path.exists(self.path(ssid))
+
+    def __getitem__(self, ssid):
+        try:
+            with open(self.path(ssid), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(ssid)
+
+    def __setitem__(self, ssid, session):
+        # Write to a temporary file and swap it in, so other workers
+        # never read a half written session
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(session, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path(ssid))
+
+    def __delitem__(self, ssid):
+        try:
+            os.remove(self.path(ssid))
+        except FileNotFoundError:
+            raise KeyError(ssid)
+
+    def __len__(self):
+        return len([
+            name for name in os.listdir(self.directory)
+            if name.endswith(".pickle")
+        ])
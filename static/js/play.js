@@ -6,6 +6,7 @@ class Board {
         this.newSSID();
 
         this.legalMovesCells = []; // legal moves
+        this.legalMoveMap = null; // legal moves by square index, pushed by the server each turn
         this.selectedPiece = null; // selected piece
         this.lastMovedPositions = []; // last moved piece
         this.gameOver = true;
@@ -17,13 +18,26 @@ class Board {
         this.gameEndSound = new Audio("/static/audio/game_end.ogg");
 
         this.toPlay = "W"; // colour to play
+        this.seq = 0; // sequence number of the last move applied
+        this.reconnecting = false; // lost the connection mid-game
         this.gameType = window.location.pathname.split("/")[2]; // game type (local, bot)
+        this.level = new URLSearchParams(window.location.search).get("level"); // bot strength, server default if null
     }
 
     newSSID() {
         this.ssid = Math.random().toString(36).substring(2, 15) + Math.random().toString(36).substring(2, 15);
     }
 
+    showsEvaluation() {
+        // the server only evaluates positions for clients that show the bar
+        let bar = document.querySelector(".evaluation-bar");
+        if (!bar) {
+            return false;
+        }
+        let rect = bar.getBoundingClientRect();
+        return rect.width > 0 && rect.right > 0 && rect.left < window.innerWidth;
+    }
+
     onOpen(event) {
         console.log("Connection established");
         // request board
@@ -39,23 +53,12 @@ class Board {
         piece.parentNode.removeChild(piece);
     }
 
-    async movePieceOnBoard(from, to, piece) {
-        console.log("Moving piece", from, to, piece);
-        // delete piece from old cell
-        this.deletePiece(from);
+    async movePieceOnBoard(from, to, changes) {
+        console.log("Moving piece", from, to, changes);
+        let isCapture = this.cellHasPiece(this.getCell(to));
 
-        let isCapture = false;
-
-        // delete children from new cell, if any
-        let row = this.board.children[to[0]];
-        let cell = row.children[to[1]];
-        while (cell.firstChild) {
-            cell.removeChild(cell.firstChild);
-            isCapture = true;
-        }
-
-        // create new piece in new cell
-        this.newPiece(piece.key, piece.colour, to);
+        // apply every square the move changed (captures, en passant, wormhole wraps)
+        this.applyChanges(changes);
 
         // delete highlights
         this.clearLegalMoves();
@@ -72,14 +75,54 @@ class Board {
         this.onPieceMoved();
     }
 
+    applyChanges(changes) {
+        // changes are [square index, code], code is "" for an empty square,
+        // uppercase for white and lowercase for black
+        for (let i = 0; i < changes.length; i++) {
+            let pos = [Math.floor(changes[i][0] / 16), changes[i][0] % 16];
+            let code = changes[i][1];
+
+            let cell = this.getCell(pos);
+            while (cell.firstChild) {
+                cell.removeChild(cell.firstChild);
+            }
+
+            if (code != "") {
+                let colour = code == code.toUpperCase() ? "white" : "black";
+                this.newPiece(code.toUpperCase(), colour, pos);
+            }
+        }
+    }
+
+    applyMoves(moves) {
+        // moves are [seq, from, to, changes], in order
+        for (let i = 0; i < moves.length; i++) {
+            let [seq, from, to, changes] = moves[i];
+            this.applyChanges(changes);
+            this.setLastMovedPositions(from, to);
+            this.setSeq(seq);
+        }
+        this.clearLegalMoves();
+    }
+
+    setSeq(seq) {
+        // white moves first, so the sequence number tells whose turn it is
+        this.seq = seq;
+        this.toPlay = seq % 2 == 0 ? "W" : "B";
+    }
+
     onPieceMoved() {
         // change turn
         this.switchToPlay();
-        
+        this.requestBotMove();
+    }
+
+    requestBotMove() {
         // if the game is bot, request bot to move
         if (this.gameType == "bot" && this.toPlay == "B") {
             socket.emit("bot_move", {
-                "ssid": this.ssid
+                "ssid": this.ssid,
+                "level": this.level
             })
         }
     }
@@ -269,6 +312,28 @@ class Board {
         document.getElementById("row-labels").children[pos[0]].classList.remove("active");
     }
 
+    showLegalMoves(positions) {
+        this.clearLegalMoves();
+        this.legalMovesCells = positions;
+        this.setCellClasses(positions, "legal-move");
+    }
+
+    getLegalMoves(pos) {
+        // look up the pushed map, only ask the server if there is none
+        if (this.legalMoveMap == null) {
+            socket.emit("get_legal_moves", {
+                "ssid": this.ssid,
+                "pos": pos
+            });
+            return;
+        }
+
+        let moves = this.legalMoveMap[pos[0] * 16 + pos[1]] || [];
+        this.showLegalMoves(moves.map(function(index) {
+            return [Math.floor(index / 16), index % 16];
+        }));
+    }
+
     clearLegalMoves() {
         // clear all legal moves if they are not highlighted
         for (let i = 0; i < this.legalMovesCells.length; i++) {
@@ -313,6 +378,7 @@ class Board {
     endGame(outcome) {
         this.gameOver = true;
         this.setWinner(outcome.winner);
+        document.getElementById("outcome-desc").innerHTML = "by " + outcome.type;
         openOutcomeMenu();
         this.gameEndSound.play();
     }
@@ -326,10 +392,15 @@ class Board {
             outcomeName.innerHTML = "White wins!";
             outcomeIconW.classList.add("active");
             outcomeIconB.classList.remove("active");
-        } else {
+        } else if (winner == "B") {
             outcomeName.innerHTML = "Black wins!";
             outcomeIconW.classList.remove("active");
             outcomeIconB.classList.add("active");
+        } else {
+            // stalemate or repetition
+            outcomeName.innerHTML = "Draw!";
+            outcomeIconW.classList.remove("active");
+            outcomeIconB.classList.remove("active");
         }
     }
 
@@ -441,10 +512,7 @@ function onPieceClick(event) {
             chessBoard.selectedPiece = piece;
 
             // get legal moves
-            socket.emit("get_legal_moves", {
-                "ssid": chessBoard.ssid,
-                "pos": pos
-            });
+            chessBoard.getLegalMoves(pos);
         }
     }
 }
@@ -459,18 +527,18 @@ function playLocal() {
     chessBoard.toPlay = "W";
     chessBoard.gameOver = false;
     chessBoard.newSSID();
-    socket.emit("request_board", {"ssid": chessBoard.ssid});
+    socket.emit("request_board", {"ssid": chessBoard.ssid, "kind": chessBoard.gameType, "level": chessBoard.level, "evaluate": chessBoard.showsEvaluation()});
     closeOutcomeMenu();
 }
 
 function playBot() {
-    window.history.pushState("", "", "/play/bot");
+    window.history.pushState("", "", "/play/bot" + window.location.search);
     chessBoard.clearBoard();
     chessBoard.gameType = "bot";
     chessBoard.toPlay = "W";
     chessBoard.gameOver = false;
     chessBoard.newSSID();
-    socket.emit("request_board", {"ssid": chessBoard.ssid});
+    socket.emit("request_board", {"ssid": chessBoard.ssid, "kind": chessBoard.gameType, "level": chessBoard.level, "evaluate": chessBoard.showsEvaluation()});
     closeOutcomeMenu();
 }
 
@@ -509,15 +577,26 @@ function hideError() {
 let chessBoard = new Board();
 
 // Connections
-const socket = io();
+// websocket only, so a connection stays on the server worker that accepted it
+const socket = io({transports: ["websocket"]});
 console.log("Connecting to server", socket);
 
 socket.on("connect", function() {
     console.log("connected to server, requesting board..");
-    if (chessBoard.gameOver) {
+    if (chessBoard.reconnecting) {
+        // only fetch the moves we missed
+        socket.emit("request_moves", {
+            "ssid": chessBoard.ssid,
+            "since": chessBoard.seq
+        });
+        hideError();
+    } else if (chessBoard.gameOver) {
         // request board
         socket.emit("request_board", {
-            "ssid": chessBoard.ssid
+            "ssid": chessBoard.ssid,
+            "kind": chessBoard.gameType,
+            "level": chessBoard.level,
+            "evaluate": chessBoard.showsEvaluation()
         });
         hideError();
     } else {
@@ -528,6 +607,7 @@ socket.on("connect", function() {
 
 socket.on("disconnect", function() {
     console.log("disconnected from server");
+    chessBoard.reconnecting = !chessBoard.gameOver;
     chessBoard.gameOver = true;
     showError("Unexpectedly disconnected from server.");
 });
@@ -540,31 +620,53 @@ socket.on("error", function(err) {
 socket.on("board", function(data) {
     console.log("received board", data);
     chessBoard.gameOver = false;
+    chessBoard.reconnecting = false;
     chessBoard.clearBoard();
     chessBoard.createBoard(data);
+    chessBoard.setSeq(data.seq);
+    chessBoard.legalMoveMap = data.legal;
+    chessBoard.requestBotMove();
+});
+
+socket.on("moves", function(data) {
+    console.log("received moves", data);
+    chessBoard.gameOver = false;
+    chessBoard.reconnecting = false;
+    chessBoard.applyMoves(data.moves);
+    chessBoard.legalMoveMap = data.legal;
+    chessBoard.requestBotMove();
 });
 
 socket.on("legal_moves", function(data) {
     console.log("received legal moves", data);
-    let positions = data;
-    chessBoard.clearLegalMoves();
-    chessBoard.legalMovesCells = positions;
-    chessBoard.setCellClasses(positions, "legal-move");
+    chessBoard.showLegalMoves(data);
 });
 
 socket.on("move_piece", function(data) {
     console.log("received move_piece", data);
     let from = data.from;
     let to = data.to;
-    let piece = data.piece;
+
+    if (data.seq != chessBoard.seq + 1) {
+        // missed a move somewhere, catch up instead of desyncing
+        socket.emit("request_moves", {
+            "ssid": chessBoard.ssid,
+            "since": chessBoard.seq
+        });
+        return;
+    }
 
     if (chessBoard.toPlay == "B") {
         setTimeout(function() {
             // instant is too fast
-            chessBoard.movePieceOnBoard(from, to, piece);
+            chessBoard.seq = data.seq;
+            chessBoard.legalMoveMap = data.legal;
+            chessBoard.movePieceOnBoard(from, to, data.changes);
         }, 500);
     } else {
-        chessBoard.movePieceOnBoard(from, to, piece);
+        chessBoard.seq = data.seq;
+        chessBoard.legalMoveMap = data.legal;
+        chessBoard.movePieceOnBoard(from, to, data.changes);
     }
 });
 
@@ -579,6 +681,10 @@ socket.on("game_over", function(data) {
 
 socket.on("evaluation", function(data) {
     console.log("received evaluation", data);
+    if (data.seq < chessBoard.seq) {
+        // a newer move has already been made
+        return;
+    }
     let evaluation = data.evaluation;
     let colour = data.colour;
 
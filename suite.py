@@ -0,0 +1,196 @@
+"""
+Position test suites, for checking that a faster search still finds
+the same tactics.
+
+Every position in a suite file (see suites/tactics.epd for the format)
+is searched with a fixed node budget, in parallel processes, and the
+engine's move is checked against the expected best (or avoided) moves.
+
+    python suite.py suites/tactics.epd --level hard --nodes 5000
+"""
+import argparse
+import contextlib
+import os
+import re
+import sys
+import tempfile
+import time
+
+import engine
+import engine_utils
+from chess.chess import ChessBoard, move_to_string, string_to_move
+
+# Level registered in every worker process, see init_worker
+SUITE_LEVEL = "suite"
+
+def parse_position(line):
+    """
+    Parses one suite line into
+    {"id": ..., "fen": ..., "isBlack": ..., "bm": [moves], "am": [moves]}
+    """
+    placement, side, operations = line.split(None, 2)
+    if side not in ("w", "b"):
+        raise ValueError(f"Side to move must be w or b, got {side}: {line}")
+
+    position = {
+        "id": None,
+        "fen": placement,
+        "isBlack": side == "b",
+        "bm": [],
+        "am": [],
+    }
+    for operation in operations.split(";"):
+        operation = operation.strip()
+        if not operation:
+            continue
+        opcode, _, operand = operation.partition(" ")
+        if opcode in ("bm", "am"):
+            position[opcode] = [string_to_move(move) for move in operand.split()]
+        elif opcode == "id":
+            position["id"] = operand.strip('"')
+        # Other operations (comments...) are ignored
+
+    if not position["bm"] and not position["am"]:
+        raise ValueError(f"Position has neither bm nor am: {line}")
+    if position["id"] is None:
+        position["id"] = placement
+
+    return position
+
+
+def load_suite(path):
+    """
+    Returns the positions in a suite file, skipping blank lines and # comments.
+    """
+    positions = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                positions.append(parse_position(line))
+
+    return positions
+
+
+def is_solution(position, move):
+    """True if the move is one of the best moves, or none of the avoided ones."""
+    move = move_to_string(move)
+    if position["bm"]:
+        return move in [move_to_string(m) for m in position["bm"]]
+    return move not in [move_to_string(m) for m in position["am"]]
+
+
+def init_worker(level, nodes):
+    # The engine saves its transposition table to the working directory,
+    # keep each process' table to itself
+    os.chdir(tempfile.mkdtemp(prefix="superchess-suite-"))
+    sys.stdout = open(os.devnull, "w")
+    # Tables are cleared for every position, nothing to keep
+    engine_utils.TRANSPOSITION_SAVE_INTERVAL = None
+
+    # Same search as the given level, but bounded by nodes alone so
+    # results don't depend on how busy the machine is
+    engine.LEVELS[SUITE_LEVEL] = dict(engine.LEVELS[level], nodes=nodes, time=0)
+    # Suites test the search, endings in the tablebases would skip it
+    engine.TABLEBASES = False
+
+
+def solve(position):
+    """
+    Searches one position. Returns its result, with the time and nodes
+    taken to settle on a solution (the first iteration after which the
+    best move never changed away from one), or None if it wasn't solved.
+    """
+    board = ChessBoard(position["fen"])
+    # Don't let one position's search answer another's
+    engine_utils.TRANSPOSITION_TABLE = {}
+
+    iterations = []
+    def on_iteration(depth, score, pv, nodes, elapsed):
+        iterations.append((pv[0] if pv else None, nodes, elapsed))
+
+    start = time.perf_counter()
+    move = engine.get_move(board, position["isBlack"], level=SUITE_LEVEL, onIteration=on_iteration)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "id": position["id"],
+        "move": move_to_string(move),
+        "solved": is_solution(position, move),
+        "time": elapsed,
+        "nodes": iterations[-1][1] if iterations else 0,
+        "depth": len(iterations),
+        "time_to_solution": None,
+        "nodes_to_solution": None,
+    }
+    if result["solved"]:
+        # Walk back over the iterations that already had a solution
+        settled = None
+        for best, nodes, seconds in reversed(iterations):
+            if best is None or not is_solution(position, best):
+                break
+            settled = (nodes, seconds)
+        nodes, seconds = settled or (result["nodes"], elapsed)
+        result["nodes_to_solution"] = nodes
+        result["time_to_solution"] = seconds
+
+    return result
+
+
+def summarise(results):
+    """Solve rate and average time/nodes to solution over the solved positions."""
+    solved = [result for result in results if result["solved"]]
+    return {
+        "positions": len(results),
+        "solved": len(solved),
+        "solve_rate": len(solved) / len(results) if results else 0.0,
+        "avg_time_to_solution": sum(r["time_to_solution"] for r in solved) / len(solved) if solved else 0.0,
+        "avg_nodes_to_solution": sum(r["nodes_to_solution"] for r in solved) / len(solved) if solved else 0.0,
+    }
+
+
+def run_suite(positions, level, nodes, processes):
+    """
+    Solves the positions across a pool of processes.
+    Returns the results in suite order.
+    """
+    import multiprocessing
+
+    with multiprocessing.Pool(processes, init_worker, (level, nodes)) as pool:
+        return pool.map(solve, positions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run position test suites through the engine.")
+    parser.add_argument("suites", nargs="+", help="suite files")
+    parser.add_argument("--level", default="hard", choices=list(engine.LEVELS),
+                        help="level whose depth and search features are used")
+    parser.add_argument("--nodes", type=int, default=5000, help="node budget per position")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--filter", help="only run positions whose id matches this regex")
+    args = parser.parse_args()
+
+    positions = []
+    for path in args.suites:
+        positions.extend(load_suite(path))
+    if args.filter:
+        positions = [p for p in positions if re.search(args.filter, p["id"])]
+
+    results = run_suite(positions, args.level, args.nodes, args.processes)
+
+    for result in results:
+        status = "ok  " if result["solved"] else "FAIL"
+        line = f"{status} {result['id']}: {result['move']} depth {result['depth']}, " \
+               f"{result['nodes']} nodes, {result['time']:.2f}s"
+        if result["solved"]:
+            line += f" (solved after {result['nodes_to_solution']} nodes, {result['time_to_solution']:.2f}s)"
+        print(line)
+
+    report = summarise(results)
+    print()
+    print(f"Solved {report['solved']}/{report['positions']} ({report['solve_rate']:.0%}) "
+          f"at {args.level} with {args.nodes} nodes")
+    print(f"Average to solution: {report['avg_time_to_solution']:.2f}s, "
+          f"{report['avg_nodes_to_solution']:.0f} nodes")
+
+    sys.exit(0 if report["solved"] == report["positions"] else 1)
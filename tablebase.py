@@ -0,0 +1,333 @@
+"""
+Endgame tablebases for king and one piece against a lone king.
+
+Tables are generated by retrograde analysis over every placement of the
+three pieces, for both sides to move, and record the result with perfect
+play and how many plies it takes (the game ends when a king is taken):
+
+    python tablebase.py KQK KWK KRK
+
+Each table is a numpy array of int8 (int16 if a result takes more than
+127 plies), indexed
+    [side to move, attacker's king, attacker's piece, defender's king]
+where squares are row * 16 + col, and side to move is 0 for the attacker
+(the side with the piece) and 1 for the defender. Values are from the
+side to move's point of view: n > 0 wins in n plies, n < 0 loses in -n
+plies, 0 is a draw. The files are memory mapped when probed, so only the
+pages used are ever read.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+import chess.pieces as chess_pieces
+
+TABLEBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tablebases")
+
+ROWS = 10
+COLS = 16
+SQUARES = ROWS * COLS
+# Index standing for "off the board", so moves can be looked up with np.take
+PAD = SQUARES
+
+ATTACKER = 0
+DEFENDER = 1
+
+# Score of a won position, less the plies it takes
+WIN_SCORE = 100000
+
+# Tables that can be generated, by the attacking piece's key
+SIGNATURES = {
+    "KQK": "Q",
+    "KWK": "W",
+    "KRK": "R",
+}
+
+STEPS = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if (i, j) != (0, 0)]
+SLIDES = {
+    "Q": STEPS,
+    "R": [(1, 0), (-1, 0), (0, 1), (0, -1)],
+}
+
+# Loaded tables by signature, None when there is no file
+TABLES = {}
+
+def step_table(step, wrap=False, distance=1):
+    """
+    Returns the square reached from every square (and PAD) by moving
+    distance times step, PAD if that leaves the board.
+    wrap joins the left and right edges, as wormholes do.
+    """
+    table = np.full(SQUARES + 1, PAD, dtype=np.int64)
+    for square in range(SQUARES):
+        row = square // COLS + step[0] * distance
+        col = square % COLS + step[1] * distance
+        if wrap:
+            col %= COLS
+        if 0 <= row < ROWS and 0 <= col < COLS:
+            table[square] = row * COLS + col
+
+    return table
+
+
+def adjacency():
+    """Kings adjacent to each other (without wrapping), indexed [square, square]."""
+    adjacent = np.zeros((SQUARES + 1, SQUARES + 1), dtype=bool)
+    for step in STEPS:
+        table = step_table(step)
+        for square in range(SQUARES):
+            if table[square] != PAD:
+                adjacent[square, table[square]] = True
+
+    return adjacent
+
+
+def attacker_moves(piece, D, AK, AP, DK):
+    """
+    Yields (successor values, valid) for every move the attacker could make,
+    with the successor values taken from D (defender to move).
+    Captures of the defender's king are left out, those positions are
+    already decided.
+    """
+    # King
+    for step in STEPS:
+        dest = step_table(step)
+        yield D.take(dest, axis=0), (dest[AK] != PAD) & (dest[AK] != AP) & (dest[AK] != DK)
+
+    if piece == "W":
+        # A wormhole steps like a king, wrapping round the sides.
+        # With no pawns on the board it has nothing to jump
+        for step in STEPS:
+            dest = step_table(step, wrap=True)
+            yield D.take(dest, axis=1), (dest[AP] != PAD) & (dest[AP] != AK) & (dest[AP] != DK)
+        return
+
+    for step in SLIDES[piece]:
+        blocked = np.zeros((SQUARES + 1,) * 3, dtype=bool)
+        for distance in range(1, max(ROWS, COLS)):
+            dest = step_table(step, distance=distance)
+            if np.all(dest == PAD):
+                break
+            destAP = dest[AP]
+            yield D.take(dest, axis=1), (destAP != PAD) & (destAP != AK) & (destAP != DK) & ~blocked
+            # Nothing moves through a piece
+            blocked = blocked | (destAP == AK) | (destAP == DK)
+
+
+def defender_moves(A, AK, AP, DK, adjacent):
+    """
+    Yields (successor values, valid) for every move the defender could make,
+    with the successor values taken from A (attacker to move).
+    """
+    for step in STEPS:
+        dest = step_table(step)
+        destDK = dest[DK]
+        successor = A.take(dest, axis=2)
+        # Taking the piece leaves king against king, which the attacker
+        # wins at once if its king defends the piece, and draws otherwise
+        successor = np.where(destDK == AP, np.where(adjacent[AK, AP], 1, 0), successor)
+        yield successor, (destDK != PAD) & (destDK != AK)
+
+
+def update(values, moves, valid):
+    """
+    One pass of retrograde analysis for one side to move.
+    A position is won if some move reaches a position lost for the
+    opponent (taking the quickest), and lost if every move reaches a
+    position won for the opponent (holding out the longest).
+    Returns the new values.
+    """
+    winIn = np.full(values.shape, np.iinfo(np.int16).max, dtype=np.int16)
+    allLost = np.ones(values.shape, dtype=bool)
+    loseIn = np.zeros(values.shape, dtype=np.int16)
+    anyMove = np.zeros(values.shape, dtype=bool)
+
+    for successor, legal in moves:
+        legal = np.broadcast_to(legal, values.shape)
+        anyMove |= legal
+        winning = legal & (successor < 0)
+        winIn = np.where(winning, np.minimum(winIn, -successor), winIn)
+        allLost &= ~legal | (successor > 0)
+        loseIn = np.where(legal, np.maximum(loseIn, successor), loseIn)
+
+    undecided = valid & (values == 0)
+    won = undecided & (winIn < np.iinfo(np.int16).max)
+    lost = undecided & ~won & anyMove & allLost
+
+    values = values.copy()
+    values[won] = winIn[won] + 1
+    values[lost] = -(loseIn[lost] + 1)
+
+    return values
+
+
+def generate(signature):
+    """
+    Generates the table for a signature, e.g. "KQK".
+    Returns an int16 array, see the module docstring.
+    """
+    piece = SIGNATURES[signature]
+    squares = np.arange(SQUARES + 1)
+    AK = squares[:, None, None]
+    AP = squares[None, :, None]
+    DK = squares[None, None, :]
+    valid = (AK < PAD) & (AP < PAD) & (DK < PAD) & (AK != AP) & (AK != DK) & (AP != DK)
+    adjacent = adjacency()
+
+    A = np.zeros((SQUARES + 1,) * 3, dtype=np.int16)
+    D = np.zeros((SQUARES + 1,) * 3, dtype=np.int16)
+
+    # Kings taken on the next move
+    A[valid & adjacent[AK, DK]] = 1
+    D[valid & adjacent[DK, AK]] = 1
+    if piece == "W":
+        for step in STEPS:
+            dest = step_table(step, wrap=True)
+            A[valid & (dest[AP] == DK)] = 1
+    else:
+        for step in SLIDES[piece]:
+            blocked = np.zeros(A.shape, dtype=bool)
+            for distance in range(1, max(ROWS, COLS)):
+                destAP = step_table(step, distance=distance)[AP]
+                A[valid & ~blocked & (destAP == DK)] = 1
+                blocked = blocked | (destAP == AK)
+
+    passes = 0
+    while True:
+        passes += 1
+        newA = update(A, attacker_moves(piece, D, AK, AP, DK), valid)
+        newD = update(D, defender_moves(A, AK, AP, DK, adjacent), valid)
+        changed = np.count_nonzero(newA != A) + np.count_nonzero(newD != D)
+        A, D = newA, newD
+        print(f"[==] {signature} pass {passes}: {changed} positions decided")
+        if not changed:
+            break
+
+    return np.stack([A[:PAD, :PAD, :PAD], D[:PAD, :PAD, :PAD]])
+
+
+def table_path(signature):
+    return os.path.join(TABLEBASE_DIR, signature + ".npy")
+
+
+def save_table(signature, table):
+    """
+    Saves a table, in int8 when every value fits.
+    """
+    if np.abs(table).max() <= np.iinfo(np.int8).max:
+        table = table.astype(np.int8)
+    os.makedirs(TABLEBASE_DIR, exist_ok=True)
+    np.save(table_path(signature), table)
+
+
+def get_table(signature):
+    """
+    Returns the memory mapped table for a signature, or None if it hasn't been generated.
+    """
+    if signature not in TABLES:
+        try:
+            TABLES[signature] = np.load(table_path(signature), mmap_mode="r")
+        except FileNotFoundError:
+            TABLES[signature] = None
+
+    return TABLES[signature]
+
+
+def square(pos):
+    return pos[0] * COLS + pos[1]
+
+
+def lookup(board):
+    """
+    Returns (table, attacker colour, [attacker king, piece, defender king squares])
+    for a board holding a tabled ending, else None.
+    """
+    pieces = list(board.get_white_pieces()) + list(board.get_black_pieces())
+    if len(pieces) != 3:
+        return None
+
+    kings = [piece for piece in pieces if isinstance(piece, chess_pieces.King)]
+    others = [piece for piece in pieces if not isinstance(piece, chess_pieces.King)]
+    if len(kings) != 2 or len(others) != 1:
+        return None
+
+    piece = others[0]
+    signature = "K" + piece.key + "K"
+    if signature not in SIGNATURES:
+        return None
+
+    table = get_table(signature)
+    if table is None:
+        return None
+
+    attackerKing = kings[0] if kings[0].colour == piece.colour else kings[1]
+    defenderKing = kings[1] if attackerKing is kings[0] else kings[0]
+    return table, piece.colour, [square(attackerKing.pos), square(piece.pos), square(defenderKing.pos)]
+
+
+def score_of(value):
+    """Orders table values for the side they belong to: quick wins first, slow losses next to last."""
+    if value > 0:
+        return WIN_SCORE - value
+    elif value < 0:
+        return -WIN_SCORE - value
+
+    return 0
+
+
+def probe(board, colour):
+    """
+    Returns (move, value) for the given colour to play from the tablebases,
+    with value as stored in the tables (see the module docstring), or None
+    if the position isn't in a generated table.
+    """
+    found = lookup(board)
+    if found is None:
+        return None
+    table, attackerColour, (attackerKing, piece, defenderKing) = found
+
+    side = ATTACKER if colour == attackerColour else DEFENDER
+    pieces = board.get_white_pieces() if colour == "W" else board.get_black_pieces()
+
+    best = None
+    for mover in pieces:
+        start = square(mover.pos)
+        for move in board.get_legal_moves(mover.pos):
+            end = square(move)
+
+            if end in (attackerKing, defenderKing):
+                # Takes the king
+                value = 1
+            elif end == piece:
+                # Defender takes the piece, the attacker takes back if it can
+                attackerPos = divmod(attackerKing, COLS)
+                adjacent = max(abs(attackerPos[0] - move[0]), abs(attackerPos[1] - move[1])) <= 1
+                value = -2 if adjacent else 0
+            else:
+                squares = [attackerKing, piece, defenderKing]
+                squares[squares.index(start)] = end
+                reply = int(table[1 - side][squares[0], squares[1], squares[2]])
+                # Won for the opponent is lost for us, one ply later
+                value = -reply + (1 if reply < 0 else -1 if reply > 0 else 0)
+
+            if best is None or score_of(value) > score_of(best[1]):
+                best = ((tuple(mover.pos), tuple(move)), value)
+
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate endgame tablebases.")
+    parser.add_argument("signatures", nargs="*", default=list(SIGNATURES), choices=list(SIGNATURES))
+    args = parser.parse_args()
+
+    for signature in args.signatures:
+        start = time.perf_counter()
+        table = generate(signature)
+        save_table(signature, table)
+
+        won = np.count_nonzero(table[ATTACKER] > 0)
+        print(f"[==] {signature}: {won} of {table[ATTACKER].size} positions won with the attacker to move, "
+              f"longest win {table.max()} plies, in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine_utils
+
+# Tests search from temporary directories, don't write tables out at exit
+# from wherever the run started
+engine_utils.TRANSPOSITION_SAVE_INTERVAL = None
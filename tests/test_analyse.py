@@ -0,0 +1,23 @@
+import analyse
+
+# Black's h2h3 opens the diagonal from a9 to its king on i1, and white
+# answers with a pawn move instead of taking the king
+GAME = {"game": "missed-king", "moves": ["a9a8", "c1d3", "b10a9", "h2h3", "p9p8"]}
+
+
+def test_eval_mode_flags_a_missed_king_capture(tmp_path, monkeypatch):
+    # The engine saves its transposition table to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(analyse, "settings", {"mode": "eval", "level": "casual", "blunder": 300})
+
+    analysis = analyse.analyse_game(GAME)
+    plies = analysis["plies"]
+
+    # Leaving the king to be taken, then not taking it
+    assert plies[3]["blunder"]
+    missed = plies[4]
+    assert missed["best"] == "a9i1"
+    assert missed["blunder"]
+    assert missed["loss"] >= analyse.EVAL_CLAMP
+    # The quiet opening moves cost little
+    assert not any(ply["blunder"] for ply in plies[:3])
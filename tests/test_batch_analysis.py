@@ -0,0 +1,43 @@
+import json
+
+import batch_analysis
+
+START = "rbnwbrnqknrbwnbr/pppppppppppppppp/16/16/16/16/16/16/PPPPPPPPPPPPPPPP/RBNWBRNQKNRBWNBR w"
+FREE_QUEEN = "12k3/16/4q11/16/16/4Q11/16/16/16/15K w"
+NO_KINGS = "16/16/16/16/16/16/16/16/16/16 w"
+BLACK_KING_ONLY = "12k3/16/16/16/16/16/16/16/16/16 b"
+
+
+def test_post_mixed_batch(tmp_path, monkeypatch):
+    # The engine saves its transposition table to the working directory
+    monkeypatch.chdir(tmp_path)
+    import server
+    server.analyser.processes = 2
+    try:
+        client = server.app.test_client()
+        response = client.post("/analyse", json={
+            "positions": [FREE_QUEEN, NO_KINGS, "garbage w", BLACK_KING_ONLY, START, FREE_QUEEN],
+            "level": "casual",
+        })
+        assert response.status_code == 200
+        results = {}
+        for line in response.get_data(as_text=True).splitlines():
+            result = json.loads(line)
+            results[result["index"]] = result
+    finally:
+        server.analyser.close()
+
+    assert sorted(results) == [0, 1, 2, 3, 4, 5]
+    for index in (1, 2, 3):
+        assert "error" in results[index]
+    assert results[0]["move"] == "e6e3"
+    assert results[5]["move"] == "e6e3"
+    assert "move" in results[4]
+
+
+def test_failed_analysis_is_an_error_line():
+    # Skips parse_position's checks, as if the engine failed on a position
+    key, result = batch_analysis.analyse_position(
+        ("key", BLACK_KING_ONLY.split()[0], "W", {"mode": "search", "level": "casual", "nodes": 0, "time": 0}))
+    assert key == "key"
+    assert "error" in result
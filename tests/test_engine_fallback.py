@@ -0,0 +1,42 @@
+import pytest
+
+from engine_pool import EngineError
+
+
+class FailingEngines:
+    """Stands in for an EnginePool whose processes can't answer."""
+    def __init__(self, answer):
+        self.answer = answer
+
+    def search(self, moves, level):
+        if self.answer is None:
+            raise EngineError("Engine process 0 has exited")
+        return self.answer
+
+    def ponder(self, board, moves, expectedMove, level):
+        return None
+
+
+@pytest.mark.parametrize("answer", [None, (None, [], 0)])
+def test_bot_moves_when_engine_processes_fail(tmp_path, monkeypatch, answer):
+    # The engine saves its transposition table to the working directory
+    monkeypatch.chdir(tmp_path)
+    import server
+    monkeypatch.setattr(server, "engines", FailingEngines(answer))
+    if server.socketio.server is None:
+        # Done in server.py's __main__
+        server.socketio.init_app(server.app)
+    fallbacks = server.ENGINE_FALLBACKS.values.get((), 0)
+
+    client = server.socketio.test_client(server.app)
+    client.emit("request_board", {"ssid": "fallback", "kind": "bot", "level": "casual"})
+    client.emit("move_piece", {"ssid": "fallback", "from": [9, 8], "to": [7, 8]})
+    client.get_received()
+    client.emit("bot_move", {"ssid": "fallback"})
+    moves = [message for message in client.get_received() if message["name"] == "move_piece"]
+    client.disconnect()
+    server.sessions.pop("fallback", None)
+
+    assert len(moves) == 1
+    assert moves[0]["args"][0]["seq"] == 2
+    assert server.ENGINE_FALLBACKS.values.get((), 0) == fallbacks + 1
@@ -0,0 +1,48 @@
+import contextlib
+import io
+
+import pytest
+
+import engine
+import engine_utils
+from chess.chess import ChessBoard, string_to_move
+
+# max is bounded by time alone, and takes too long to check here
+LEVELS = ["casual", "easy", "normal", "hard"]
+
+
+def depth_reached(board, isBlack, level):
+    engine_utils.TRANSPOSITION_TABLE = {}
+    depths = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.get_move(board, isBlack, level=level,
+                        onIteration=lambda depth, score, pv, nodes, elapsed: depths.append(depth))
+    return depths[-1]
+
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_level_reaches_its_depth_from_the_start(level, tmp_path, monkeypatch):
+    # The engine saves its transposition table to the working directory
+    monkeypatch.chdir(tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        board = ChessBoard()
+    assert depth_reached(board, False, level) == engine.LEVELS[level]["depth"]
+
+
+@pytest.mark.parametrize("level", ["easy", "normal"])
+def test_level_reaches_its_depth_replying_to_the_first_move(level, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        board = ChessBoard()
+        board.move_piece(*string_to_move("i9i7"))
+    assert depth_reached(board, True, level) == engine.LEVELS[level]["depth"]
+
+
+def test_pruning_lets_normal_reach_its_depth(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        board = ChessBoard()
+        board.move_piece(*string_to_move("i9i7"))
+    # Without null-move pruning and late-move reductions the node budget runs out first
+    monkeypatch.setitem(engine.LEVELS, "unpruned", dict(engine.LEVELS["normal"], null_move=False, lmr=False))
+    assert depth_reached(board, True, "unpruned") < engine.LEVELS["normal"]["depth"]
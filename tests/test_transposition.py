@@ -0,0 +1,34 @@
+import contextlib
+import io
+import json
+
+import engine_utils
+from chess.chess import ChessBoard, string_to_move
+
+
+def test_saves_are_throttled_and_flushed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(engine_utils, "TRANSPOSITION_TABLE", {})
+    monkeypatch.setattr(engine_utils, "TRANSPOSITION_SAVED_AT", 0.0)
+    monkeypatch.setattr(engine_utils, "TRANSPOSITION_SAVE_INTERVAL", 3600)
+    saves = []
+    save = engine_utils.save_transposition
+    monkeypatch.setattr(engine_utils, "save_transposition", lambda t: saves.append(len(t)) or save(t))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        board = ChessBoard()
+    move = string_to_move("i9i7")
+    engine_utils.add_transposition(board, 10, move, 2)
+    board.move_piece(*move)
+    engine_utils.add_transposition(board, -10, string_to_move("h2h4"), 2)
+    # The first add saves, the second waits for the interval
+    assert saves == [1]
+
+    engine_utils.flush_transposition()
+    assert saves == [1, 2]
+    with open(tmp_path / "transposition_table.json") as f:
+        assert len(json.load(f)) == 2
+
+    # Nothing changed since
+    engine_utils.flush_transposition()
+    assert saves == [1, 2]
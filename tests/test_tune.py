@@ -0,0 +1,37 @@
+import contextlib
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import engine_utils
+import tune
+from chess.chess import ChessBoard
+
+# Each rook can take the other
+ROOKS = "12k3/16/4r11/16/16/4R11/16/16/16/15K"
+
+
+def sides_of(placement=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        board = ChessBoard(placement) if placement else ChessBoard()
+    sides = {}
+    engine_utils.get_features(board, "W", sides=sides)
+    return sides
+
+
+def test_start_position_is_quiet():
+    assert tune.is_quiet(sides_of(), "W")
+
+
+@pytest.mark.parametrize("toPlay", ["W", "B"])
+def test_captures_for_both_sides_are_not_quiet(toPlay):
+    sides = sides_of(ROOKS)
+    assert sides["W"]["captures"] == sides["B"]["captures"] == 1
+    assert not tune.is_quiet(sides, toPlay)
+
+
+def test_capture_values_are_not_tuned():
+    assert not [name for name in tune.TUNED_VALUES if name.endswith("_CAPTURE") or name == "CHECK"]
+    assert "QUEEN_CAPTURE" in tune.UNFITTABLE_VALUES
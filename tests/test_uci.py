@@ -0,0 +1,32 @@
+import contextlib
+import io
+
+import engine
+import uci
+
+
+def run(commands):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        protocol = uci.EngineProtocol(output)
+        protocol.run(commands + ["quit"])
+    return output.getvalue().splitlines()
+
+
+def test_invalid_limit_answers_without_searching(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert run(["position startpos", "go depth x"]) == ["bestmove 0000"]
+
+
+def test_infinite_lifts_the_depth_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Only the limits are checked here, not the search
+    searched = []
+    def get_move_with_pv(board, isBlack, stop, level, onIteration=None):
+        searched.append(dict(engine.LEVELS[level]))
+        return None, []
+    monkeypatch.setattr(engine, "get_move_with_pv", get_move_with_pv)
+
+    run(["position startpos", "go level normal infinite", "go depth 1 infinite"])
+    assert [(settings["depth"], settings["nodes"], settings["time"]) for settings in searched] == [
+        (uci.INFINITE_DEPTH, 0, 0), (1, 0, 0)]
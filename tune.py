@@ -0,0 +1,228 @@
+"""
+Tunes the evaluation values in engine_utils.VALUES on self-play games,
+Texel style: the evaluation of every quiet position is mapped to an
+expected score with a logistic curve, and the values are fitted so that
+expected scores match the results of the games the positions came from.
+
+    python match.py --games 400 --level-a casual --level-b casual --output games.jsonl
+    python tune.py games.jsonl --output weights.json
+
+Games logged by the server (see game_log.py) can be used as well.
+
+The evaluation is linear in the values (see engine_utils.get_features),
+so features are counted once per position, in parallel processes, and the
+fit itself only needs matrix products over the whole set of positions.
+The evaluator loads weights.json next to engine_utils.py at startup.
+"""
+import argparse
+import contextlib
+import json
+import os
+
+import numpy as np
+
+import engine_utils
+from game_log import read_games, replay_game
+
+# Values fitted by the tuner, in VALUES order. Only quiet positions are
+# used (see is_quiet), where the side to play has no captures and neither
+# king is in check, so the *_CAPTURE and CHECK counts are always 0 there and
+# nothing can be learnt about their values. They keep their current ones
+UNFITTABLE_VALUES = [
+    name for name in engine_utils.VALUES
+    if (name.endswith("_CAPTURE") or name == "CHECK") and name not in engine_utils.FIXED_VALUES
+]
+TUNED_VALUES = [
+    name for name in engine_utils.VALUES
+    if name not in engine_utils.FIXED_VALUES and name not in UNFITTABLE_VALUES
+]
+
+RESULTS = {
+    "1-0": 1.0,
+    "1/2-1/2": 0.5,
+    "0-1": 0.0,
+}
+
+def is_quiet(sides, toPlay):
+    """
+    A position is quiet when the side to play is not in check, has moves
+    and has no captures (taking a king in check among them), so its static
+    evaluation is not about to be overturned. sides holds each colour's own
+    counts, see engine_utils.get_features.
+    """
+    side = sides[toPlay]
+    return not side["in_check"] and side["moves"] and not side["captures"]
+
+
+def extract_positions(game, skipPlies=8):
+    """
+    Replays a game and counts the features of its quiet positions.
+    The first skipPlies positions (mostly the random opening) are skipped.
+
+    Returns:
+        (rows, material, results) as lists, rows holding the counts of TUNED_VALUES
+    """
+    result = RESULTS[game["result"]]
+
+    rows, material, results = [], [], []
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for ply, board, move in replay_game(game):
+            if not board.get_king("W") or not board.get_king("B"):
+                break
+            if ply < skipPlies:
+                continue
+
+            toPlay = "W" if ply % 2 == 0 else "B"
+            sides = {}
+            features = engine_utils.get_features(board, toPlay, sides=sides)
+            if is_quiet(sides, toPlay):
+                rows.append([features[name] for name in TUNED_VALUES])
+                material.append(features["MATERIAL"] * engine_utils.VALUES["MATERIAL"])
+                results.append(result)
+
+    return rows, material, results
+
+
+def _extract(args):
+    return extract_positions(*args)
+
+
+def load_positions(paths, skipPlies, processes):
+    """
+    Counts the features of every quiet position in the games, across a pool
+    of processes.
+
+    Returns:
+        (X, material, y) arrays: feature counts (positions x TUNED_VALUES),
+        the fixed part of each evaluation, and the result of each game for white
+    """
+    import multiprocessing
+
+    X, material, y = [], [], []
+    with multiprocessing.Pool(processes) as pool:
+        # Unfinished games have no result to learn from
+        games = ((game, skipPlies) for game in read_games(paths) if game["result"] in RESULTS)
+        for i, (rows, fixed, results) in enumerate(pool.imap_unordered(_extract, games, chunksize=4)):
+            X.extend(rows)
+            material.extend(fixed)
+            y.extend(results)
+            if (i + 1) % 100 == 0:
+                print(f"[==] {i + 1} games, {len(y)} positions")
+
+    return (
+        np.array(X, dtype=np.float64).reshape(-1, len(TUNED_VALUES)),
+        np.array(material, dtype=np.float64),
+        np.array(y, dtype=np.float64),
+    )
+
+
+def expected_score(evaluations, k):
+    """White's expected score from evaluations, on the usual 400 point logistic scale."""
+    return 1 / (1 + np.power(10, -k * evaluations / 400))
+
+
+def loss(X, material, y, weights, k):
+    """Mean squared error between expected scores and results."""
+    return np.mean((y - expected_score(X @ weights + material, k)) ** 2)
+
+
+def fit_k(X, material, y, weights, low=-4.0, high=2.0, iterations=50):
+    """
+    Finds the scaling constant k that best fits the current weights,
+    by golden section search over log10(k).
+    """
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = low, high
+    c = b - ratio * (b - a)
+    d = a + ratio * (b - a)
+    for _ in range(iterations):
+        if loss(X, material, y, weights, 10 ** c) < loss(X, material, y, weights, 10 ** d):
+            b = d
+        else:
+            a = c
+        c = b - ratio * (b - a)
+        d = a + ratio * (b - a)
+
+    return 10 ** ((a + b) / 2)
+
+
+def tune(X, material, y, weights, k, iterations=2000, rate=0.5):
+    """
+    Fits the weights by full batch gradient descent (Adam) on the loss.
+    Returns the fitted weights.
+    """
+    weights = weights.copy()
+    m = np.zeros_like(weights)
+    v = np.zeros_like(weights)
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+
+    for i in range(1, iterations + 1):
+        scores = expected_score(X @ weights + material, k)
+        # d(loss)/d(evaluation) for every position
+        slope = -2 * (y - scores) * scores * (1 - scores) * np.log(10) * k / 400
+        gradient = X.T @ slope / len(y)
+
+        m = beta1 * m + (1 - beta1) * gradient
+        v = beta2 * v + (1 - beta2) * gradient ** 2
+        weights -= rate * (m / (1 - beta1 ** i)) / (np.sqrt(v / (1 - beta2 ** i)) + epsilon)
+
+        if i % 200 == 0:
+            print(f"[==] Iteration {i}: loss {loss(X, material, y, weights, k):.6f}")
+
+    return weights
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tune the evaluation values on self-play games.")
+    parser.add_argument("games", nargs="*",
+                        help="match.py --output files, or game logs (files or directories) written by the server")
+    parser.add_argument("--output", default=engine_utils.WEIGHTS_FILE, help="weights file to write")
+    parser.add_argument("--cache", help="save the positions' features here, or load them if it exists")
+    parser.add_argument("--skip-plies", type=int, default=8, help="opening moves not used for tuning")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0.5, help="learning rate, in evaluation points")
+    parser.add_argument("--holdout", type=float, default=0.1, help="share of positions kept out of the fit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.cache and os.path.exists(args.cache):
+        data = np.load(args.cache)
+        X, material, y = data["X"], data["material"], data["y"]
+        if X.shape[1] != len(TUNED_VALUES):
+            parser.error(f"{args.cache} was saved for other values, delete it to count the features again")
+        print(f"[==] Loaded {len(y)} positions from {args.cache}")
+    else:
+        if not args.games:
+            parser.error("no games to tune on")
+        X, material, y = load_positions(args.games, args.skip_plies, args.processes)
+        if args.cache:
+            np.savez_compressed(args.cache, X=X, material=material, y=y)
+    if not len(y):
+        parser.error("no quiet positions found")
+    if np.all(y == 0.5):
+        print("[!] Every game was drawn, the results can't tell the values apart")
+
+    # Hold some positions out to check the fit isn't just memorising
+    order = np.random.default_rng(args.seed).permutation(len(y))
+    split = int(len(y) * (1 - args.holdout))
+    fit, held = order[:split], order[split:]
+
+    initial = np.array([engine_utils.VALUES[name] for name in TUNED_VALUES], dtype=np.float64)
+    k = fit_k(X[fit], material[fit], y[fit], initial)
+    print(f"[==] {len(fit)} positions to fit, {len(held)} held out, k = {k:.4f}")
+    print(f"[==] Initial loss {loss(X[fit], material[fit], y[fit], initial, k):.6f}"
+          + (f", held out {loss(X[held], material[held], y[held], initial, k):.6f}" if len(held) else ""))
+
+    weights = tune(X[fit], material[fit], y[fit], initial, k, args.iterations, args.rate)
+    print(f"[==] Final loss {loss(X[fit], material[fit], y[fit], weights, k):.6f}"
+          + (f", held out {loss(X[held], material[held], y[held], weights, k):.6f}" if len(held) else ""))
+
+    print()
+    for name, old, new in zip(TUNED_VALUES, initial, weights):
+        print(f"{name:>22}: {old:>8.2f} -> {new:>8.2f}")
+    print(f"[==] Not tuned (always 0 in quiet positions): {', '.join(UNFITTABLE_VALUES)}")
+
+    with open(args.output, "w") as f:
+        json.dump({name: round(float(value), 2) for name, value in zip(TUNED_VALUES, weights)}, f, indent=4)
+    print(f"[==] Wrote {args.output}")
@@ -0,0 +1,225 @@
+"""
+The engine as a standalone process, speaking a UCI-like protocol over
+stdin and stdout, one command per line:
+
+    uci                              -> id name superchess, then uciok
+    isready                          -> readyok
+    ucinewgame                       forget earlier searches (the transposition table)
+    position startpos [moves i9i7 ...]
+    position fen <placement> [w|b] [moves ...]
+    go [level L] [depth D] [nodes N] [movetime MS] [infinite]
+    stop                             end the search now
+    quit
+
+go searches the last position set, with the side to play following from
+the moves, at a strength level (engine.LEVELS) whose limits the other
+arguments replace (infinite drops the node and time budgets, and the depth
+limit unless a depth is given, so the search runs until stop). While it
+searches, every complete iteration is reported as
+
+    info depth D score cp S nodes N time MS pv i9i7 h2h4 ...
+
+with the score for the side to play, and the search ends with
+
+    bestmove i9i7 [ponder h2h4]
+
+(bestmove 0000 when there is no move, a limit is invalid or the search
+failed). After a stop, the best move is the last complete iteration's.
+Moves are written as in match.py, positions as in ChessBoard.to_fen.
+Anything the engine prints goes to stderr with --debug, and nowhere
+otherwise.
+
+    python uci.py
+
+engine_pool.py runs these processes for the server.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+import engine
+import engine_utils
+from chess.chess import ChessBoard, move_to_string, string_to_move
+
+NAME = "superchess"
+
+# Level registered for every search, see go
+UCI_LEVEL = "uci"
+
+# Depth searched to by go infinite without a depth, deeper than any search finishes
+INFINITE_DEPTH = 100
+
+class EngineProtocol:
+    """
+    Reads commands, and runs each search on a thread so stop and
+    isready are answered while it runs.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.outputLock = threading.Lock()
+        self.board = ChessBoard()
+        self.isBlack = False
+        self.stop = None
+        self.thread = None
+
+    def send(self, line):
+        # The search thread and the command loop both write
+        with self.outputLock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def run(self, lines):
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            command, args = fields[0], fields[1:]
+
+            if command == "uci":
+                self.send(f"id name {NAME}")
+                self.send("uciok")
+            elif command == "isready":
+                self.send("readyok")
+            elif command == "ucinewgame":
+                self.wait()
+                engine_utils.TRANSPOSITION_TABLE = {}
+            elif command == "position":
+                self.wait()
+                self.set_position(args)
+            elif command == "go":
+                self.wait()
+                self.go(args)
+            elif command == "stop":
+                if self.stop is not None:
+                    self.stop.set()
+                self.wait()
+            elif command == "quit":
+                if self.stop is not None:
+                    self.stop.set()
+                self.wait()
+                return
+            else:
+                print(f"[!!] Unknown command: {line}", file=sys.stderr)
+
+    def wait(self):
+        """Waits for the running search (if any) to finish."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.stop = None
+
+    def set_position(self, args):
+        """
+        position startpos [moves ...] or position fen <placement> [w|b] [moves ...]
+        """
+        try:
+            moves = args.index("moves")
+        except ValueError:
+            moves = len(args)
+        setup, moves = args[:moves], args[moves + 1:]
+
+        try:
+            if setup[:1] == ["startpos"]:
+                board, isBlack = ChessBoard(), False
+            elif setup[:1] == ["fen"] and len(setup) > 1:
+                board = ChessBoard(setup[1])
+                isBlack = len(setup) > 2 and setup[2] == "b"
+            else:
+                raise ValueError(f"Expected startpos or fen: {' '.join(args)}")
+
+            for string in moves:
+                move = string_to_move(string)
+                board.move_piece(move[0], move[1])
+                isBlack = not isBlack
+        except (ValueError, KeyError, IndexError, AttributeError) as e:
+            print(f"[!!] Invalid position: {e}", file=sys.stderr)
+            return
+
+        self.board = board
+        self.isBlack = isBlack
+
+    def go(self, args):
+        """
+        Starts searching the current position with the given limits.
+        """
+        options = {}
+        tokens = iter(args)
+        for token in tokens:
+            if token in ("level", "depth", "nodes", "movetime"):
+                options[token] = next(tokens, None)
+            else:
+                options[token] = True
+
+        level = engine.get_level(options.get("level"))
+        settings = dict(engine.LEVELS[level])
+        try:
+            if "depth" in options:
+                settings["depth"] = int(options["depth"])
+            if "nodes" in options:
+                settings["nodes"] = int(options["nodes"])
+            if "movetime" in options:
+                settings["time"] = int(options["movetime"]) / 1000
+        except (ValueError, TypeError) as e:
+            # Don't search with only some of the limits asked for
+            print(f"[!!] Invalid limit: {e}", file=sys.stderr)
+            self.send("bestmove 0000")
+            return
+        if "infinite" in options:
+            settings["nodes"] = settings["time"] = 0
+            if "depth" not in options:
+                settings["depth"] = INFINITE_DEPTH
+        engine.LEVELS[UCI_LEVEL] = settings
+
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.search, args=(self.board, self.isBlack, self.stop), daemon=True)
+        self.thread.start()
+
+    def search(self, board, isBlack, stop):
+        # Last complete iteration's pv, played if the search is stopped
+        lastPv = []
+        def on_iteration(depth, score, pv, nodes, elapsed):
+            lastPv[:] = pv
+            line = " ".join(move_to_string(move) for move in pv)
+            self.send(f"info depth {depth} score cp {score} nodes {nodes} time {int(elapsed * 1000)} pv {line}")
+
+        try:
+            try:
+                move, pv = engine.get_move_with_pv(board, isBlack, stop, UCI_LEVEL, on_iteration)
+            except engine.SearchStopped:
+                pv = lastPv
+                move = pv[0] if pv else None
+                if move is None:
+                    # Stopped before depth 1 was done, which is quick to finish
+                    engine.LEVELS[UCI_LEVEL] = dict(engine.LEVELS[UCI_LEVEL], depth=1)
+                    move, pv = engine.get_move_with_pv(board, isBlack, None, UCI_LEVEL)
+        except Exception as e:
+            # Whoever is waiting still gets its answer
+            print(f"[!!] Search failed: {e!r}", file=sys.stderr)
+            move, pv = None, []
+
+        if move is None:
+            self.send("bestmove 0000")
+        elif len(pv) > 1:
+            self.send(f"bestmove {move_to_string(move)} ponder {move_to_string(pv[1])}")
+        else:
+            self.send(f"bestmove {move_to_string(move)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the engine over a UCI-like protocol on stdin and stdout.")
+    parser.add_argument("--debug", action="store_true", help="send the engine's own output to stderr")
+    parser.add_argument("--table-dir", help="directory the transposition table is saved in (default: a new temporary one)")
+    args = parser.parse_args()
+
+    # The protocol owns stdout, everything else printed goes elsewhere
+    output = sys.stdout
+    sys.stdout = sys.stderr if args.debug else open(os.devnull, "w")
+
+    # The engine saves its transposition table to the working directory,
+    # keep each process' table to itself
+    os.chdir(args.table_dir or tempfile.mkdtemp(prefix="superchess-uci-"))
+
+    protocol = EngineProtocol(output)
+    protocol.run(sys.stdin)